@@ -14,48 +14,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import multiprocessing
 import os
 import subprocess
 import tempfile
 
-from typing import Optional
+from typing import Dict, List, Optional, Tuple, Union
 
-from .exceptions import BCFExtrasInputError
+from . import metrics
+from .bgzf import is_bcf, is_bgzf, reheader_bgzf, remap_index
+from .exceptions import BCFExtrasBatchError, BCFExtrasInputError
 
+__all__ = [
+    "add_header_lines",
+]
 
-def add_header_lines(
-        vcf: str,
-        lines: str,
-        start: Optional[int] = None,
-        end: Optional[int] = None,
-        tmp_dir: Optional[str] = None,
-        delete_old: bool = False):
-    """
-    Utility to insert header lines from a text file into a VCF.
-    :param vcf: The VCF to add header lines to.
-    :param lines: The text file containing the lines in question.
-    :param start: 0-indexed offset from the start of the header, excluding fileformat line.
-    :param end: 0-indexed offset from the start of the header, excluding #CHROM line.
-    :param tmp_dir: Optionally, a directory to put header file fragments during processing.
-    :param delete_old: Whether to delete the original VCF or keep it with a .old file extension.
-    """
-
-    if start is None and end is None:
-        end = 0
+_INDEX_EXTENSIONS = (".tbi", ".csi")
 
-    if start is not None and end is not None:
-        raise BCFExtrasInputError("add_header_lines: Cannot set both start and end offsets")
 
-    header = [
+def _read_header(vcf: str) -> List[bytes]:
+    return [
         line.strip()
-        for line in subprocess.check_output(["bcftools", "view", "-h", vcf]).split(b"\n")
+        for line in metrics.check_output(["bcftools", "view", "-h", vcf]).split(b"\n")
         if not line.startswith(b"##bcftools")  # get rid of extra bcftools junk
         if line.strip()
     ]
-    incl_length = len(header) - 2  # Exclude first and last lines (fileformat/CHROM etc respectively)
 
-    with open(lines, "rb") as lf:
-        new_lines = [line.strip() for line in lf.readlines() if line.strip()]
+
+def _insert_lines(header: List[bytes], new_lines: List[bytes], start: Optional[int], end: Optional[int]) -> bytes:
+    incl_length = len(header) - 2  # Exclude first and last lines (fileformat/CHROM etc respectively)
 
     # ##fileformat
     # 0
@@ -81,8 +68,8 @@ def add_header_lines(
             raise BCFExtrasInputError(f"add_header_lines: End offset is past first header ({end} > {incl_length})")
 
         # Reverse lines to have consistent indexing strategy
-        header.reverse()
-        new_lines.reverse()
+        header = header[::-1]
+        new_lines = new_lines[::-1]
 
     offset = start if start is not None else end
 
@@ -93,17 +80,164 @@ def add_header_lines(
         # Un-reverse
         header.reverse()
 
-    tmp_dir = tmp_dir or "/tmp"
-    with tempfile.NamedTemporaryFile(dir=tmp_dir) as tmpfile:
-        tmpfile.write(b"\n".join(header) + b"\n")
-        tmpfile.flush()
+    return b"\n".join(header) + b"\n"
+
+
+def _replace_header(vcf: str, new_header: bytes, tmp_dir: Optional[str], delete_old: bool):
+    """
+    Replaces the header of a VCF with a new one, keeping the original VCF as {vcf}.old unless delete_old is set.
+    Plain-text VCFs and BCFs are re-headered with bcftools, which needs the new header in a file (put in tmp_dir.)
+    """
+
+    new_fn = f"{vcf}.new"
+    old_fn = f"{vcf}.old"
 
+    indices = [ext for ext in _INDEX_EXTENSIONS if os.path.exists(f"{vcf}{ext}")]
+
+    if is_bgzf(vcf) and not is_bcf(vcf):
+        # Only re-compress the header, and patch any existing index instead of having to rebuild it
+        with metrics.stage("reheader_bgzf"):
+            remap = reheader_bgzf(vcf, new_header, new_fn)
+        for ext in indices:
+            with metrics.stage("remap_index", index=f"{vcf}{ext}"):
+                remap_index(f"{vcf}{ext}", f"{new_fn}{ext}", remap)
+    else:
         # Re-header the VCF file
-        new_fn = f"{vcf}.new"
-        old_fn = f"{vcf}.old"
-        subprocess.check_call(["bcftools", "reheader", "-h", tmpfile.name, "-o", new_fn, vcf])
-        os.rename(vcf, old_fn)
-        os.rename(new_fn, vcf)
-
-        if delete_old:
-            os.remove(old_fn)
+        with tempfile.NamedTemporaryFile(dir=tmp_dir or "/tmp") as tmpfile:
+            tmpfile.write(new_header)
+            tmpfile.flush()
+            metrics.check_call(["bcftools", "reheader", "-h", tmpfile.name, "-o", new_fn, vcf])
+        # The binary BCF header is stored in front of the records, so any existing index needs to be rebuilt
+        for ext in indices:
+            metrics.check_call(["bcftools", "index", "-f", "-t" if ext == ".tbi" else "-c", new_fn])
+
+    # Indices move along with the file they belong to
+    for ext in ("", *indices):
+        os.rename(f"{vcf}{ext}", f"{old_fn}{ext}")
+        os.rename(f"{new_fn}{ext}", f"{vcf}{ext}")
+
+    if delete_old:
+        for ext in ("", *indices):
+            os.remove(f"{old_fn}{ext}")
+
+
+def _read_header_one(vcf: str) -> Tuple[Optional[List[bytes]], Optional[str]]:
+    try:
+        with metrics.stage("read_header", vcf=vcf):
+            return _read_header(vcf), None
+    except (OSError, subprocess.CalledProcessError) as e:
+        return None, str(e)
+
+
+def _replace_header_one(vcf: str, new_header: bytes, tmp_dir: Optional[str], delete_old: bool) -> Optional[str]:
+    """
+    Replaces the header of a single VCF in a batch.
+    :return: None if the file was processed successfully, or an error message otherwise.
+    """
+    try:
+        with metrics.stage("replace_header", vcf=vcf):
+            _replace_header(vcf, new_header, tmp_dir, delete_old)
+    except (OSError, subprocess.CalledProcessError, BCFExtrasInputError) as e:
+        return str(e)
+    return None
+
+
+def _run_batch(fn, args: List[tuple], ntasks: int) -> list:
+    if ntasks <= 1:
+        return [fn(*a) for a in args]
+    with multiprocessing.Pool(ntasks) as p:
+        jobs = [p.apply_async(metrics.wrap(fn), a) for a in args]
+        return [metrics.unwrap(j.get()) for j in jobs]
+
+
+def _add_header_lines_batch(
+        vcfs: List[str],
+        new_lines: List[bytes],
+        start: Optional[int],
+        end: Optional[int],
+        tmp_dir: Optional[str],
+        delete_old: bool,
+        ntasks: int):
+
+    ntasks = min(ntasks, len(vcfs))
+    failures: Dict[str, str] = {}
+
+    headers = _run_batch(_read_header_one, [(vcf,) for vcf in vcfs], ntasks)
+
+    # VCFs from the same source usually share a header, so only build each distinct new header once.
+    # Each entry is (new header, error.)
+    new_headers: Dict[Tuple[bytes, ...], Tuple[Optional[bytes], Optional[str]]] = {}
+    jobs = []
+
+    for vcf, (header, err) in zip(vcfs, headers):
+        if err is None:
+            key = tuple(header)
+            if key not in new_headers:
+                try:
+                    new_headers[key] = (_insert_lines(header, new_lines, start, end), None)
+                except BCFExtrasInputError as e:
+                    new_headers[key] = (None, str(e))
+
+            new_header, err = new_headers[key]
+
+        if err is not None:
+            failures[vcf] = err
+            continue
+
+        jobs.append((vcf, new_header, tmp_dir, delete_old))
+
+    errors = _run_batch(_replace_header_one, jobs, ntasks)
+
+    failures.update({job[0]: err for job, err in zip(jobs, errors) if err is not None})
+    if failures:
+        raise BCFExtrasBatchError(
+            f"add_header_lines: {len(failures)} of {len(vcfs)} file(s) could not be processed",
+            {vcf: failures[vcf] for vcf in vcfs if vcf in failures})
+
+
+def _check_options(start: Optional[int], end: Optional[int], ntasks: int):
+    if start is not None and end is not None:
+        raise BCFExtrasInputError("add_header_lines: Cannot set both start and end offsets")
+    if ntasks < 1:
+        raise BCFExtrasInputError("add_header_lines: ntasks must be at least 1")
+
+
+def add_header_lines(
+        vcf: Union[str, List[str]],
+        lines: str,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        tmp_dir: Optional[str] = None,
+        delete_old: bool = False,
+        ntasks: int = 1):
+    """
+    Utility to insert header lines from a text file into a VCF. For bgzipped VCFs, only the header is re-compressed
+    and the rest of the file is copied as-is; any tabix/CSI index is updated to match rather than rebuilt.
+    If a list of VCFs is given, the lines file is only read once, each distinct header is only modified once, and
+    failures for individual VCFs are collected and raised together as a BCFExtrasBatchError.
+    :param vcf: The VCF (or list of VCFs) to add header lines to.
+    :param lines: The text file containing the lines in question.
+    :param start: 0-indexed offset from the start of the header, excluding fileformat line.
+    :param end: 0-indexed offset from the start of the header, excluding #CHROM line.
+    :param tmp_dir: Optionally, a directory to put header file fragments during processing.
+    :param delete_old: Whether to delete the original VCF or keep it with a .old file extension.
+    :param ntasks: The number of VCFs to process at once, if a list of VCFs is given.
+    """
+
+    if start is None and end is None:
+        end = 0
+
+    _check_options(start, end, ntasks)
+
+    with open(lines, "rb") as lf:
+        new_lines = [line.strip() for line in lf.readlines() if line.strip()]
+
+    if not isinstance(vcf, str):
+        _add_header_lines_batch(vcf, new_lines, start, end, tmp_dir, delete_old, ntasks)
+        return
+
+    with metrics.stage("read_header", vcf=vcf):
+        new_header = _insert_lines(_read_header(vcf), new_lines, start, end)
+
+    with metrics.stage("replace_header", vcf=vcf):
+        _replace_header(vcf, new_header, tmp_dir, delete_old)
@@ -0,0 +1,341 @@
+# bcf_extras is a set of variant file helper utilities built on top of bcftools and htslib.
+# Copyright (C) 2021  David Lougheed
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+An asyncio API for running many bcf_extras jobs from a single event loop. Each job (one VCF for copy_compress_index
+and add_header_lines, or a whole merge for parallel_mergestr) runs in its own subprocess, along with the bcftools,
+tabix, bgzip or mergeSTR processes it starts, so the event loop only ever waits on pipes and never needs a thread per
+job. Jobs can share a Limiter to cap how many run at once across calls, report their progress as they go, and are
+stopped (along with everything they started) when the task awaiting them is cancelled.
+"""
+
+import asyncio
+import collections
+import contextlib
+import json
+import os
+import signal
+import sys
+
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from .exceptions import BCFExtrasBatchError, BCFExtrasInputError, BCFExtrasProcessError
+from .output_formats import OUTPUT_VCF
+
+__all__ = [
+    "EVENT_STARTED",
+    "EVENT_OUTPUT",
+    "EVENT_FINISHED",
+    "EVENT_FAILED",
+    "ProgressEvent",
+    "Limiter",
+    "copy_compress_index",
+    "add_header_lines",
+    "parallel_mergestr",
+]
+
+
+EVENT_STARTED = "started"
+EVENT_OUTPUT = "output"  # A line of (standard) output from the job
+EVENT_FINISHED = "finished"
+EVENT_FAILED = "failed"
+
+_STDERR_TAIL_LINES = 20
+
+# The package's parent directory, so that job subprocesses import this same copy of bcf_extras
+_PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@dataclass(frozen=True)
+class ProgressEvent:
+    action: str  # e.g. copy_compress_index
+    job: str  # The input file (or merge output) the event is about
+    kind: str  # One of the EVENT_ constants
+    message: Optional[str] = None  # The output line or error message, for EVENT_OUTPUT and EVENT_FAILED
+
+
+ProgressCallback = Callable[[ProgressEvent], Any]
+
+
+class Limiter:
+    """
+    Shares a number of slots (e.g. CPU cores) between jobs, including jobs from different calls into this module.
+    Most jobs take one slot, copy_compress_index jobs take one per compression thread and parallel_mergestr takes one
+    per task; a job needing more slots than there are takes them all. Waiting jobs start in the order they asked, so
+    a large job is never starved by a stream of small ones.
+    """
+
+    def __init__(self, slots: int):
+        if slots < 1:
+            raise BCFExtrasInputError("Limiter: slots must be at least 1")
+        self.slots = slots
+        self._free = slots
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = collections.deque()
+
+    @property
+    def in_use(self) -> int:
+        return self.slots - self._free
+
+    def _wake(self):
+        while self._waiters and self._waiters[0][0] <= self._free:
+            n, fut = self._waiters.popleft()
+            if not fut.done():
+                self._free -= n
+                fut.set_result(None)
+
+    async def _acquire(self, n: int):
+        if not self._waiters and n <= self._free:
+            self._free -= n
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append((n, fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.cancelled():
+                with contextlib.suppress(ValueError):  # Unless it was already dropped from the queue
+                    self._waiters.remove((n, fut))
+                self._wake()  # Jobs queued behind this one may fit now
+            else:  # Cancelled just after being given its slots
+                self._release(n)
+            raise
+
+    def _release(self, n: int):
+        self._free += n
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, n: int = 1):
+        """
+        Holds n slots for the duration of the async with-block, waiting for them to be free first.
+        """
+        n = min(n, self.slots)
+        await self._acquire(n)
+        try:
+            yield
+        finally:
+            self._release(n)
+
+
+@contextlib.asynccontextmanager
+async def _slots(limiter: Optional[Limiter], n: int):
+    if limiter is None:
+        yield
+        return
+    async with limiter.acquire(n):
+        yield
+
+
+async def _emit(progress: Optional[ProgressCallback], event: ProgressEvent):
+    if progress is None:
+        return
+    res = progress(event)
+    if asyncio.iscoroutine(res) or isinstance(res, asyncio.Future):
+        await res
+
+
+def _kill(proc: asyncio.subprocess.Process):
+    # Jobs run in their own process group, so this also stops any bcftools (etc.) processes they started
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def _job_error(ret: int, stderr: Deque[bytes]) -> str:
+    if stderr:
+        try:
+            return json.loads(stderr[-1])["error"]
+        except (ValueError, KeyError, TypeError):
+            pass
+    if ret < 0:
+        return f"killed by signal {-ret}"
+    return b"".join(stderr).decode("utf-8", errors="replace").strip() or f"exited with status {ret}"
+
+
+async def _run_job(action: str, job: str, kwargs: Dict[str, Any], slots: int, limiter: Optional[Limiter],
+                   progress: Optional[ProgressCallback]) -> Optional[str]:
+    """
+    Runs one job in a subprocess, streaming its output lines as progress events.
+    :return: None if the job succeeded, or an error message otherwise.
+    """
+
+    async with _slots(limiter, slots):
+        await _emit(progress, ProgressEvent(action, job, EVENT_STARTED))
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(p for p in (_PACKAGE_ROOT, env.get("PYTHONPATH")) if p)
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "bcf_extras.aio", action,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            env=env, start_new_session=True)
+
+        stderr: Deque[bytes] = collections.deque(maxlen=_STDERR_TAIL_LINES)
+
+        async def _read_stderr():
+            async for line in proc.stderr:
+                stderr.append(line)
+
+        stderr_task = asyncio.ensure_future(_read_stderr())
+        try:
+            # Arguments go through stdin rather than argv, which could be too short for e.g. a cohort's worth of VCFs
+            with contextlib.suppress(BrokenPipeError, ConnectionResetError):  # If it died, its exit status says why
+                proc.stdin.write(json.dumps(kwargs).encode("utf-8"))
+                await proc.stdin.drain()
+            proc.stdin.close()
+
+            async for line in proc.stdout:
+                await _emit(progress, ProgressEvent(action, job, EVENT_OUTPUT, line.decode("utf-8", "replace").strip()))
+            await stderr_task
+            ret = await proc.wait()
+        except BaseException:
+            # Cancelled (or the progress callback failed); don't leave the job running without anyone waiting on it
+            _kill(proc)
+            stderr_task.cancel()
+            await proc.wait()
+            raise
+
+    if ret == 0:
+        await _emit(progress, ProgressEvent(action, job, EVENT_FINISHED))
+        return None
+
+    error = _job_error(ret, stderr)
+    await _emit(progress, ProgressEvent(action, job, EVENT_FAILED, error))
+    return error
+
+
+async def _run_batch(action: str, jobs: List[Tuple[str, Dict[str, Any]]], ntasks: int, slots: int,
+                     limiter: Optional[Limiter], progress: Optional[ProgressCallback]) -> Dict[str, str]:
+    local = asyncio.Semaphore(ntasks)
+
+    async def _run(job: str, kwargs: Dict[str, Any]) -> Optional[str]:
+        async with local:
+            return await _run_job(action, job, kwargs, slots, limiter, progress)
+
+    # Cancelling this cancels (and so stops) every job
+    errors = await asyncio.gather(*(_run(job, kwargs) for job, kwargs in jobs))
+    return {job: err for (job, _), err in zip(jobs, errors) if err is not None}
+
+
+async def copy_compress_index(vcfs: List[str], ntasks: int = 1, threads: int = 1, sort_mem: Optional[int] = None,
+                              tmp_dir: Optional[str] = None, incremental: bool = False,
+                              output_format: str = OUTPUT_VCF, limiter: Optional[Limiter] = None,
+                              progress: Optional[ProgressCallback] = None):
+    """
+    Asynchronous version of bcf_extras.copy_compress_index.copy_compress_index; each VCF is processed by its own job.
+    Failures for individual VCFs are collected and raised together as a BCFExtrasBatchError.
+    :param limiter: Optionally, a Limiter shared with other jobs; each job takes one slot per compression thread.
+    :param progress: Optionally, a function (or coroutine function) to call with a ProgressEvent as each job starts,
+                     outputs a line, and finishes or fails.
+    """
+
+    from .copy_compress_index import _check_options
+    _check_options(ntasks, threads, sort_mem, output_format)
+
+    failures = await _run_batch("copy_compress_index", [(vcf, {
+        "vcfs": [vcf],
+        "threads": threads,
+        "sort_mem": sort_mem,
+        "tmp_dir": tmp_dir,
+        "incremental": incremental,
+        "output_format": output_format,
+    }) for vcf in vcfs], ntasks, threads, limiter, progress)
+
+    if failures:
+        raise BCFExtrasBatchError(
+            f"copy_compress_index: {len(failures)} of {len(vcfs)} file(s) could not be processed", failures)
+
+
+async def add_header_lines(vcf: Union[str, List[str]], lines: str, start: Optional[int] = None,
+                           end: Optional[int] = None, tmp_dir: Optional[str] = None, delete_old: bool = False,
+                           ntasks: int = 1, limiter: Optional[Limiter] = None,
+                           progress: Optional[ProgressCallback] = None):
+    """
+    Asynchronous version of bcf_extras.add_header_lines.add_header_lines; each VCF is processed by its own job.
+    Failures for individual VCFs are collected and raised together as a BCFExtrasBatchError.
+    :param limiter: Optionally, a Limiter shared with other jobs; each job takes one slot.
+    :param progress: Optionally, a function (or coroutine function) to call with a ProgressEvent as each job starts,
+                     outputs a line, and finishes or fails.
+    """
+
+    from .add_header_lines import _check_options
+    _check_options(start, end, ntasks)
+
+    vcfs = [vcf] if isinstance(vcf, str) else vcf
+    failures = await _run_batch("add_header_lines", [(v, {
+        "vcf": v,
+        "lines": lines,
+        "start": start,
+        "end": end,
+        "tmp_dir": tmp_dir,
+        "delete_old": delete_old,
+    }) for v in vcfs], ntasks, 1, limiter, progress)
+
+    if failures:
+        raise BCFExtrasBatchError(
+            f"add_header_lines: {len(failures)} of {len(vcfs)} file(s) could not be processed", failures)
+
+
+async def parallel_mergestr(vcfs: List[str], out: str, ntasks: int = 2, limiter: Optional[Limiter] = None,
+                            progress: Optional[ProgressCallback] = None, **kwargs):
+    """
+    Asynchronous version of bcf_extras.parallel_mergestr.parallel_mergestr, run as a single job; other keyword
+    arguments are the same as for the synchronous version. Raises a BCFExtrasProcessError if the merge fails.
+    :param limiter: Optionally, a Limiter shared with other jobs; the merge takes one slot per task.
+    :param progress: Optionally, a function (or coroutine function) to call with a ProgressEvent as the merge starts,
+                     outputs a line, and finishes or fails.
+    """
+
+    if ntasks < 1:
+        raise BCFExtrasInputError("parallel_mergestr: ntasks must be at least 1")
+
+    error = await _run_job(
+        "parallel_mergestr", out, {"vcfs": vcfs, "out": out, "ntasks": ntasks, **kwargs}, ntasks, limiter, progress)
+    if error is not None:
+        raise BCFExtrasProcessError(f"parallel_mergestr: {error}")
+
+
+def _job_main(action: str, kwargs: Dict[str, Any]) -> int:
+    # Runs a job in its subprocess. Errors are reported to the parent as a JSON object on the last line of stderr.
+
+    # TODO: py3.10: match
+    if action == "copy_compress_index":
+        from .copy_compress_index import copy_compress_index as fn
+    elif action == "add_header_lines":
+        from .add_header_lines import add_header_lines as fn
+    elif action == "parallel_mergestr":
+        from .parallel_mergestr import parallel_mergestr as fn
+    else:
+        raise BCFExtrasInputError(f"Unknown job action: {action}")
+
+    try:
+        fn(**kwargs)
+    except BCFExtrasBatchError as e:
+        error = "; ".join(e.failures.values())
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    else:
+        return 0
+
+    sys.stdout.flush()
+    sys.stderr.write("\n" + json.dumps({"error": error}) + "\n")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(_job_main(sys.argv[1], json.load(sys.stdin)))
@@ -0,0 +1,462 @@
+# bcf_extras is a set of variant file helper utilities built on top of bcftools and htslib.
+# Copyright (C) 2021  David Lougheed
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+import os
+import shutil
+import struct
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .exceptions import BCFExtrasInputError
+
+__all__ = [
+    "is_gzipped",
+    "is_bgzf",
+    "is_bcf",
+    "has_bgzf_eof",
+    "read_block",
+    "compress_blocks",
+    "BGZFWriter",
+    "TabixIndexBuilder",
+    "reheader_bgzf",
+    "remap_index",
+]
+
+
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+_BLOCK_HEADER = struct.Struct("<4BI2BH2BHH")
+_BLOCK_DATA_SIZE = 0xff00  # Same as htslib; small enough that a compressed block always fits in 64 KiB
+_COPY_CHUNK_SIZE = 1024 ** 3
+
+_TBI_PSEUDO_BIN = 37450
+_TBI_LINEAR_SHIFT = 14  # Linear index windows are 16 kbp
+
+# The binning scheme of .tbi indexes can't address positions past 2^29 (512 Mbp); longer contigs need CSI indexes
+TBI_MAX_POSITION = 1 << 29
+
+# Column layouts of the tabix presets (as with tabix -p): (format, sequence name, start and end columns.)
+_TBI_PRESETS = {
+    "gff": (0, 1, 4, 5),  # Generic format
+    "vcf": (2, 1, 2, 0),  # VCF; ends come from the length of REF or an INFO END, rather than a column
+}
+
+VirtualOffsetMap = Callable[[int], int]
+
+
+def is_gzipped(path: str) -> bool:
+    # gzip can read BGZF (a series of gzip members) as well as regular gzip files
+    with open(path, "rb") as fh:
+        return fh.read(2) == b"\x1f\x8b"
+
+
+def is_bgzf(path: str) -> bool:
+    try:
+        with open(path, "rb") as fh:
+            header = fh.read(_BLOCK_HEADER.size + 4)
+    except OSError:
+        return False
+    # gzip magic, deflate, FEXTRA flag, and a BC extra subfield first
+    return len(header) >= 16 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+
+def is_bcf(path: str) -> bool:
+    # BCFs are BGZF-compressed too, but the first block starts with the binary BCF magic instead of a text header
+    if not is_bgzf(path):
+        return False
+    with open(path, "rb") as fh:
+        block = read_block(fh)
+    return block is not None and block[1].startswith(b"BCF\x02")
+
+
+def has_bgzf_eof(path: str) -> bool:
+    # A BGZF file which was completely written ends with an empty EOF block
+    try:
+        with open(path, "rb") as fh:
+            fh.seek(0, os.SEEK_END)
+            if fh.tell() < len(BGZF_EOF):
+                return False
+            fh.seek(-len(BGZF_EOF), os.SEEK_END)
+            return fh.read() == BGZF_EOF
+    except OSError:
+        return False
+
+
+def read_block(fh: BinaryIO) -> Optional[Tuple[int, bytes]]:
+    """
+    Reads the BGZF block at the current position of a file, returning its total compressed size and its
+    decompressed data, or None at the end of the file.
+    """
+
+    header = fh.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04":
+        raise BCFExtrasInputError("Invalid BGZF block header")
+
+    extra = fh.read(struct.unpack_from("<H", header, 10)[0])
+    block_size = None
+    pos = 0
+    while pos + 4 <= len(extra):
+        si1, si2, sub_len = struct.unpack_from("<2BH", extra, pos)
+        if (si1, si2) == (66, 67):  # BC
+            block_size = struct.unpack_from("<H", extra, pos + 4)[0] + 1
+        pos += 4 + sub_len
+
+    if block_size is None:
+        raise BCFExtrasInputError("Invalid BGZF block header (missing block size)")
+
+    rest = fh.read(block_size - 12 - len(extra))
+    return block_size, zlib.decompress(rest[:-8], -15)
+
+
+def _compress_block(data: bytes, level: int) -> bytes:
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    header = _BLOCK_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def compress_blocks(data: bytes, level: int = 6) -> Iterator[bytes]:
+    for i in range(0, len(data), _BLOCK_DATA_SIZE):
+        yield _compress_block(data[i:i+_BLOCK_DATA_SIZE], level)
+
+
+def _write_bgzf(path: str, data: bytes):
+    with open(path, "wb") as out:
+        for block in compress_blocks(data):
+            out.write(block)
+        out.write(BGZF_EOF)
+
+
+class BGZFWriter:
+    """
+    Writes a BGZF file, keeping track of the virtual offset of the current position so that what is being written
+    can be indexed as it goes. With threads, blocks are compressed in parallel (zlib releases the GIL) whenever a
+    write fills more than one of them.
+    """
+
+    def __init__(self, path: str, level: int = 6, threads: int = 1):
+        self._fh = open(path, "wb")
+        self._level = level
+        self._buf = bytearray()
+        self._coffset = 0  # Compressed offset of the block currently being filled
+        self._block_offsets: List[int] = []  # Compressed offsets of every block written so far
+        self._pool = ThreadPoolExecutor(threads) if threads > 1 else None
+
+    def tell(self) -> int:
+        # Full blocks are always flushed on write, so this never points just past the end of a block
+        return (self._coffset << 16) | len(self._buf)
+
+    def virtual_offset(self, position: int) -> int:
+        """
+        Converts a position in the uncompressed data written so far to a virtual offset. Since every block but the
+        last holds exactly the same amount of data, positions can be recorded while writing and converted later.
+        """
+        block, uoffset = divmod(position, _BLOCK_DATA_SIZE)
+        return ((self._block_offsets[block] if block < len(self._block_offsets) else self._coffset) << 16) | uoffset
+
+    def _write_blocks(self, data: bytes):
+        if self._pool is None:
+            blocks = compress_blocks(data, self._level)
+        else:
+            blocks = self._pool.map(
+                lambda i: _compress_block(data[i:i+_BLOCK_DATA_SIZE], self._level),
+                range(0, len(data), _BLOCK_DATA_SIZE))
+        for block in blocks:
+            self._block_offsets.append(self._coffset)
+            self._fh.write(block)
+            self._coffset += len(block)
+
+    def write(self, data: bytes):
+        self._buf += data
+        if len(self._buf) >= _BLOCK_DATA_SIZE:
+            n = len(self._buf) - len(self._buf) % _BLOCK_DATA_SIZE
+            self._write_blocks(bytes(self._buf[:n]))
+            del self._buf[:n]
+
+    def close(self):
+        if self._fh.closed:
+            return
+        if self._buf:
+            self._write_blocks(bytes(self._buf))
+            self._buf.clear()
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._fh.write(BGZF_EOF)
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _reg2bin(beg: int, end: int) -> int:
+    # Smallest bin in the UCSC/htslib binning scheme (0-based, end-exclusive coordinates) which contains a region
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+class _TabixRef:
+    def __init__(self):
+        self.bins: Dict[int, List[List[int]]] = {}
+        self.linear: List[Optional[int]] = []
+        self.last_beg = 0
+        self.off_beg = None
+        self.off_end = 0
+        self.n_records = 0
+
+
+class TabixIndexBuilder:
+    """
+    Builds a tabix (.tbi) index for a sorted, BGZF-compressed GFF3 or VCF file while it is being written, from the
+    virtual offsets of each record. The index answers queries the same way as one from tabix -p gff (or -p vcf),
+    without having to read the finished file back in again.
+    """
+
+    def __init__(self, preset: str = "gff"):
+        self._preset = _TBI_PRESETS[preset]
+        self._names: List[bytes] = []
+        self._refs: List[_TabixRef] = []
+
+    def add(self, name: bytes, beg: int, end: int, start_offset: int, end_offset: int):
+        """
+        Adds a record to the index.
+        :param name: The record's sequence name.
+        :param beg: The record's 0-based start position.
+        :param end: The record's end position (exclusive.)
+        :param start_offset: The virtual offset of the start of the record.
+        :param end_offset: The virtual offset just past the end of the record.
+        """
+
+        if not self._names or self._names[-1] != name:
+            if name in self._names:
+                raise BCFExtrasInputError(f"Cannot index unsorted records: {name.decode()} is not contiguous")
+            self._names.append(name)
+            self._refs.append(_TabixRef())
+
+        ref = self._refs[-1]
+        if beg < ref.last_beg:
+            raise BCFExtrasInputError(f"Cannot index unsorted records: {name.decode()}:{beg + 1} is out of order")
+        ref.last_beg = beg
+        end = max(end, beg + 1)
+        if end > TBI_MAX_POSITION:
+            raise BCFExtrasInputError(
+                f"Cannot index {name.decode()}:{beg + 1}: tabix indexes only cover positions up to {TBI_MAX_POSITION}")
+
+        chunks = ref.bins.setdefault(_reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+
+        last_window = (end - 1) >> _TBI_LINEAR_SHIFT
+        if len(ref.linear) <= last_window:
+            ref.linear.extend([None] * (last_window + 1 - len(ref.linear)))
+        for w in range(beg >> _TBI_LINEAR_SHIFT, last_window + 1):
+            if ref.linear[w] is None:
+                ref.linear[w] = start_offset
+
+        if ref.off_beg is None:
+            ref.off_beg = start_offset
+        ref.off_end = end_offset
+        ref.n_records += 1
+
+    def write(self, path: str, remap: Optional[VirtualOffsetMap] = None):
+        """
+        Writes out the index.
+        :param path: The index path.
+        :param remap: Optionally, a function to convert the offsets that were added into virtual offsets, e.g.
+                      BGZFWriter.virtual_offset for uncompressed positions.
+        """
+
+        remap = remap or (lambda offset: offset)
+
+        names = b"".join(n + b"\0" for n in self._names)
+        # Preset columns, # for comments and no lines to skip
+        data = bytearray(b"TBI\x01")
+        data += struct.pack("<8i", len(self._names), *self._preset, ord("#"), 0, len(names))
+        data += names
+
+        for ref in self._refs:
+            data += struct.pack("<i", len(ref.bins) + 1)
+            for bin_id, chunks in sorted(ref.bins.items()):
+                data += struct.pack("<Ii", bin_id, len(chunks))
+                for beg, end in chunks:
+                    data += struct.pack("<QQ", remap(beg), remap(end))
+            # htslib's pseudo-bin, holding the offsets spanned by the reference and its record counts
+            data += struct.pack(
+                "<IiQQQQ", _TBI_PSEUDO_BIN, 2, remap(ref.off_beg), remap(ref.off_end), ref.n_records, 0)
+
+            # Empty windows get the offset of the next record, since nothing before it can overlap them
+            linear = list(ref.linear)
+            next_offset = ref.off_end
+            for w in reversed(range(len(linear))):
+                if linear[w] is None:
+                    linear[w] = next_offset
+                else:
+                    next_offset = linear[w]
+            data += struct.pack(f"<i{len(linear)}Q", len(linear), *map(remap, linear))
+
+        data += struct.pack("<Q", 0)  # No records without coordinates
+        _write_bgzf(path, bytes(data))
+
+
+def _copy_rest(src: BinaryIO, dst: BinaryIO, offset: int):
+    # Copies src from offset onwards to dst without going through Python where possible (copy_file_range may even
+    # share the data blocks on file systems which support reflinks.)
+    dst.flush()
+    if hasattr(os, "copy_file_range"):
+        try:
+            while True:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), _COPY_CHUNK_SIZE, offset)
+                if not copied:
+                    return
+                offset += copied
+        except OSError:
+            pass  # e.g. not supported across file systems on older kernels; finish with a regular copy
+    src.seek(offset)
+    shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+
+
+def reheader_bgzf(path: str, header: bytes, out_path: str) -> VirtualOffsetMap:
+    """
+    Writes a copy of a BGZF-compressed VCF with its header replaced. Only the blocks holding the old header are
+    decompressed; the new header is compressed into new blocks, followed by the records which shared a block with
+    the end of the old header, and every block after that is copied byte-for-byte.
+    Returns a function which maps virtual offsets into the original file to the corresponding ones in the copy, for
+    updating an index.
+    """
+
+    data = b""
+    data_start = 0  # Uncompressed offset of the first block in data
+    block_offset = 0  # Compressed offset of the current block
+
+    with open(path, "rb") as fh:
+        while True:
+            block = read_block(fh)
+            if block is None:
+                raise BCFExtrasInputError(f"Could not find the end of the header of {path}")
+
+            block_size, block_data = block
+            data += block_data
+
+            if not data.startswith(b"#"):
+                raise BCFExtrasInputError(f"{path} does not start with a VCF header")
+
+            chrom = (b"\n" + data).find(b"\n#CHROM")  # Start of the #CHROM line within data, if it is there yet
+            header_end = data.find(b"\n", chrom) + 1 if chrom != -1 else 0
+            if header_end:
+                break
+
+            block_offset += block_size
+            data_start = len(data)
+
+        # The old header ends within (or at the end of) the current block
+        split_offset = block_offset
+        split_pos = header_end - data_start
+        tail = block_data[split_pos:]
+        old_rest = block_offset + block_size
+
+        with open(out_path, "wb") as out:
+            for new_block in compress_blocks(header):
+                out.write(new_block)
+            tail_offset = out.tell()
+            if tail:
+                out.write(_compress_block(tail, 6))
+            new_rest = out.tell()
+            _copy_rest(fh, out, old_rest)
+
+    first_record = (tail_offset if tail else new_rest) << 16
+    shift = new_rest - old_rest
+
+    def _map(voffset: int) -> int:
+        coffset, uoffset = voffset >> 16, voffset & 0xffff
+        if coffset >= old_rest:
+            return ((coffset + shift) << 16) | uoffset
+        if coffset == split_offset and uoffset >= split_pos and tail:
+            return (tail_offset << 16) | (uoffset - split_pos)
+        # Anything pointing into the old header can only be a lower bound, which the first record still is
+        return first_record
+
+    return _map
+
+
+def _remap_bins(data: bytearray, pos: int, remap: VirtualOffsetMap, pseudo_bin: int, csi: bool) -> int:
+    n_bin = struct.unpack_from("<i", data, pos)[0]
+    pos += 4
+
+    for _ in range(n_bin):
+        bin_id = struct.unpack_from("<I", data, pos)[0]
+        pos += 4
+        if csi:
+            struct.pack_into("<Q", data, pos, remap(struct.unpack_from("<Q", data, pos)[0]))  # loffset
+            pos += 8
+        n_chunk = struct.unpack_from("<i", data, pos)[0]
+        pos += 4
+        # The pseudo-bin's second "chunk" holds mapped/unmapped record counts, not offsets
+        n_offsets = 2 if bin_id == pseudo_bin else n_chunk * 2
+        for i in range(n_chunk * 2):
+            if i < n_offsets:
+                struct.pack_into("<Q", data, pos, remap(struct.unpack_from("<Q", data, pos)[0]))
+            pos += 8
+
+    return pos
+
+
+def remap_index(index_path: str, out_path: str, remap: VirtualOffsetMap):
+    """
+    Writes a copy of a tabix (.tbi) or CSI index with all of its virtual offsets passed through remap.
+    """
+
+    with gzip.open(index_path, "rb") as fh:
+        data = bytearray(fh.read())
+
+    magic = bytes(data[:4])
+
+    if magic == b"TBI\x01":
+        n_ref = struct.unpack_from("<i", data, 4)[0]
+        l_nm = struct.unpack_from("<i", data, 32)[0]
+        pos = 36 + l_nm
+        for _ in range(n_ref):
+            pos = _remap_bins(data, pos, remap, _TBI_PSEUDO_BIN, csi=False)
+            n_intv = struct.unpack_from("<i", data, pos)[0]
+            pos += 4
+            for _ in range(n_intv):
+                struct.pack_into("<Q", data, pos, remap(struct.unpack_from("<Q", data, pos)[0]))
+                pos += 8
+
+    elif magic == b"CSI\x01":
+        depth, l_aux = struct.unpack_from("<ii", data, 8)
+        pos = 16 + l_aux
+        n_ref = struct.unpack_from("<i", data, pos)[0]
+        pos += 4
+        pseudo_bin = ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+        for _ in range(n_ref):
+            pos = _remap_bins(data, pos, remap, pseudo_bin, csi=True)
+
+    else:
+        raise BCFExtrasInputError(f"Unrecognized index format: {index_path}")
+
+    _write_bgzf(out_path, bytes(data))
@@ -14,17 +14,425 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import re
 import subprocess
 
-from typing import List
+from typing import BinaryIO, Dict, List, Optional
+
+from . import metrics
+from .bgzf import TBI_MAX_POSITION, BGZFWriter, TabixIndexBuilder, has_bgzf_eof
+from .exceptions import BCFExtrasBatchError, BCFExtrasInputError
+from .output_formats import OUTPUT_BCF, OUTPUT_BOTH, OUTPUT_FORMATS, OUTPUT_VCF
 
 __all__ = [
     "copy_compress_index",
 ]
 
 
-def copy_compress_index(vcfs: List[str]):
-    for vcf in vcfs:  # TODO: Parallelize if specified
-        vcf_gz = f"{vcf}.gz"
-        subprocess.check_call(["bcftools", "sort", "-o", vcf_gz, "-O" "z", vcf])
-        subprocess.check_call(["tabix", "-f", "-p", "vcf", vcf_gz])
+_READ_SIZE = 4 * 1024 * 1024
+
+SIDECAR_EXTENSION = ".cci.json"
+_SIDECAR_VERSION = 2
+
+TBI_EXTENSION = ".tbi"
+CSI_EXTENSION = ".csi"
+
+_CONTIG_ID = re.compile(rb"^##contig=<(?:.*,)?ID=([^,>]+)")
+_CONTIG_LENGTH = re.compile(rb"^##contig=<(?:.*,)?length=(\d+)")
+
+
+def _open_vcf(vcf: str) -> BinaryIO:
+    with open(vcf, "rb") as fh:
+        gzipped = fh.read(2) == b"\x1f\x8b"
+    return gzip.open(vcf, "rb") if gzipped else open(vcf, "rb")
+
+
+def _info_end(info: bytes) -> Optional[int]:
+    # As with tabix, an INFO END value overrides the end implied by the length of REF
+    if info.startswith(b"END="):
+        start = 4
+    else:
+        start = info.find(b";END=")
+        if start == -1:
+            return None
+        start += 5
+    end = info.find(b";", start)
+    try:
+        return int(info[start:] if end == -1 else info[start:end])
+    except ValueError:
+        return None
+
+
+def _alleles(ref: bytes, alt: bytes) -> List[bytes]:
+    # bcftools sort orders records at the same position by their alleles, compared case-insensitively
+    return [ref.lower(), *(alt.lower().split(b",") if alt != b"." else ())]
+
+
+def _longest_contig(vcf: str) -> int:
+    longest = 0
+    with _open_vcf(vcf) as vf:
+        for line in vf:
+            if not line.startswith(b"##"):
+                break
+            m = _CONTIG_LENGTH.match(line)
+            if m:
+                longest = max(longest, int(m.group(1)))
+    return longest
+
+
+def _write_if_sorted(vf: BinaryIO, writer: Optional[BGZFWriter], index: Optional[TabixIndexBuilder]) -> bool:
+    # With no writer or index, this just checks whether the VCF is sorted
+    contigs: Dict[bytes, int] = {}
+    last_key = (-1, 0)
+    last_alleles = (b"", b".")
+    position = 0  # In the uncompressed output
+
+    for lines in iter(lambda: vf.readlines(_READ_SIZE), []):
+        if not lines[-1].endswith(b"\n"):
+            lines[-1] += b"\n"
+
+        for line in lines:
+            if line.startswith(b"#"):
+                m = _CONTIG_ID.match(line)
+                if m and m.group(1) not in contigs:
+                    contigs[m.group(1)] = len(contigs)
+                position += len(line)
+                continue
+
+            try:
+                chrom, pos, _, ref, alt, _, _, info = line.split(b"\t", 8)[:8]
+                pos = int(pos)
+            except ValueError:
+                return False  # Let bcftools deal with (and report) anything malformed
+
+            # Like htslib, contigs missing from the header are ordered after the others, in order of appearance
+            rank = contigs.get(chrom)
+            if rank is None:
+                rank = contigs[chrom] = len(contigs)
+
+            key = (rank, pos)
+            if key < last_key or (key == last_key and _alleles(ref, alt) < _alleles(*last_alleles)):
+                return False
+            last_key = key
+            last_alleles = (ref, alt)
+
+            if index is not None:
+                beg = pos - 1
+                end = _info_end(info)
+                index.add(chrom, beg, end if end is not None and end > beg else beg + len(ref), position,
+                          position + len(line))
+            position += len(line)
+
+        if writer is not None:
+            writer.write(b"".join(lines))
+
+    return True
+
+
+def _compress_index_sorted(vcf: str, vcf_gz: str, threads: int, csi: bool = False) -> bool:
+    """
+    Compresses and indexes a VCF in a single pass, as long as its records turn out to already be in the order bcftools
+    sort would put them in: by contig in header order, then position, then alleles. CSI indexes can't be built along
+    the way, so they are made by tabix afterwards.
+    :return: Whether the VCF was sorted; if not, no output is left behind.
+    """
+
+    index = None if csi else TabixIndexBuilder("vcf")
+    try:
+        with _open_vcf(vcf) as vf, BGZFWriter(vcf_gz, threads=threads) as writer:
+            is_sorted = _write_if_sorted(vf, writer, index)
+    except BCFExtrasInputError:  # A record past the reach of a tabix index
+        os.remove(vcf_gz)
+        raise
+
+    if not is_sorted:
+        os.remove(vcf_gz)
+        return False
+
+    if csi:
+        metrics.check_call(["tabix", "-f", "--csi", "-p", "vcf", vcf_gz])
+    else:
+        index.write(f"{vcf_gz}.tbi", writer.virtual_offset)
+    return True
+
+
+def _sort_command(sort_mem: Optional[int], tmp_dir: Optional[str]) -> List[str]:
+    sort_cmd = ["bcftools", "sort"]
+    if sort_mem is not None:
+        sort_cmd.extend(("-m", str(sort_mem)))
+    if tmp_dir is not None:
+        sort_cmd.extend(("-T", os.path.join(tmp_dir, "bcftools.XXXXXX")))
+    return sort_cmd
+
+
+def _sort_compress(vcf: str, vcf_gz: str, threads: int, sort_mem: Optional[int], tmp_dir: Optional[str]):
+    sort_cmd = _sort_command(sort_mem, tmp_dir)
+
+    if threads <= 1:
+        metrics.check_call([*sort_cmd, "-o", vcf_gz, "-O" "z", vcf])
+        return
+
+    # bcftools sort cannot use extra compression threads itself, so hand uncompressed VCF text off to a multi-threaded
+    # bgzip process instead. Uncompressed BCF would be cheaper to pass along, but requires contig header lines.
+    sort_proc = metrics.popen([*sort_cmd, "-O", "v", vcf], stdout=subprocess.PIPE)
+    try:
+        with open(vcf_gz, "wb") as gz_fh:
+            metrics.check_call(["bgzip", "-@", str(threads), "-c"], stdin=sort_proc.stdout, stdout=gz_fh)
+    finally:
+        sort_proc.stdout.close()
+        sort_ret = metrics.wait(sort_proc)
+
+    if sort_ret != 0:
+        raise subprocess.CalledProcessError(sort_ret, sort_proc.args)
+
+
+def _compress_index(vcf: str, vcf_gz: str, threads: int, sort_mem: Optional[int], tmp_dir: Optional[str]) -> str:
+    """
+    Makes a sorted, bgzipped copy of a VCF with an index: a tabix one, unless the VCF has contigs too long for tabix.
+    :return: The extension of the index that was made.
+    """
+
+    csi = _longest_contig(vcf) > TBI_MAX_POSITION
+    try:
+        with metrics.stage("compress_index_sorted", csi=csi):
+            is_sorted = _compress_index_sorted(vcf, vcf_gz, threads, csi)
+    except BCFExtrasInputError:
+        # Records past tabix' limit, on a contig without a (long enough) declared length
+        csi = True
+        with metrics.stage("compress_index_sorted", csi=csi):
+            is_sorted = _compress_index_sorted(vcf, vcf_gz, threads, csi)
+
+    index_ext = CSI_EXTENSION if csi else TBI_EXTENSION
+    if is_sorted:
+        print(f"\t{vcf}: already sorted; compressed and indexed in a single pass", flush=True)
+        return index_ext
+
+    print(f"\t{vcf}: not sorted; sorting with bcftools sort", flush=True)
+    with metrics.stage("sort_compress"):
+        _sort_compress(vcf, vcf_gz, threads, sort_mem, tmp_dir)
+    metrics.check_call(["tabix", "-f", *(("--csi",) if csi else ()), "-p", "vcf", vcf_gz])
+    return index_ext
+
+
+def _convert_index_bcf(vcf: str, bcf: str, threads: int, sort_mem: Optional[int], tmp_dir: Optional[str],
+                       sorted_copy: Optional[str] = None):
+    """
+    Makes a sorted BCF copy of a VCF with a CSI index, converting an already-sorted copy of it if one is given.
+    """
+
+    if sorted_copy is None:
+        with metrics.stage("check_sorted"), _open_vcf(vcf) as vf:
+            is_sorted = _write_if_sorted(vf, None, None)
+    else:
+        is_sorted = True
+
+    if is_sorted:
+        print(f"\t{vcf}: converting to BCF", flush=True)
+        with metrics.stage("convert_bcf"):
+            metrics.check_call([
+                "bcftools", "view", *(("--threads", str(threads)) if threads > 1 else ()), "-o", bcf, "-O", "b",
+                sorted_copy or vcf])
+    else:
+        print(f"\t{vcf}: not sorted; sorting with bcftools sort into BCF", flush=True)
+        with metrics.stage("sort_bcf"):
+            metrics.check_call([*_sort_command(sort_mem, tmp_dir), "-o", bcf, "-O", "b", vcf])
+
+    # Unlike tabix indexes, CSI indexes can cover contigs of any length
+    metrics.check_call(["bcftools", "index", "-f", "--csi", bcf])
+
+
+def _file_stamp(path: str) -> List[int]:
+    # Unlike the modification time, the change time can't be set back, and is updated by any write to the file
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+
+def _sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(_READ_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_sidecar(sidecar: str, record: dict):
+    # Written atomically, so that an interrupted run can never leave a half-written one behind
+    tmp_path = f"{sidecar}.tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump(record, fh, indent=2)
+    os.replace(tmp_path, sidecar)
+
+
+def _is_up_to_date(vcf: str, output: str) -> bool:
+    """
+    Checks one of a VCF's compressed copies and its index against the fingerprints recorded in the copy's sidecar
+    when they were made. Outputs must be unchanged since then and complete; the source must either be untouched since,
+    or (e.g. if it was copied or touched) still have the same content.
+    """
+
+    sidecar = f"{output}{SIDECAR_EXTENSION}"
+
+    try:
+        with open(sidecar, "r") as fh:
+            record = json.load(fh)
+        if record.get("version") != _SIDECAR_VERSION:
+            return False
+
+        if (_file_stamp(output) != record["output"] or
+                _file_stamp(f"{output}{record['index_extension']}") != record["index"]):
+            return False
+        if not has_bgzf_eof(output):  # BCF files are BGZF-compressed too
+            return False
+
+        source = _file_stamp(vcf)
+        if source == record["source"]["stamp"]:
+            return True
+        if source[0] != record["source"]["stamp"][0] or _sha256(vcf) != record["source"]["sha256"]:
+            return False
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+    # Same content; remember the new stamp, so the next run doesn't need to hash the source again
+    record["source"]["stamp"] = source
+    _write_sidecar(sidecar, record)
+    return True
+
+
+def _remove_if_exists(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _bcf_path(vcf: str) -> str:
+    for ext in (".vcf", ".vcf.gz"):
+        if vcf.endswith(ext):
+            return f"{vcf[:-len(ext)]}.bcf"
+    return f"{vcf}.bcf"
+
+
+def _replace_output(tmp_path: str, output: str, index_ext: str):
+    # Data first, then its index, so an index is never newer than the data it describes; an index of the other kind
+    # left over from a previous run would be stale, so it goes too.
+    os.replace(tmp_path, output)
+    os.replace(f"{tmp_path}{index_ext}", f"{output}{index_ext}")
+    _remove_if_exists(f"{output}{CSI_EXTENSION if index_ext == TBI_EXTENSION else TBI_EXTENSION}")
+
+
+def _copy_compress_index_one(vcf: str, threads: int, sort_mem: Optional[int], tmp_dir: Optional[str],
+                             incremental: bool = False, output_format: str = OUTPUT_VCF) -> Optional[str]:
+    """
+    Sorts, compresses and indexes a single VCF.
+    :return: None if the file was processed successfully, or an error message otherwise.
+    """
+
+    vcf_gz = f"{vcf}.gz"
+    bcf = _bcf_path(vcf)
+    outputs = [
+        *((vcf_gz,) if output_format in (OUTPUT_VCF, OUTPUT_BOTH) else ()),
+        *((bcf,) if output_format in (OUTPUT_BCF, OUTPUT_BOTH) else ()),
+    ]
+
+    # Outputs are written under temporary names and only replace the previous ones once complete, so an interrupted
+    # run never leaves a truncated file in their place
+    tmp_gz = f"{vcf}.tmp.gz"
+    tmp_bcf = f"{bcf[:-4]}.tmp.bcf"
+
+    try:
+        with metrics.stage("file", vcf=vcf, output_format=output_format):
+            if incremental:
+                with metrics.stage("check_up_to_date"):
+                    stale = [o for o in outputs if not _is_up_to_date(vcf, o)]
+                if not stale:
+                    print(f"\t{vcf}: up to date; skipped", flush=True)
+                    return None
+                outputs = stale
+
+            for output in outputs:
+                _remove_if_exists(f"{output}{SIDECAR_EXTENSION}")
+            source = {"stamp": _file_stamp(vcf), "sha256": _sha256(vcf)} if incremental else None
+
+            index_exts = {}
+            sorted_copy = vcf_gz if output_format == OUTPUT_BOTH else None  # If it is up to date, it can be reused
+            if vcf_gz in outputs:
+                index_exts[vcf_gz] = _compress_index(vcf, tmp_gz, threads, sort_mem, tmp_dir)
+                sorted_copy = tmp_gz
+            if bcf in outputs:
+                _convert_index_bcf(vcf, tmp_bcf, threads, sort_mem, tmp_dir, sorted_copy)
+                index_exts[bcf] = CSI_EXTENSION
+
+            for output, tmp_path in ((vcf_gz, tmp_gz), (bcf, tmp_bcf)):
+                if output not in outputs:
+                    continue
+                _replace_output(tmp_path, output, index_exts[output])
+                if incremental:
+                    _write_sidecar(f"{output}{SIDECAR_EXTENSION}", {
+                        "version": _SIDECAR_VERSION,
+                        "source": source,
+                        "output": _file_stamp(output),
+                        "index_extension": index_exts[output],
+                        "index": _file_stamp(f"{output}{index_exts[output]}"),
+                    })
+    except (OSError, subprocess.CalledProcessError) as e:
+        for path in (tmp_gz, tmp_bcf):
+            for ext in ("", TBI_EXTENSION, CSI_EXTENSION):
+                _remove_if_exists(f"{path}{ext}")
+        return str(e)
+    return None
+
+
+def _check_options(ntasks: int, threads: int, sort_mem: Optional[int], output_format: str):
+    if ntasks < 1:
+        raise BCFExtrasInputError("copy_compress_index: ntasks must be at least 1")
+    if threads < 1:
+        raise BCFExtrasInputError("copy_compress_index: threads must be at least 1")
+    if sort_mem is not None and sort_mem < 1:
+        raise BCFExtrasInputError("copy_compress_index: sort_mem must be at least 1")
+    if output_format not in OUTPUT_FORMATS:
+        raise BCFExtrasInputError(f"copy_compress_index: unknown output format: {output_format}")
+
+
+def copy_compress_index(vcfs: List[str], ntasks: int = 1, threads: int = 1, sort_mem: Optional[int] = None,
+                        tmp_dir: Optional[str] = None, incremental: bool = False, output_format: str = OUTPUT_VCF):
+    """
+    Creates a sorted, bgzipped copy of each VCF with a corresponding tabix index, and/or a sorted BCF copy with a CSI
+    index. VCFs which are already sorted (by header contig order and position) are compressed and indexed in a single
+    streaming pass; the order is checked along the way, and only VCFs which turn out to be unsorted are sorted with
+    bcftools sort. Bgzipped copies of VCFs with contigs longer than tabix indexes can handle (512 Mbp) get CSI indexes
+    instead.
+    In incremental mode, a sidecar file per output ({vcf}.gz.cci.json, {vcf}.bcf.cci.json) records fingerprints of
+    each VCF's content and outputs, and outputs which are still complete and up to date with their VCF's content are
+    skipped.
+    :param vcfs: The VCFs to process.
+    :param ntasks: The number of VCFs to process at once.
+    :param threads: The number of extra compression threads to use for each VCF.
+    :param sort_mem: Optionally, the maximum amount of memory (in bytes) for bcftools sort to use before spilling
+                     records to temporary files.
+    :param tmp_dir: Optionally, the directory for bcftools sort to put its temporary files in.
+    :param incremental: Whether to skip VCFs whose outputs are up to date, and record fingerprints for later runs.
+    :param output_format: What to produce for each VCF: "vcf" ({vcf}.gz), "bcf" (the VCF's name with a .bcf extension
+                          instead of .vcf) or "both".
+    """
+
+    _check_options(ntasks, threads, sort_mem, output_format)
+
+    ntasks = min(ntasks, len(vcfs))
+    args = (threads, sort_mem, tmp_dir, incremental, output_format)
+
+    if ntasks <= 1:
+        errors = [_copy_compress_index_one(vcf, *args) for vcf in vcfs]
+    else:
+        with multiprocessing.Pool(ntasks) as p:
+            jobs = [p.apply_async(metrics.wrap(_copy_compress_index_one), (vcf, *args)) for vcf in vcfs]
+            errors = [metrics.unwrap(j.get()) for j in jobs]
+
+    failures: Dict[str, str] = {vcf: err for vcf, err in zip(vcfs, errors) if err is not None}
+    if failures:
+        raise BCFExtrasBatchError(
+            f"copy_compress_index: {len(failures)} of {len(vcfs)} file(s) could not be processed", failures)
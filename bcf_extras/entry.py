@@ -17,14 +17,19 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import contextlib
+import itertools
+import re
 import sys
 
-from typing import List, Optional
+from typing import ContextManager, Iterable, Iterator, List, Optional, TextIO
 
-from .add_header_lines import add_header_lines
-from .copy_compress_index import copy_compress_index
-from .parallel_mergestr import parallel_mergestr
-from .filter_gff3 import filter_gff3
+from .exceptions import BCFExtrasBatchError
+from .merge_engines import ENGINE_MERGESTR, MERGE_ENGINES
+from .output_formats import OUTPUT_FORMATS, OUTPUT_VCF
+
+# Sub-command implementations are only imported once their action has been picked, so that quick actions (e.g.
+# arg-join, often run in shell loops) don't pay for importing the others and their dependencies (TRTools, NumPy...)
 
 __all__ = [
     "main",
@@ -35,13 +40,63 @@ ACTION_ADD_HEADER_LINES = "add-header-lines"
 ACTION_ARG_JOIN = "arg-join"
 ACTION_COPY_COMPRESS_INDEX = "copy-compress-index"
 ACTION_PARALLEL_MERGESTR = "parallel-mergeSTR"
+ACTION_PLAN_MERGESTR = "plan-mergeSTR"
+ACTION_RUN_MERGE_PLAN = "run-merge-plan"
 ACTION_FILTER_GFF3 = "filter-gff3"
+ACTION_INDEX_GFF3 = "index-gff3"
+ACTION_QUERY_GFF3 = "query-gff3"
+
+
+_MEMORY_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def _memory_size(value: str) -> int:
+    # Parses sizes like 64G, 512M, 1.5GiB or a plain number of bytes
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*", value, re.IGNORECASE)
+    if m is None:
+        raise argparse.ArgumentTypeError(f"invalid memory size: {value} (expected e.g. 512M or 64G)")
+    return int(float(m.group(1)) * _MEMORY_UNITS[m.group(2).upper()])
 
 
 def _add_cci_parser(subparsers):
     cci_parser = subparsers.add_parser(
         ACTION_COPY_COMPRESS_INDEX,
-        help="Compresses a VCF to a bgzipped copy with a tabix index, leaving the original intact.")
+        help="Compresses a VCF to a bgzipped copy with a tabix index (and/or a BCF copy with a CSI index), leaving the "
+             "original intact.")
+    cci_parser.add_argument(
+        "--ntasks",
+        type=int,
+        default=1,
+        help="The number of VCFs to process at once, each in its own process.")
+    cci_parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="The number of compression threads to use for each VCF.")
+    cci_parser.add_argument(
+        "--sort-mem",
+        type=_memory_size,
+        default=None,
+        help="For VCFs which turn out not to be sorted already, the maximum amount of memory (e.g. 2G) for bcftools "
+             "sort to use before spilling to temporary files. Defaults to bcftools' own default.")
+    cci_parser.add_argument(
+        "--tmp-dir",
+        type=str,
+        default=None,
+        help="Directory for bcftools sort's temporary files, for VCFs which turn out not to be sorted already.")
+    cci_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip VCFs whose compressed copy and index are complete and up to date with the VCF's content, as "
+             "recorded in a {output}.cci.json fingerprint file by a previous incremental run.")
+    cci_parser.add_argument(
+        "--output-format",
+        type=str,
+        choices=OUTPUT_FORMATS,
+        default=OUTPUT_VCF,
+        help="What to produce for each VCF: a bgzipped copy ({vcf}.gz) with a tabix index (or a CSI index, if the VCF "
+             "has contigs longer than 512 Mbp), a BCF copy (with a .bcf extension instead of .vcf) with a CSI index, "
+             "or both.")
     cci_parser.add_argument("vcfs", nargs="+", type=str, help="The VCF(s) to process.")
 
 
@@ -50,8 +105,19 @@ def _add_ahl_parser(subparsers):
         ACTION_ADD_HEADER_LINES,
         help="Inserts new VCF header lines from stdin to either the end of the header (default) or to a specified "
              "position in a VCF file, in-place. Ignores the first and last header lines (fileformat/#CHROM.)")
-    ahl_parser.add_argument("vcf", type=str, help="The VCF to process.")
+    ahl_parser.add_argument("vcfs", nargs="*", type=str, help="The VCF(s) to process.")
     ahl_parser.add_argument("lines", type=str, help="The text file with header lines to insert.")
+    ahl_parser.add_argument(
+        "--vcf-list",
+        type=str,
+        default=None,
+        help="A text file listing VCFs to process (one per line), or - to read them from stdin, in addition to any "
+             "given as arguments.")
+    ahl_parser.add_argument(
+        "--ntasks",
+        type=int,
+        default=1,
+        help="The number of VCFs to process at once, each in its own process.")
     ahl_parser.add_argument(
         "--tmp-dir",
         type=str,
@@ -81,23 +147,130 @@ def _add_aj_parser(subparsers):
         ACTION_ARG_JOIN,
         help="Joins arguments by a specified string, for pipelining into other utilities.")
     aj_parser.add_argument("--sep", type=str, default=",", help="The string to join arguments by.")
+    aj_parser.add_argument(
+        "--items-from",
+        type=str,
+        default=None,
+        help="A text file of items to join (one per line; blank lines and #-comments are ignored), or - to read them "
+             "from stdin, after any given as arguments. Items are streamed through rather than held in memory.")
+    aj_parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="File to write the joined items to instead of stdout.")
     aj_parser.add_argument("args", nargs="*", help="Arguments to join together.")
 
 
+def _add_merge_args(parser: argparse.ArgumentParser, ntasks_help: str):
+    # Options shared by parallel-mergeSTR and plan-mergeSTR, which plans merges the same way
+    parser.add_argument("--out", type=str, required=True, help="Output VCF name for final merge result.")
+    parser.add_argument(
+        "--vcftype",
+        type=str,
+        default="auto",
+        help="The type of VCFs being processed (see mergeSTR docs for more info.)")
+    parser.add_argument("--ntasks", type=int, default=2, help=ntasks_help)
+    parser.add_argument(
+        "--fan-in",
+        type=int,
+        default=None,
+        help="If set, the maximum number of inputs for any single merge. Intermediate results are merged in a "
+             "multi-level tree, with each merge starting as soon as its inputs are ready.")
+    parser.add_argument(
+        "--shard",
+        action="store_true",
+        help="Instead of merging groups of samples in a tree, merge all samples one contig at a time in parallel, "
+             "then concatenate the per-contig results. Requires tabix-indexed inputs.")
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=None,
+        help="If set, further splits contigs into region shards of this many bases. Implies --shard.")
+    parser.add_argument(
+        "--tmp-dir",
+        type=str,
+        default=None,
+        help="Directory to write intermediate merge files to, e.g. local scratch space on a cluster node.")
+    parser.add_argument(
+        "--stream-intermediates",
+        action="store_true",
+        help="Pipe intermediate merge output straight into bgzip, instead of writing an uncompressed VCF to disk "
+             "and compressing it afterwards.")
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=MERGE_ENGINES,
+        default=ENGINE_MERGESTR,
+        help="The merge implementation to use: TRTools' mergeSTR, or a built-in streaming merger which produces the "
+             "same output faster for large numbers of samples.")
+    parser.add_argument(
+        "--vcf-list",
+        type=str,
+        default=None,
+        help="A text file listing VCFs to merge (one per line), or - to read them from stdin, in addition to any "
+             "given as arguments. Avoids command-line length limits for large cohorts.")
+    parser.add_argument("vcfs", nargs="*", type=str, help="The VCF(s) to merge.")
+
+
 def _add_pms_parser(subparsers):
     pms_parser = subparsers.add_parser(
         ACTION_PARALLEL_MERGESTR,
         help="Runs the TRTools mergeSTR command in parallel, with a specified number of processes.")
-    pms_parser.add_argument("--out", type=str, required=True, help="Output VCF name for final merge result.")
+    _add_merge_args(pms_parser, "The number of processes to use.")
     pms_parser.add_argument(
-        "--vcftype",
-        type=str,
-        default="auto",
-        help="The type of VCFs being processed (see mergeSTR docs for more info.)")
-    pms_parser.add_argument("--ntasks", type=int, default=2, help="The number of processes to use.")
+        "--no-resume",
+        action="store_true",
+        help="Re-run every merge, instead of re-using intermediate files which a previous, interrupted run with the "
+             "same inputs and options had already finished.")
+    pms_parser.add_argument(
+        "--max-mem",
+        type=_memory_size,
+        default=None,
+        help="If set, a memory budget (e.g. 64G) for all merges running at once. Merges are only started while "
+             "their estimated memory use fits in the budget; estimates are refined from measured peak memory use.")
     pms_parser.add_argument("--step1-only", action="store_true", help="Whether to only run the first step.")
     pms_parser.add_argument("--step2-only", action="store_true", help="Whether to only run the second step.")
-    pms_parser.add_argument("vcfs", nargs="+", type=str, help="The VCF(s) to merge.")
+
+
+def _add_plan_parser(subparsers):
+    plan_parser = subparsers.add_parser(
+        ACTION_PLAN_MERGESTR,
+        help="Plans a parallel-mergeSTR merge without running it, writing every merge (with its inputs, "
+             "dependencies and estimated cost) to a JSON plan which run-merge-plan can run, e.g. across a cluster.")
+    plan_parser.add_argument("--plan", type=str, required=True, help="Where to write the JSON merge plan.")
+    _add_merge_args(plan_parser, "The number of processes to plan the first level of merges for.")
+
+
+def _add_rmp_parser(subparsers):
+    rmp_parser = subparsers.add_parser(
+        ACTION_RUN_MERGE_PLAN,
+        help="Runs a merge plan written by plan-mergeSTR: either a single merge of it (e.g. as a cluster array job "
+             "task), or the whole plan on this machine.")
+    node = rmp_parser.add_mutually_exclusive_group()
+    node.add_argument("--node", type=str, default=None, help="The ID of the single merge to run.")
+    node.add_argument(
+        "--level",
+        type=int,
+        default=None,
+        help="The level of the single merge to run, which is picked by its --index within the level. The merges of "
+             "a level only depend on those of earlier levels.")
+    rmp_parser.add_argument("--index", type=int, default=None, help="With --level, the index of the merge to run.")
+    rmp_parser.add_argument(
+        "--ntasks",
+        type=int,
+        default=2,
+        help="When running the whole plan, the number of processes to use.")
+    rmp_parser.add_argument(
+        "--max-mem",
+        type=_memory_size,
+        default=None,
+        help="When running the whole plan, a memory budget (e.g. 64G) for all merges running at once.")
+    rmp_parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="When running the whole plan, re-run every merge instead of re-using ones a previous, interrupted run "
+             "had already finished.")
+    rmp_parser.add_argument("plan", type=str, help="The JSON merge plan to run.")
 
 
 def _add_fg3_parser(subparsers):
@@ -109,46 +282,224 @@ def _add_fg3_parser(subparsers):
     fg3_parser.add_argument("--type", type=str, help="type filter")
     fg3_parser.add_argument("--strand", type=str, help="strand filter")
     fg3_parser.add_argument("--phase", type=str, help="phase filter")
+    fg3_parser.add_argument(
+        "--attr",
+        type=str,
+        action="append",
+        default=None,
+        help="Attribute (column 9) filter, either KEY=REGEX to match the value of an attribute, or just KEY to only "
+             "require the attribute to be present. Can be given multiple times; all filters must match.")
+    fg3_parser.add_argument(
+        "--expr",
+        type=str,
+        default=None,
+        help="Filter expression over columns and attributes, e.g. 'type ~ \"^exon$\" and end - start > 1000 and "
+             "score >= 10'. Columns: seqid, source, type, start, end, score, strand, phase; attributes: attr.KEY.")
+    fg3_parser.add_argument(
+        "--region",
+        type=str,
+        default=None,
+        help="Only output features overlapping a region (chr, chr:start or chr:start-end, 1-based and inclusive.) "
+             "For bgzipped files with a tabix index, this and --seqid read only the matching parts of the file.")
+    fg3_parser.add_argument(
+        "--ntasks",
+        type=int,
+        default=1,
+        help="The number of processes to filter large, uncompressed files with. Output stays in input order.")
+    fg3_parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="File to write output to instead of stdout. Output is bgzipped if the file name ends in .gz.")
+    fg3_parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Sort the (bgzipped) output by position and tabix-index it, in the same pass as filtering. Implies "
+             "--no-body-comments.")
+    fg3_parser.add_argument(
+        "--sort-mem",
+        type=_memory_size,
+        default="512M",
+        help="With --index, roughly how much memory (e.g. 2G) to hold records in if they need sorting; beyond this, "
+             "sorted runs are written to temporary files and merged.")
+    fg3_parser.add_argument(
+        "--tmp-dir",
+        type=str,
+        default=None,
+        help="Directory for temporary files used when sorting output.")
     fg3_parser.add_argument("--no-body-comments", action="store_true",
                             help="Whether to remove comments that are interspersed with records.")
     fg3_parser.add_argument("file", type=str, help="GFF3 file path to process.")
 
 
-def main(args: Optional[List[str]] = None):
-    parser = argparse.ArgumentParser(
-        description="A set of variant file helper utilities built on top of bcftools and htslib.")
-    subparsers = parser.add_subparsers(
-        dest="action",
-        title="action",
-        help="The action to run. Each action has its own set of arguments.",
-        required=True)
+def _add_ig3_parser(subparsers):
+    ig3_parser = subparsers.add_parser(
+        ACTION_INDEX_GFF3,
+        help="Builds a persistent index of a GFF3 file (plain or bgzipped) for fast feature/hierarchy and region "
+             "queries with query-gff3.")
+    ig3_parser.add_argument(
+        "--index-path",
+        type=str,
+        default=None,
+        help="Where to write the index. Defaults to the GFF3 file path plus .gffidx.")
+    ig3_parser.add_argument("file", type=str, help="GFF3 file path to index.")
 
-    _add_cci_parser(subparsers)
-    _add_ahl_parser(subparsers)
-    _add_aj_parser(subparsers)
-    _add_pms_parser(subparsers)
-    _add_fg3_parser(subparsers)
 
-    p_args = parser.parse_args(args or sys.argv[1:])
+def _add_qg3_parser(subparsers):
+    qg3_parser = subparsers.add_parser(
+        ACTION_QUERY_GFF3,
+        help="Queries a GFF3 file indexed with index-gff3, for a feature and its descendants or for all features "
+             "overlapping a region.")
+    query = qg3_parser.add_mutually_exclusive_group(required=True)
+    query.add_argument("--id", type=str, help="ID of the feature to output, along with all of its descendants.")
+    query.add_argument(
+        "--region",
+        type=str,
+        help="Output all features overlapping a region (chr, chr:start or chr:start-end, 1-based and inclusive.)")
+    qg3_parser.add_argument(
+        "--no-descendants",
+        action="store_true",
+        help="With --id, only output the feature itself, not its children, their children, etc.")
+    qg3_parser.add_argument(
+        "--index-path",
+        type=str,
+        default=None,
+        help="Path of the index, if it isn't the GFF3 file path plus .gffidx.")
+    qg3_parser.add_argument("file", type=str, help="Indexed GFF3 file path to query.")
+
+
+def _open_file_list(path: str) -> ContextManager[TextIO]:
+    return contextlib.nullcontext(sys.stdin) if path == "-" else open(path, "r")
+
+
+def _iter_file_list(fh: TextIO) -> Iterator[str]:
+    # One file name per line; blank lines and #-comments are ignored
+    for ln in fh:
+        ln = ln.strip()
+        if ln and not ln.startswith("#"):
+            yield ln
+
+
+def _read_file_list(path: str) -> List[str]:
+    with _open_file_list(path) as fh:
+        return list(_iter_file_list(fh))
+
+
+def _write_joined(items: Iterable[str], sep: str, out: TextIO):
+    # Written item by item, so even a huge list is never built up into one string
+    for idx, item in enumerate(items):
+        if idx:
+            out.write(sep)
+        out.write(item)
+
+
+def _vcfs_with_list(parser: argparse.ArgumentParser, p_args: argparse.Namespace) -> List[str]:
+    vcfs = p_args.vcfs + (_read_file_list(p_args.vcf_list) if p_args.vcf_list else [])
+    if not vcfs:
+        parser.error(f"{p_args.action}: no VCFs given")
+    return vcfs
+
+
+def _report_batch_error(e: BCFExtrasBatchError):
+    print(str(e), file=sys.stderr)
+    for fn, err in e.failures.items():
+        print(f"\t{fn}: {err}", file=sys.stderr)
+    sys.exit(1)
 
+
+def _run_action(parser: argparse.ArgumentParser, p_args: argparse.Namespace):
     # TODO: py3.10: match
     if p_args.action == ACTION_COPY_COMPRESS_INDEX:
-        copy_compress_index(p_args.vcfs)
+        from .copy_compress_index import copy_compress_index
+        try:
+            copy_compress_index(
+                p_args.vcfs,
+                p_args.ntasks,
+                p_args.threads,
+                sort_mem=p_args.sort_mem,
+                tmp_dir=p_args.tmp_dir,
+                incremental=p_args.incremental,
+                output_format=p_args.output_format,
+            )
+        except BCFExtrasBatchError as e:
+            _report_batch_error(e)
     elif p_args.action == ACTION_ADD_HEADER_LINES:
-        add_header_lines(p_args.vcf, p_args.lines, p_args.start, p_args.end, p_args.delete_old)
+        vcfs = _vcfs_with_list(parser, p_args)
+
+        from .add_header_lines import add_header_lines
+
+        failures = {}
+        try:
+            add_header_lines(
+                vcfs,
+                p_args.lines,
+                p_args.start,
+                p_args.end,
+                tmp_dir=p_args.tmp_dir,
+                delete_old=p_args.delete_old,
+                ntasks=p_args.ntasks,
+            )
+        except BCFExtrasBatchError as e:
+            failures = e.failures
+
+        print(f"add-header-lines: {len(vcfs) - len(failures)} of {len(vcfs)} file(s) updated")
+        for vcf in vcfs:
+            print(f"\t{vcf}: {'failed - ' + failures[vcf] if vcf in failures else 'OK'}")
+        if failures:
+            sys.exit(1)
     elif p_args.action == ACTION_ARG_JOIN:
-        print(p_args.sep.join(p_args.args), end="")
+        with contextlib.ExitStack() as stack:
+            items: Iterable[str] = p_args.args
+            if p_args.items_from:
+                items = itertools.chain(items, _iter_file_list(stack.enter_context(_open_file_list(p_args.items_from))))
+            out = stack.enter_context(open(p_args.output, "w")) if p_args.output else sys.stdout
+            _write_joined(items, p_args.sep, out)
     elif p_args.action == ACTION_PARALLEL_MERGESTR:
+        vcfs = _vcfs_with_list(parser, p_args)
+        from .parallel_mergestr import parallel_mergestr
         # leave intermediate_prefix default
         parallel_mergestr(
-            p_args.vcfs,
+            vcfs,
             p_args.out,
             p_args.vcftype,
             p_args.ntasks,
             p_args.step1_only,
             p_args.step2_only,
+            fan_in=p_args.fan_in,
+            shard=p_args.shard,
+            shard_size=p_args.shard_size,
+            resume=not p_args.no_resume,
+            tmp_dir=p_args.tmp_dir,
+            stream_intermediates=p_args.stream_intermediates,
+            engine=p_args.engine,
+            max_mem=p_args.max_mem,
         )
+    elif p_args.action == ACTION_PLAN_MERGESTR:
+        vcfs = _vcfs_with_list(parser, p_args)
+        from .parallel_mergestr import plan_mergestr
+        plan_mergestr(
+            vcfs,
+            p_args.out,
+            p_args.plan,
+            p_args.vcftype,
+            p_args.ntasks,
+            fan_in=p_args.fan_in,
+            shard=p_args.shard,
+            shard_size=p_args.shard_size,
+            tmp_dir=p_args.tmp_dir,
+            stream_intermediates=p_args.stream_intermediates,
+            engine=p_args.engine,
+        )
+    elif p_args.action == ACTION_RUN_MERGE_PLAN:
+        if (p_args.level is None) != (p_args.index is None):
+            parser.error("run-merge-plan: --level and --index must be given together")
+        from .parallel_mergestr import run_merge_plan, run_merge_plan_node
+        if p_args.node is not None or p_args.level is not None:
+            run_merge_plan_node(p_args.plan, node_id=p_args.node, level=p_args.level, index=p_args.index)
+        else:
+            run_merge_plan(p_args.plan, p_args.ntasks, max_mem=p_args.max_mem, resume=not p_args.no_resume)
     elif p_args.action == ACTION_FILTER_GFF3:
+        from .filter_gff3 import filter_gff3
         filter_gff3(
             p_args.file,
             getattr(p_args, "seqid", None),
@@ -157,7 +508,77 @@ def main(args: Optional[List[str]] = None):
             getattr(p_args, "strand", None),
             getattr(p_args, "phase", None),
             no_body_comments=p_args.no_body_comments,
+            region=p_args.region,
+            attributes=p_args.attr,
+            expression=p_args.expr,
+            ntasks=p_args.ntasks,
+            output=p_args.output,
+            index=p_args.index,
+            tmp_dir=p_args.tmp_dir,
+            sort_mem=p_args.sort_mem,
         )
+    elif p_args.action == ACTION_INDEX_GFF3:
+        from .gff3_index import index_gff3
+        index_gff3(p_args.file, index_path=p_args.index_path)
+    elif p_args.action == ACTION_QUERY_GFF3:
+        from .gff3_index import query_gff3
+        query_gff3(
+            p_args.file,
+            feature_id=p_args.id,
+            region=p_args.region,
+            descendants=not p_args.no_descendants,
+            index_path=p_args.index_path,
+        )
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="A set of variant file helper utilities built on top of bcftools and htslib.")
+    parser.add_argument(
+        "--metrics-json",
+        type=str,
+        default=None,
+        help="Write per-stage and per-process timing and resource use (wall/CPU time, peak memory, bytes read and "
+             "written) for the run to this JSON file.")
+    subparsers = parser.add_subparsers(
+        dest="action",
+        title="action",
+        help="The action to run. Each action has its own set of arguments.",
+        required=True)
+
+    _add_cci_parser(subparsers)
+    _add_ahl_parser(subparsers)
+    _add_aj_parser(subparsers)
+    _add_pms_parser(subparsers)
+    _add_plan_parser(subparsers)
+    _add_rmp_parser(subparsers)
+    _add_fg3_parser(subparsers)
+    _add_ig3_parser(subparsers)
+    _add_qg3_parser(subparsers)
+
+    p_args = parser.parse_args(args or sys.argv[1:])
+
+    if p_args.metrics_json is None:
+        _run_action(parser, p_args)
+        return
+
+    from . import metrics
+
+    status, error = "ok", None
+    with metrics.collect() as collector:
+        try:
+            with metrics.stage(p_args.action):
+                _run_action(parser, p_args)
+        except SystemExit as e:
+            if e.code:
+                status, error = "error", f"exited with status {e.code}"
+            raise
+        except BaseException as e:
+            status, error = "error", f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            collector.write_json(
+                p_args.metrics_json, command=p_args.action, argv=args or sys.argv[1:], status=status, error=error)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,10 @@
+from typing import Dict
+
 __all__ = [
     "BCFExtrasInputError",
     "BCFExtrasDependencyError",
+    "BCFExtrasBatchError",
+    "BCFExtrasProcessError",
 ]
 
 
@@ -10,3 +14,13 @@ class BCFExtrasInputError(Exception):
 
 class BCFExtrasDependencyError(Exception):
     pass
+
+
+class BCFExtrasBatchError(Exception):
+    def __init__(self, message: str, failures: Dict[str, str]):
+        super().__init__(message)
+        self.failures = failures  # Maps each failed input file to the error it produced
+
+
+class BCFExtrasProcessError(Exception):
+    pass
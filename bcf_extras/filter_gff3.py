@@ -1,54 +1,461 @@
+import contextlib
+import gzip
+import heapq
+import itertools
+import multiprocessing
+import os
 import re
+import shutil
+import subprocess
 import sys
-from typing import Optional
+import tempfile
+from typing import BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple
+
+from . import metrics
+from .bgzf import BGZFWriter, TabixIndexBuilder, is_gzipped
+from .exceptions import BCFExtrasInputError
+from .gff3_expr import compile_filter
 
 __all__ = [
+    "parse_region",
     "filter_gff3",
 ]
 
 
+_TABIX_MAX_REGIONS = 1000  # Regions per tabix call, to stay well clear of command line length limits
+
+_READ_SIZE = 4 * 1024 * 1024  # Roughly how much is read (and written) at once when filtering in-process
+_CHUNK_SIZE = 32 * 1024 * 1024  # Size of the chunks of uncompressed files which are handed off to worker processes
+
+_SORT_MEM = 512 * 1024 * 1024  # Default memory budget for records held in memory when sorting output
+_SORT_RECORD_OVERHEAD = 128  # Rough per-record memory use on top of the line itself, for the sort budget
+_SORT_MAX_RUNS = 128  # Maximum number of sorted runs merged at once (each one is an open file)
+
+# (header/leading comments, filtered lines, whether any record was seen) for a batch of lines
+_FilteredBatch = Tuple[bytes, bytes, bool]
+
+
 def _compile_if_not_none(pattern: Optional[str]) -> Optional[re.Pattern]:
     # I wish for monads
     return re.compile(pattern) if pattern is not None else None
 
 
-def filter_gff3(gff_file: str, seq_id: Optional[str], source: Optional[str], feature_type: Optional[str],
-                strand: Optional[str], phase: Optional[str], no_body_comments: bool = False):
-    # TODO: Add support for reading from bgzip file
-    # TODO: Add support for querying scalar values
-    # TODO: Add support for attribute querying
+def parse_region(region: str) -> Tuple[str, int, Optional[int]]:
+    # Parses tabix-style regions: chr, chr:start or chr:start-end (1-based, inclusive)
+    m = re.fullmatch(r"(.+?)(?::(\d+)(?:-(\d+))?)?", region.replace(",", ""))
+    if m is None:
+        raise BCFExtrasInputError(f"filter_gff3: Invalid region: {region}")
+    chrom, start, end = m.groups()
+    start = int(start) if start is not None else 1
+    end = int(end) if end is not None else None
+    if end is not None and end < start:
+        raise BCFExtrasInputError(f"filter_gff3: Region end is before its start: {region}")
+    return chrom, start, end
 
-    seq_id = _compile_if_not_none(seq_id)
-    source = _compile_if_not_none(source)
-    feature_type = _compile_if_not_none(feature_type)
-    strand = _compile_if_not_none(strand)
-    phase = _compile_if_not_none(phase)
 
-    done_header = False
+def _parse_attribute_filter(attr: str) -> Tuple[str, Optional[str]]:
+    # KEY=REGEX matches the value of an attribute; a bare KEY only requires the attribute to be present
+    key, sep, pattern = attr.partition("=")
+    if not key:
+        raise BCFExtrasInputError(f"filter_gff3: Invalid attribute filter: {attr}")
+    return key, pattern if sep else None
+
+
+def _open_gff3(gff_file: str) -> BinaryIO:
+    return gzip.open(gff_file, "rb") if is_gzipped(gff_file) else open(gff_file, "rb")
+
 
-    with open(gff_file, "r") as gf:
+def _has_index(gff_file: str) -> bool:
+    return shutil.which("tabix") is not None and (
+        os.path.exists(f"{gff_file}.tbi") or os.path.exists(f"{gff_file}.csi"))
+
+
+def _index_regions(gff_file: str, seq_id: Optional[re.Pattern], region: Optional[Tuple[str, int, Optional[int]]]):
+    """
+    Works out which regions to fetch from a tabix-indexed GFF3 file: the --region, if given, or otherwise every
+    contig in the index which the seqid filter matches.
+    """
+
+    contigs = metrics.check_output(["tabix", "-l", gff_file]).decode("utf-8").split()
+
+    if region is not None:
+        chrom, start, end = region
+        if chrom not in contigs or (seq_id is not None and not seq_id.match(chrom)):
+            return []
+        return [f"{chrom}:{start}-{end}" if end is not None else f"{chrom}:{start}"]
+
+    return [c for c in contigs if seq_id.match(c)]
+
+
+def _read_header(gff_file: str) -> List[bytes]:
+    header = []
+    with _open_gff3(gff_file) as gf:
         for line in gf:
-            if not line.strip() or line[0] == "#":
-                if not (done_header and no_body_comments):
-                    sys.stdout.write(line)
+            if line.strip() and line[:1] != b"#":
+                break
+            header.append(line)
+    return header
+
+
+def _fetch_regions(gff_file: str, regions: List[str]) -> Iterable[bytes]:
+    # tabix seeks straight to the blocks overlapping each region, so only matching parts of the file get read
+    for i in range(0, len(regions), _TABIX_MAX_REGIONS):
+        proc = metrics.popen(["tabix", gff_file, *regions[i:i+_TABIX_MAX_REGIONS]], stdout=subprocess.PIPE)
+        try:
+            yield from proc.stdout
+        finally:
+            proc.stdout.close()
+            ret = metrics.wait(proc)
+        if ret != 0:
+            raise subprocess.CalledProcessError(ret, proc.args)
+
+
+def _batches(lines: Iterable[bytes], size: int = 65536) -> Iterable[List[bytes]]:
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _InvalidRecord(Exception):
+    # A record the filter couldn't be evaluated on, found at position index in the batch of lines being filtered
+
+    def __init__(self, index: int, record: bytes, reason: str):
+        super().__init__(index, record, reason)
+        self.index = index
+        self.record = record
+        self.reason = reason
+
+    def error(self, first_line: Optional[int]) -> BCFExtrasInputError:
+        # Lines fetched through an index don't have a known line number in the file
+        where = f" on line {first_line + self.index}" if first_line is not None else ""
+        record = self.record.rstrip(b"\r\n").decode("utf-8", errors="replace")
+        return BCFExtrasInputError(f"filter_gff3: Invalid record{where} ({self.reason}): {record}")
+
+
+def _filter_lines(lines: List[bytes], predicate: Optional[Callable[[bytes], bool]],
+                  no_body_comments: bool) -> _FilteredBatch:
+    """
+    Filters a batch of lines. Since a batch doesn't know whether a record came before it (and so whether any leading
+    comments are part of the header or the body), comments before its first record are returned separately.
+    Records with malformed columns which the filter needs raise _InvalidRecord.
+    """
+
+    leading = []
+    out = []
+    has_record = False
+
+    try:
+        for line in lines:
+            if not line.strip() or line[:1] == b"#":
+                if not has_record:
+                    leading.append(line)
+                elif not no_body_comments:
+                    out.append(line)
                 continue
 
-            done_header = True
+            has_record = True
+
+            if predicate is None or predicate(line):
+                out.append(line)
+    except (ValueError, IndexError) as e:
+        # Only the predicate can fail. An earlier copy of the same line would have failed first, so index() finds it
+        raise _InvalidRecord(lines.index(line), line, str(e))
+
+    return b"".join(leading), b"".join(out), has_record
+
+
+def _filter_batches(batches: Iterable[List[bytes]], predicate: Optional[Callable[[bytes], bool]],
+                    no_body_comments: bool, first_line: Optional[int] = 1) -> Iterable[_FilteredBatch]:
+    # first_line is the line number of the first line of the first batch, or None if it isn't known
+    for batch in batches:
+        try:
+            filtered = _filter_lines(batch, predicate, no_body_comments)
+        except _InvalidRecord as e:
+            raise e.error(first_line) from None
+        yield filtered
+        if first_line is not None:
+            first_line += len(batch)
+
+
+def _count_lines(gff_file: str, end: int) -> int:
+    # Number of lines in the first end bytes of an uncompressed file
+    count = 0
+    with open(gff_file, "rb") as gf:
+        while gf.tell() < end:
+            count += gf.read(min(_READ_SIZE, end - gf.tell())).count(b"\n")
+    return count
+
+
+def _write_batches(batches: Iterable[_FilteredBatch], out: BinaryIO, no_body_comments: bool):
+    done_header = False
+    for leading, filtered, has_record in batches:
+        if not (done_header and no_body_comments):
+            out.write(leading)
+        out.write(filtered)
+        done_header = done_header or has_record
+
+
+def _chunk_offsets(gff_file: str, chunk_size: int) -> List[Tuple[int, int]]:
+    # Splits a file into (start, end) byte ranges of around chunk_size, each ending right after a newline
+    size = os.path.getsize(gff_file)
+    offsets = [0]
+    with open(gff_file, "rb") as gf:
+        while offsets[-1] + chunk_size < size:
+            gf.seek(offsets[-1] + chunk_size)
+            gf.readline()
+            if gf.tell() >= size:
+                break
+            offsets.append(gf.tell())
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def _open_output(path: str):
+    return BGZFWriter(path) if path.endswith((".gz", ".bgz")) else open(path, "wb")
+
+
+_SortKey = Tuple[int, int, int]  # (contig rank, start, end)
+
+
+class _SortedGFF3Writer:
+    """
+    Writes records to a bgzipped, tabix-indexed GFF3 file, building the index as it goes. Records are written
+    straight to the output for as long as they arrive sorted (each contig's records together, in order of start
+    position.) If a record turns up out of order, it and everything after it are sorted in runs of bounded size,
+    spilled to disk, and merged with what was already written at the end. Contigs keep the order in which they first
+    appear.
+    """
+
+    def __init__(self, path: str, header: bytes, tmp_dir: Optional[str], sort_mem: int):
+        self._path = path
+        self._header = header
+        self._tmp_dir = tmp_dir
+        self._sort_mem = sort_mem
+
+        self._contigs: Dict[bytes, int] = {}
+        self._last = (0, 0)
+
+        self._writer = BGZFWriter(path)
+        self._writer.write(header)
+        self._index = TabixIndexBuilder()
+        self._in_order = True
+
+        self._tmp: Optional[tempfile.TemporaryDirectory] = None
+        self._runs: List[str] = []
+        self._n_runs = 0
+        self._buffer: List[Tuple[_SortKey, bytes]] = []
+        self._buffered = 0
+
+    def _key(self, line: bytes) -> _SortKey:
+        fields = line.split(b"\t", 5)
+        try:
+            return self._contigs.setdefault(fields[0], len(self._contigs)), int(fields[3]), int(fields[4])
+        except (IndexError, ValueError):
+            raise BCFExtrasInputError(f"filter_gff3: Invalid GFF3 record: {line.decode(errors='replace')}")
+
+    def _write(self, writer: BGZFWriter, index: TabixIndexBuilder, line: bytes, key: _SortKey):
+        start = writer.tell()
+        writer.write(line)
+        index.add(line[:line.index(b"\t")], key[1] - 1, key[2], start, writer.tell())
+
+    def write_records(self, lines: Iterable[bytes]):
+        for line in lines:
+            if not line.endswith(b"\n"):
+                line += b"\n"
+            key = self._key(line)
+
+            if self._in_order:
+                if key[:2] >= self._last:
+                    self._last = key[:2]
+                    self._write(self._writer, self._index, line, key)
+                    continue
+                # Everything up to here is sorted, and becomes the first run of the merge at the end
+                self._in_order = False
+                self._writer.close()
+
+            self._buffer.append((key, line))
+            self._buffered += len(line) + _SORT_RECORD_OVERHEAD
+            if self._buffered >= self._sort_mem:
+                self._spill()
+
+    def _write_run(self, records: Iterable[Tuple[_SortKey, bytes]]):
+        if self._tmp is None:
+            self._tmp = tempfile.TemporaryDirectory(dir=self._tmp_dir)
+        run = os.path.join(self._tmp.name, f"run{self._n_runs}")
+        self._n_runs += 1
+        with open(run, "wb") as rf:
+            rf.writelines(line for _, line in records)
+        self._runs.append(run)
+
+    def _spill(self):
+        with metrics.stage("sort_spill", records=len(self._buffer)):
+            self._buffer.sort(key=lambda r: r[0][:2])
+            self._write_run(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        if len(self._runs) >= _SORT_MAX_RUNS:
+            # Merge what's been spilled so far into a single run, so the final merge doesn't open too many files
+            runs, self._runs = self._runs, []
+            with contextlib.ExitStack() as stack, metrics.stage("sort_merge_runs", runs=len(runs)):
+                self._write_run(self._merge([stack.enter_context(open(r, "rb")) for r in runs]))
+            for r in runs:
+                os.remove(r)
+
+    def _merge(self, runs: list) -> Iterable[Tuple[_SortKey, bytes]]:
+        # heapq.merge is stable, so records with the same position stay in the order they were read in
+        return heapq.merge(*(((self._key(line), line) for line in run) for run in runs), key=lambda r: r[0][:2])
+
+    def close(self):
+        if self._in_order:
+            self._writer.close()
+            with metrics.stage("write_index"):
+                self._index.write(f"{self._path}.tbi")
+            return
+
+        self._buffer.sort(key=lambda r: r[0][:2])
+        index = TabixIndexBuilder()
+        merged_path = f"{self._path}.sorting"
+
+        with contextlib.ExitStack() as stack, metrics.stage("sort_merge", runs=len(self._runs) + 2):
+            written = stack.enter_context(gzip.open(self._path, "rb"))
+            written.read(len(self._header))
+            runs = [written, *(stack.enter_context(open(r, "rb")) for r in self._runs)]
+            records = heapq.merge(self._merge(runs), self._buffer, key=lambda r: r[0][:2])
+
+            with BGZFWriter(merged_path) as writer:
+                writer.write(self._header)
+                for key, line in records:
+                    self._write(writer, index, line, key)
+
+        os.replace(merged_path, self._path)
+        with metrics.stage("write_index"):
+            index.write(f"{self._path}.tbi")
+
+    def cleanup(self):
+        self._writer.close()
+        if self._tmp is not None:
+            self._tmp.cleanup()
+
+
+def _write_sorted(batches: Iterable[_FilteredBatch], path: str, tmp_dir: Optional[str], sort_mem: int):
+    batches = iter(batches)
+
+    header = []
+    first = b""
+    for leading, filtered, has_record in batches:
+        header.append(leading)
+        if has_record:
+            first = filtered
+            break
+
+    sw = _SortedGFF3Writer(path, b"".join(header), tmp_dir, sort_mem)
+    try:
+        sw.write_records(first.splitlines(keepends=True))
+        for _, filtered, _ in batches:
+            sw.write_records(filtered.splitlines(keepends=True))
+        sw.close()
+    finally:
+        sw.cleanup()
+
+
+_worker_predicate: Optional[Callable[[bytes], bool]] = None
+
+
+def _init_worker(filter_args: dict):
+    # Compiled predicates can't be pickled, so each worker compiles its own copy
+    global _worker_predicate
+    _worker_predicate = compile_filter(**filter_args, binary=True)
+
+
+def _filter_chunk(chunk: Tuple[str, int, int, bool]) -> _FilteredBatch:
+    gff_file, start, end, no_body_comments = chunk
+    with metrics.stage("filter_chunk", start=start, end=end):
+        with open(gff_file, "rb") as gf:
+            gf.seek(start)
+            data = gf.read(end - start)
+        try:
+            return _filter_lines(data.splitlines(keepends=True), _worker_predicate, no_body_comments)
+        except _InvalidRecord as e:
+            # Only count the lines before the chunk if there's a problem, since it means reading the file up to it
+            raise e.error(_count_lines(gff_file, start) + 1) from None
+
+
+def filter_gff3(gff_file: str, seq_id: Optional[str], source: Optional[str], feature_type: Optional[str],
+                strand: Optional[str], phase: Optional[str], no_body_comments: bool = False,
+                region: Optional[str] = None, attributes: Optional[List[str]] = None,
+                expression: Optional[str] = None, ntasks: int = 1, output: Optional[str] = None,
+                index: bool = False, tmp_dir: Optional[str] = None, sort_mem: int = _SORT_MEM):
+    """
+    Filters a GFF3 file, writing the header and any matching records to stdout or an output file (bgzipped if its
+    name ends in .gz.) All filters are compiled into a single function which works on bytes, and output is written in
+    large batches. Uncompressed files can be split into chunks which are filtered in ntasks worker processes, with
+    output still in the same order as the input.
+    With index, output is also sorted and tabix-indexed in the same pass; body comments are left out, and records
+    are only sorted (externally, holding at most around sort_mem bytes of them in memory) if they arrive out of order.
+    """
+
+    if ntasks < 1:
+        raise BCFExtrasInputError("filter_gff3: ntasks must be at least 1")
+    if index and (output is None or not output.endswith((".gz", ".bgz"))):
+        raise BCFExtrasInputError("filter_gff3: Indexed output must be written to a bgzipped file (ending in .gz)")
+    if sort_mem < 1:
+        raise BCFExtrasInputError("filter_gff3: sort_mem must be at least 1")
+
+    no_body_comments = no_body_comments or index
+
+    columns: Dict[str, str] = {
+        name: pattern
+        for name, pattern in (
+            ("seqid", seq_id), ("source", source), ("type", feature_type), ("strand", strand), ("phase", phase))
+        if pattern is not None
+    }
+    filter_args = dict(
+        expression=expression,
+        columns=columns,
+        region=parse_region(region) if region is not None else None,
+        attributes=[_parse_attribute_filter(a) for a in attributes or ()],
+    )
+    predicate = compile_filter(**filter_args, binary=True)
+
+    with contextlib.ExitStack() as stack:
+        mode = "sequential"
+        if (seq_id is not None or region is not None) and _has_index(gff_file):
+            # With an index, only the header and the matching contigs/region need to be read. Comments in the body of
+            # the file are not part of the index, so they are left out.
+            lines = _fetch_regions(
+                gff_file, _index_regions(gff_file, _compile_if_not_none(seq_id), filter_args["region"]))
+            batches = itertools.chain(
+                [(b"".join(_read_header(gff_file)), b"", False)],
+                _filter_batches(_batches(lines), predicate, no_body_comments, first_line=None))
+            mode = "indexed"
 
-            l_split = line.strip().split("\t")
+        elif ntasks > 1 and not is_gzipped(gff_file) and os.path.getsize(gff_file) > _CHUNK_SIZE:
+            chunks = [
+                (gff_file, start, end, no_body_comments) for start, end in _chunk_offsets(gff_file, _CHUNK_SIZE)]
+            p = stack.enter_context(multiprocessing.Pool(ntasks, initializer=_init_worker, initargs=(filter_args,)))
+            # imap keeps results in input order, and lets output be written while later chunks are still running
+            batches = map(metrics.unwrap, p.imap(metrics.wrap(_filter_chunk), chunks))
+            mode = "parallel"
 
-            res = True
+        else:
+            gf = stack.enter_context(_open_gff3(gff_file))
+            batches = _filter_batches(iter(lambda: gf.readlines(_READ_SIZE), []), predicate, no_body_comments)
 
-            if seq_id is not None:
-                res = res and bool(seq_id.match(l_split[0]))
-            if source is not None:
-                res = res and bool(source.match(l_split[1]))
-            if feature_type is not None:
-                res = res and bool(feature_type.match(l_split[2]))
-            if strand is not None:
-                res = res and bool(strand.match(l_split[6]))
-            if phase is not None:
-                res = res and bool(phase.match(l_split[7]))
+        # Reading, filtering and writing are interleaved, so they are measured together
+        stack.enter_context(metrics.stage("filter", mode=mode, output=output, sorted_index=index))
 
-            if res:
-                sys.stdout.write(line)
+        if index:
+            _write_sorted(batches, output, tmp_dir, sort_mem)
+        elif output is not None:
+            with _open_output(output) as out:
+                _write_batches(batches, out, no_body_comments)
+        else:
+            sys.stdout.flush()
+            _write_batches(batches, sys.stdout.buffer, no_body_comments)
+            sys.stdout.buffer.flush()
@@ -0,0 +1,422 @@
+import math
+import re
+
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+from .exceptions import BCFExtrasInputError
+
+__all__ = [
+    "attribute_value",
+    "compile_filter",
+]
+
+
+# Column name: (index, type)
+_COLUMNS = {
+    "seqid": (0, "str"),
+    "source": (1, "str"),
+    "type": (2, "str"),
+    "start": (3, "int"),
+    "end": (4, "int"),
+    "score": (5, "float"),
+    "strand": (6, "str"),
+    "phase": (7, "str"),
+}
+_ATTRIBUTES_COLUMN = 8
+
+_COMPARISONS = ("==", "!=", "<=", ">=", "<", ">")
+_MATCHES = ("~", "!~")
+
+_TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<num>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+   |(?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+   |(?P<op>==|!=|<=|>=|!~|~|<|>|\+|-|\*|/|\(|\))
+   |(?P<name>attr\.[^\s()=!<>~]+|[A-Za-z_]\w*)
+)""", re.VERBOSE)
+
+_KEYWORDS = ("and", "or", "not")
+
+
+def _tokenize(expression: str) -> List[Tuple[str, str]]:
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        m = _TOKEN_RE.match(expression, pos)
+        if m is None:
+            raise BCFExtrasInputError(f"filter expression: Unexpected input at position {pos}: {expression[pos:]}")
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "name" and value in _KEYWORDS:
+            kind = "op"
+        tokens.append((kind, value))
+        pos = m.end()
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent parser for filter expressions, producing a tree of tuples: (kind, type, ...children.)
+    Value types are "int", "float", "str", "attr" (a string which may be missing) or "bool" (a condition.)
+    """
+
+    def __init__(self, expression: str):
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _accept(self, *ops: str):
+        kind, value = self._peek()
+        if kind == "op" and value in ops:
+            self.pos += 1
+            return value
+        return None
+
+    def _expect(self, op: str):
+        if self._accept(op) is None:
+            raise BCFExtrasInputError(f"filter expression: Expected '{op}', found {self._peek()[1] or 'end of input'}")
+
+    def parse(self):
+        node = self._or()
+        if self.pos != len(self.tokens):
+            raise BCFExtrasInputError(f"filter expression: Unexpected '{self._peek()[1]}'")
+        return _as_condition(node)
+
+    def _or(self):
+        operands = [self._and()]
+        while self._accept("or"):
+            operands.append(self._and())
+        return ("or", "bool", *map(_as_condition, operands)) if len(operands) > 1 else operands[0]
+
+    def _and(self):
+        operands = [self._not()]
+        while self._accept("and"):
+            operands.append(self._not())
+        return ("and", "bool", *map(_as_condition, operands)) if len(operands) > 1 else operands[0]
+
+    def _not(self):
+        if self._accept("not"):
+            return "not", "bool", _as_condition(self._not())
+        return self._comparison()
+
+    def _comparison(self):
+        left = self._sum()
+
+        op = self._accept(*_MATCHES)
+        if op is not None:
+            kind, value = self._peek()
+            if kind != "str":
+                raise BCFExtrasInputError(f"filter expression: '{op}' must be followed by a quoted regular expression")
+            self.pos += 1
+            if left[1] not in ("str", "attr"):
+                raise BCFExtrasInputError("filter expression: Cannot match a number against a regular expression")
+            return _match(left, _unquote(value), negate=op == "!~")
+
+        op = self._accept(*_COMPARISONS)
+        if op is not None:
+            right = self._sum()
+            return _comparison(op, left, right)
+
+        return left
+
+    def _sum(self):
+        node = self._product()
+        while True:
+            op = self._accept("+", "-")
+            if op is None:
+                return node
+            node = _arithmetic(op, node, self._product())
+
+    def _product(self):
+        node = self._unary()
+        while True:
+            op = self._accept("*", "/")
+            if op is None:
+                return node
+            node = _arithmetic(op, node, self._unary())
+
+    def _unary(self):
+        if self._accept("-"):
+            return _arithmetic("-", ("num", "int", 0), self._unary())
+
+        if self._accept("("):
+            node = self._or()
+            self._expect(")")
+            return node
+
+        kind, value = self._peek()
+        self.pos += 1
+
+        if kind == "num":
+            return ("num", "float", float(value)) if any(ch in value for ch in ".eE") else ("num", "int", int(value))
+        if kind == "str":
+            return "str", "str", _unquote(value)
+        if kind == "name" and value.startswith("attr."):
+            return "attr", "attr", value[5:]
+        if kind == "name" and value in _COLUMNS:
+            return "col", _COLUMNS[value][1], value
+
+        raise BCFExtrasInputError(f"filter expression: Unexpected {repr(value) if value else 'end of input'}")
+
+
+def _unquote(literal: str) -> str:
+    return re.sub(r"\\(.)", r"\1", literal[1:-1])
+
+
+def _match(left, pattern: str, negate: bool = False, anchored: bool = False):
+    # Patterns are kept as strings, since they get compiled differently for str and bytes predicates
+    try:
+        re.compile(pattern)
+    except re.error as e:
+        raise BCFExtrasInputError(f"filter expression: Invalid regular expression {pattern!r}: {e}")
+    return "match", "bool", left, pattern, negate, anchored
+
+
+def _is_numeric(node) -> bool:
+    return node[1] in ("int", "float")
+
+
+def _as_condition(node):
+    if node[1] == "bool":
+        return node
+    if node[0] == "attr":
+        return "exists", "bool", node  # A bare attribute is true if it is present
+    raise BCFExtrasInputError(f"filter expression: Expected a condition, found a value ({node[0]} {node[2]})")
+
+
+def _arithmetic(op: str, left, right):
+    if not (_is_numeric(left) or left[0] == "attr") or not (_is_numeric(right) or right[0] == "attr"):
+        raise BCFExtrasInputError(f"filter expression: '{op}' can only be used with numbers")
+    result_type = "int" if left[1] == right[1] == "int" and op != "/" else "float"
+    return "arith", result_type, op, left, right
+
+
+def _comparison(op: str, left, right):
+    if left[1] == "bool" or right[1] == "bool":
+        raise BCFExtrasInputError(f"filter expression: Cannot compare conditions with '{op}'")
+
+    numeric = _is_numeric(left) or _is_numeric(right)
+    if numeric and (left[1] == "str" or right[1] == "str"):
+        raise BCFExtrasInputError(f"filter expression: Cannot compare a number and a string with '{op}'")
+    if not numeric and op not in ("==", "!="):
+        raise BCFExtrasInputError("filter expression: Strings can only be compared with == or !=")
+
+    return "cmp", "bool", op, left, right, numeric
+
+
+def _cost(node) -> int:
+    # Rough relative cost of evaluating a node, used to put cheap checks first in and/or chains
+    kind = node[0]
+    if kind in ("num", "str"):
+        return 0
+    if kind == "col":
+        return {"str": 1, "int": 2, "float": 3}[node[1]]
+    if kind == "attr":
+        return 10
+    if kind in ("exists", "not"):
+        return _cost(node[2])
+    if kind == "match":
+        return _cost(node[2]) + 5
+    if kind in ("cmp", "arith"):
+        return _cost(node[3]) + _cost(node[4]) + 1
+    return sum(_cost(n) for n in node[2:])  # and/or
+
+
+def _score(value: str) -> float:
+    return math.nan if value == "." else float(value)
+
+
+def _score_bytes(value: bytes) -> float:
+    return math.nan if value == b"." else float(value)
+
+
+def attribute_value(attributes: str, key: str) -> Optional[str]:
+    """
+    Finds the value of a single attribute in a GFF3 attribute column, without splitting up the rest of the column.
+    Values are unescaped, but multiple (comma-separated) values are returned as-is.
+    """
+
+    prefix = f"{key}="
+    pos = attributes.find(prefix)
+    while pos != -1:
+        if pos == 0 or attributes[pos - 1] in "; ":  # Make sure we didn't find the end of a different key
+            start = pos + len(prefix)
+            end = attributes.find(";", start)
+            value = attributes[start:end] if end != -1 else attributes[start:]
+            return unquote(value) if "%" in value else value
+        pos = attributes.find(prefix, pos + 1)
+    return None
+
+
+def _attr_num(attributes: str, key: str) -> float:
+    value = attribute_value(attributes, key)
+    try:
+        return float(value) if value is not None else math.nan
+    except ValueError:
+        return math.nan
+
+
+def _attr_bytes(attributes: bytes, key: str) -> Optional[bytes]:
+    value = attribute_value(attributes.decode("utf-8"), key)
+    return value.encode("utf-8") if value is not None else None
+
+
+def _attr_num_bytes(attributes: bytes, key: str) -> float:
+    return _attr_num(attributes.decode("utf-8"), key)
+
+
+def _div(left: float, right: float) -> float:
+    # Dividing by zero gives nan, like a missing value, instead of failing the whole filter
+    return left / right if right else math.nan
+
+
+def _search(pattern, value) -> bool:
+    return value is not None and pattern.search(value) is not None
+
+
+def _match_start(pattern, value) -> bool:
+    return value is not None and pattern.match(value) is not None
+
+
+class _CodeGenerator:
+    def __init__(self, binary: bool):
+        self.binary = binary
+        self.constants = {}
+        self.max_column = -1
+
+    def _constant(self, value) -> str:
+        name = f"_k{len(self.constants)}"
+        self.constants[name] = value
+        return name
+
+    def _column(self, idx: int) -> str:
+        self.max_column = max(self.max_column, idx)
+        return f"c[{idx}]"
+
+    def value(self, node, numeric: bool = False) -> str:
+        kind = node[0]
+
+        if kind == "num":
+            return repr(node[2])
+        if kind == "str":
+            return repr(node[2].encode("utf-8") if self.binary else node[2])
+        if kind == "col":
+            idx, col_type = _COLUMNS[node[2]]
+            col = self._column(idx)
+            return {"str": col, "int": f"int({col})", "float": f"_score({col})"}[col_type]
+        if kind == "attr":
+            attrs = self._column(_ATTRIBUTES_COLUMN)
+            return f"_attr{'_num' if numeric else ''}({attrs}, {node[2]!r})"
+        if kind == "arith":
+            _, _, op, left, right = node
+            if op == "/":
+                return f"_div({self.value(left, True)}, {self.value(right, True)})"
+            return f"({self.value(left, True)} {op} {self.value(right, True)})"
+
+        return self.condition(node)
+
+    def condition(self, node) -> str:
+        kind = node[0]
+
+        if kind in ("and", "or"):
+            # Cheapest checks first, so the more expensive ones are skipped as often as possible
+            operands = []
+            for n in node[2:]:
+                operands.extend(n[2:] if n[0] == kind else (n,))
+            operands.sort(key=_cost)
+            return "(" + f" {kind} ".join(self.condition(n) for n in operands) + ")"
+        if kind == "not":
+            return f"(not {self.condition(node[2])})"
+        if kind == "exists":
+            return f"({self.value(node[2])} is not None)"
+        if kind == "match":
+            _, _, left, pattern, negate, anchored = node
+            value = self.value(left)
+            regex = self._constant(re.compile(pattern.encode("utf-8") if self.binary else pattern))
+            method = "match" if anchored else "search"
+            check = (f"_{'match_start' if anchored else 'search'}({regex}, {value})" if left[0] == "attr"
+                     else f"({regex}.{method}({value}) is not None)")
+            return f"(not {check})" if negate else check
+        if kind == "cmp":
+            _, _, op, left, right, numeric = node
+            return f"({self.value(left, numeric)} {op} {self.value(right, numeric)})"
+
+        raise BCFExtrasInputError("filter expression: Expected a condition")  # pragma: no cover
+
+
+def compile_filter(
+        expression: Optional[str] = None,
+        columns: Optional[Dict[str, str]] = None,
+        region: Optional[Tuple[str, int, Optional[int]]] = None,
+        attributes: Optional[List[Tuple[str, Optional[str]]]] = None,
+        binary: bool = False,
+) -> Optional[Callable]:
+    """
+    Compiles a filter expression over GFF3 columns into a single Python function, which takes a GFF3 record line
+    and returns whether it passes the filter. For example:
+        type ~ "^exon$" and end - start > 1000 and score >= 10
+    Columns are referred to by name (seqid, source, type, start, end, score, strand, phase) and attributes as
+    attr.KEY. Strings are compared with ==, != and regular expression searches (~, !~); numbers with the usual
+    comparison and arithmetic operators. Conditions are combined with and, or, not and parentheses.
+    A bare attribute is true if the attribute is present. A missing score (.), a missing/non-numeric attribute used
+    as a number or a division by zero never compares as equal, greater or less than anything. A malformed start, end
+    or score column makes the function raise ValueError (or IndexError, if the line has too few columns.)
+    The expression is checked once, up front; in and/or chains, cheaper checks are moved first, and lines are only
+    split up as far as the last column the expression needs.
+    filter-gff3's other filters can be compiled into the same function: regular expressions matched against the
+    start of columns (by name), a (seqid, start, end) region which features must overlap, and (key, regular
+    expression or None) attribute filters, None meaning the attribute only has to be present.
+    :param binary: Whether the function should take lines as bytes rather than str.
+    :return: The filter function, or None if there is nothing to filter on.
+    """
+
+    conditions = []
+
+    for name, pattern in (columns or {}).items():
+        conditions.append(_match(("col", "str", name), pattern, anchored=True))
+
+    if region is not None:
+        chrom, start, end = region
+        conditions.append(_comparison("==", ("col", "str", "seqid"), ("str", "str", chrom)))
+        conditions.append(_comparison(">=", ("col", "int", "end"), ("num", "int", start)))
+        if end is not None:
+            conditions.append(_comparison("<=", ("col", "int", "start"), ("num", "int", end)))
+
+    for key, pattern in attributes or ():
+        attr = ("attr", "attr", key)
+        conditions.append(_match(attr, pattern, anchored=True) if pattern is not None else _as_condition(attr))
+
+    if expression is not None:
+        conditions.append(_Parser(expression).parse())
+
+    if not conditions:
+        return None
+
+    gen = _CodeGenerator(binary)
+    body = gen.condition(("and", "bool", *conditions) if len(conditions) > 1 else conditions[0])
+
+    nl, tab = (r'b"\r\n"', r'b"\t"') if binary else (r'"\r\n"', r'"\t"')
+    if gen.max_column == _ATTRIBUTES_COLUMN:
+        split = f"line.rstrip({nl}).split({tab}, 9)"
+    else:
+        split = f"line.split({tab}, {gen.max_column + 1})"
+
+    source = f"def _predicate(line):\n    c = {split}\n    return {body}\n"
+
+    namespace = {
+        "_score": _score_bytes if binary else _score,
+        "_attr": _attr_bytes if binary else attribute_value,
+        "_attr_num": _attr_num_bytes if binary else _attr_num,
+        "_div": _div,
+        "_search": _search,
+        "_match_start": _match_start,
+        **gen.constants,
+    }
+    exec(compile(source, "<filter expression>", "exec"), namespace)
+
+    predicate = namespace["_predicate"]
+    predicate.source = source
+    return predicate
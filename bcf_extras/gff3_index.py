@@ -0,0 +1,494 @@
+import array
+import mmap
+import os
+import struct
+import sys
+
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.parse import unquote
+
+from . import metrics
+from .bgzf import is_bgzf, is_gzipped, read_block
+from .exceptions import BCFExtrasInputError
+from .filter_gff3 import parse_region
+
+__all__ = [
+    "GFF3Index",
+    "index_gff3",
+    "query_gff3",
+]
+
+
+INDEX_EXTENSION = ".gffidx"
+
+_MAGIC = b"BXGFFIDX"
+_VERSION = 1
+_BYTE_ORDER_MARK = 0x01020304
+_FLAG_BGZF = 1
+
+# Magic, byte order mark, version, flags, GFF3 file size, GFF3 file modification time (ns)
+_HEADER = struct.Struct("=8sIIIQQ")
+_SECTION = struct.Struct("=QQ")  # Offset, length in bytes
+
+_NO_ID = 0xffffffff
+
+# Every section of the index, in the order they're stored, with their array type codes (or None for raw bytes.)
+# All of them are laid out so they can be used straight from the memory-mapped file, without parsing.
+_SECTIONS = (
+    ("header", None),  # The GFF3 file's header lines
+    ("feature_offset", "Q"),  # Per feature (record line), in file order: byte or BGZF virtual offset of the line,
+    ("feature_length", "I"),  # its length,
+    ("feature_id", "I"),  # and the index of its ID in the sorted ID table, or _NO_ID
+    ("id_key_offset", "Q"),  # Sorted ID table: start of each ID in id_keys, plus the end of the last one
+    ("id_keys", None),
+    ("id_feature_start", "Q"),  # Per ID: range of id_features holding the features (lines) with that ID
+    ("id_features", "I"),
+    ("child_start", "Q"),  # Per ID: range of children holding the features with that ID as a Parent
+    ("children", "I"),
+    ("contig_key_offset", "Q"),  # Sorted contig table, as for IDs
+    ("contig_keys", None),
+    ("contig_start", "Q"),  # Per contig: range of the interval arrays below holding its features
+    ("iv_start", "Q"),  # Implicit interval trees (one per contig): features sorted by 0-based start,
+    ("iv_end", "Q"),  # their (exclusive) ends,
+    ("iv_max", "Q"),  # the maximum end in the subtree rooted at each element,
+    ("iv_feature", "I"),  # and the feature each interval belongs to
+)
+
+
+def _index_path(gff_file: str, index_path: Optional[str]) -> str:
+    return index_path if index_path is not None else f"{gff_file}{INDEX_EXTENSION}"
+
+
+def _file_stamp(gff_file: str) -> Tuple[int, int]:
+    st = os.stat(gff_file)
+    return st.st_size, st.st_mtime_ns
+
+
+def _bgzf_lines(fh: BinaryIO) -> Iterator[Tuple[int, bytes]]:
+    # Yields (virtual offset, line) for every line of a BGZF file
+    coffset = 0
+    partial = b""
+    partial_offset = 0
+    while True:
+        block = read_block(fh)
+        if block is None:
+            break
+        block_size, data = block
+        pos = 0
+        while pos < len(data):
+            end = data.find(b"\n", pos)
+            if end == -1:
+                if not partial:
+                    partial_offset = (coffset << 16) | pos
+                partial += data[pos:]
+                break
+            if partial:
+                yield partial_offset, partial + data[pos:end + 1]
+                partial = b""
+            else:
+                yield (coffset << 16) | pos, data[pos:end + 1]
+            pos = end + 1
+        coffset += block_size
+    if partial:
+        yield partial_offset, partial
+
+
+def _plain_lines(fh: BinaryIO) -> Iterator[Tuple[int, bytes]]:
+    offset = 0
+    for line in fh:
+        yield offset, line
+        offset += len(line)
+
+
+def _attributes(column: str) -> Dict[str, str]:
+    # Values stay escaped, so that escaped commas in multi-valued attributes (e.g. Parent) aren't split on
+    attributes = {}
+    for attr in column.strip().split(";"):
+        key, sep, value = attr.strip().partition("=")
+        if sep:
+            attributes[key] = value
+    return attributes
+
+
+def _build_interval_tree(starts: array.array, ends: array.array) -> array.array:
+    """
+    Computes the max-end augmentation for an implicit interval tree over intervals sorted by start (as in cgranges):
+    the tree is laid out in-order over the array itself, so elements at odd indices are the internal nodes.
+    """
+
+    n = len(starts)
+    maxes = array.array("Q", ends)
+    if n == 0:
+        return maxes
+
+    last_i = (n - 1) & ~1
+    last = maxes[last_i]
+    k = 1
+    while (1 << k) <= n:
+        x = 1 << (k - 1)
+        for i in range((x << 1) - 1, n, x << 2):
+            el = maxes[i - x]
+            er = maxes[i + x] if i + x < n else last
+            maxes[i] = max(ends[i], el, er)
+        last_i = last_i - x if (last_i >> k) & 1 else last_i + x
+        if last_i < n and maxes[last_i] > last:
+            last = maxes[last_i]
+        k += 1
+
+    return maxes
+
+
+def _sorted_table(keys: Iterable[str]) -> Tuple[List[str], array.array, bytes]:
+    keys = sorted(keys)
+    encoded = [k.encode("utf-8") for k in keys]
+    offsets = array.array("Q", [0])
+    for e in encoded:
+        offsets.append(offsets[-1] + len(e))
+    return keys, offsets, b"".join(encoded)
+
+
+def _csr(n: int, pairs: List[Tuple[int, int]]) -> Tuple[array.array, array.array]:
+    # Compressed sparse rows from (row, value) pairs; values stay in the order given within each row
+    counts = [0] * (n + 1)
+    for row, _ in pairs:
+        counts[row + 1] += 1
+    for i in range(n):
+        counts[i + 1] += counts[i]
+    starts = array.array("Q", counts)
+    values = array.array("I", bytes(4 * len(pairs)))
+    fill = counts[:-1]
+    for row, value in pairs:
+        values[fill[row]] = value
+        fill[row] += 1
+    return starts, values
+
+
+def index_gff3(gff_file: str, index_path: Optional[str] = None) -> str:
+    """
+    Builds a persistent index of a GFF3 file (plain or bgzipped) for fast, repeated queries: offsets of every
+    feature by ID, links from parents to their children, and an interval tree per contig. Returns the path of the
+    index, which defaults to the GFF3 file's path plus .gffidx.
+    """
+
+    bgzf = is_bgzf(gff_file)
+    if not bgzf and is_gzipped(gff_file):
+        raise BCFExtrasInputError(f"index_gff3: {gff_file} is gzipped, but not with bgzip; it cannot be indexed")
+
+    size, mtime = _file_stamp(gff_file)
+
+    header = []
+    offsets = array.array("Q")
+    lengths = array.array("I")
+    feature_ids: List[Optional[str]] = []
+    parent_links: List[Tuple[str, int]] = []
+    intervals: Dict[str, List[Tuple[int, int, int]]] = {}
+
+    with open(gff_file, "rb") as fh, metrics.stage("scan", file=gff_file):
+        for offset, line in (_bgzf_lines(fh) if bgzf else _plain_lines(fh)):
+            if line.startswith(b"##FASTA"):
+                break  # Everything after this is sequence, not features
+            if not line.strip() or line[:1] == b"#":
+                if not offsets:
+                    header.append(line)
+                continue
+
+            fields = line.rstrip(b"\r\n").decode("utf-8").split("\t")
+            if len(fields) != 9:
+                raise BCFExtrasInputError(f"index_gff3: Invalid GFF3 record: {line.decode('utf-8', 'replace')}")
+
+            feature = len(offsets)
+            offsets.append(offset)
+            lengths.append(len(line))
+
+            attributes = _attributes(fields[8])
+            feature_id = attributes.get("ID")
+            feature_ids.append(unquote(feature_id) if feature_id is not None else None)
+            parent_links.extend((unquote(p), feature) for p in attributes.get("Parent", "").split(",") if p)
+
+            try:
+                intervals.setdefault(fields[0], []).append((int(fields[3]) - 1, int(fields[4]), feature))
+            except ValueError:
+                raise BCFExtrasInputError(f"index_gff3: Invalid GFF3 record: {line.decode('utf-8', 'replace')}")
+
+    if len(offsets) >= _NO_ID:
+        raise BCFExtrasInputError(f"index_gff3: Too many features in {gff_file}")
+
+    with metrics.stage("build_tables", features=len(offsets)):
+        # IDs which are only ever referred to as a Parent are included, so their children can still be found
+        ids, id_key_offset, id_keys = _sorted_table(
+            {i for i in feature_ids if i is not None} | {p for p, _ in parent_links})
+        id_ranks = {k: i for i, k in enumerate(ids)}
+        feature_id = array.array("I", (id_ranks[i] if i is not None else _NO_ID for i in feature_ids))
+        id_feature_start, id_features = _csr(len(ids), [(r, f) for f, r in enumerate(feature_id) if r != _NO_ID])
+        child_start, children = _csr(len(ids), [(id_ranks[p], f) for p, f in parent_links])
+
+        contigs, contig_key_offset, contig_keys = _sorted_table(intervals)
+        contig_start = array.array("Q", [0])
+        iv_start, iv_end, iv_feature = array.array("Q"), array.array("Q"), array.array("I")
+        iv_max = array.array("Q")
+        for contig in contigs:
+            contig_intervals = sorted(intervals[contig])
+            starts = array.array("Q", (i[0] for i in contig_intervals))
+            ends = array.array("Q", (i[1] for i in contig_intervals))
+            iv_start.extend(starts)
+            iv_end.extend(ends)
+            iv_max.extend(_build_interval_tree(starts, ends))
+            iv_feature.extend(i[2] for i in contig_intervals)
+            contig_start.append(len(iv_start))
+
+    sections = {
+        "header": b"".join(header),
+        "feature_offset": offsets,
+        "feature_length": lengths,
+        "feature_id": feature_id,
+        "id_key_offset": id_key_offset,
+        "id_keys": id_keys,
+        "id_feature_start": id_feature_start,
+        "id_features": id_features,
+        "child_start": child_start,
+        "children": children,
+        "contig_key_offset": contig_key_offset,
+        "contig_keys": contig_keys,
+        "contig_start": contig_start,
+        "iv_start": iv_start,
+        "iv_end": iv_end,
+        "iv_max": iv_max,
+        "iv_feature": iv_feature,
+    }
+
+    index_path = _index_path(gff_file, index_path)
+    tmp_path = f"{index_path}.tmp"
+
+    with open(tmp_path, "wb") as fh, metrics.stage("write_index", index=index_path):
+        fh.write(_HEADER.pack(_MAGIC, _BYTE_ORDER_MARK, _VERSION, _FLAG_BGZF if bgzf else 0, size, mtime))
+        table_pos = fh.tell()
+        fh.write(bytes(_SECTION.size * len(_SECTIONS)))
+
+        table = []
+        for name, _ in _SECTIONS:
+            fh.write(bytes(-fh.tell() % 8))  # Keep every array aligned
+            data = sections[name]
+            table.append((fh.tell(), len(data) * (data.itemsize if isinstance(data, array.array) else 1)))
+            fh.write(data)
+
+        fh.seek(table_pos)
+        for section in table:
+            fh.write(_SECTION.pack(*section))
+
+    # Replace any old index in one go, so a concurrent query never sees a partially-written one
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+class _KeyTable:
+    # Sequence view over a sorted table of strings in the index, for binary searching without decoding all of it
+    def __init__(self, offsets: memoryview, keys: memoryview):
+        self._offsets = offsets
+        self._keys = keys
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return bytes(self._keys[self._offsets[i]:self._offsets[i + 1]])
+
+    def find(self, key: str) -> Optional[int]:
+        key = key.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self) and self[lo] == key else None
+
+
+class GFF3Index:
+    """
+    A GFF3 file opened together with its index (see index_gff3.) The index is memory-mapped rather than read in, so
+    opening it and running a query only touches the parts of it (and of the GFF3 file) that the query needs.
+    """
+
+    def __init__(self, gff_file: str, index_path: Optional[str] = None):
+        index_path = _index_path(gff_file, index_path)
+        if not os.path.exists(index_path):
+            raise BCFExtrasInputError(f"No index found for {gff_file} (run index-gff3 first)")
+
+        with open(index_path, "rb") as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, bom, version, flags, size, mtime = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC or bom != _BYTE_ORDER_MARK or version != _VERSION:
+            self._map.close()
+            raise BCFExtrasInputError(
+                f"{index_path} is not a GFF3 index from this version, or is from another platform")
+        if (size, mtime) != _file_stamp(gff_file):
+            self._map.close()
+            raise BCFExtrasInputError(f"{index_path} is out of date (re-run index-gff3 on {gff_file})")
+
+        self._view = memoryview(self._map)
+        s = {}
+        for i, (name, typecode) in enumerate(_SECTIONS):
+            offset, length = _SECTION.unpack_from(self._map, _HEADER.size + i * _SECTION.size)
+            section = self._view[offset:offset + length]
+            s[name] = section.cast(typecode) if typecode else section
+        self._s = s
+
+        self._ids = _KeyTable(s["id_key_offset"], s["id_keys"])
+        self._contigs = _KeyTable(s["contig_key_offset"], s["contig_keys"])
+
+        self._bgzf = bool(flags & _FLAG_BGZF)
+        self._gff = open(gff_file, "rb")
+        self._gff_map = None if self._bgzf else (
+            mmap.mmap(self._gff.fileno(), 0, access=mmap.ACCESS_READ) if size else b"")
+        self._blocks: Dict[int, Tuple[int, bytes]] = {}
+
+    @property
+    def header(self) -> bytes:
+        return bytes(self._s["header"])
+
+    def _with_id(self, rank: int) -> memoryview:
+        return self._s["id_features"][self._s["id_feature_start"][rank]:self._s["id_feature_start"][rank + 1]]
+
+    def _children_of(self, rank: int) -> memoryview:
+        return self._s["children"][self._s["child_start"][rank]:self._s["child_start"][rank + 1]]
+
+    def feature(self, feature_id: str, descendants: bool = True) -> List[int]:
+        """
+        Finds the features (record lines) with an ID and, optionally, all of their descendants through Parent
+        attributes. Returns feature numbers in file order.
+        """
+
+        rank = self._ids.find(feature_id)
+        if rank is None:
+            return []
+
+        found: Set[int] = set(self._with_id(rank))
+        if descendants:
+            seen_ids = {rank}
+            stack = [rank]
+            while stack:
+                for child in self._children_of(stack.pop()):
+                    found.add(child)
+                    child_rank = self._s["feature_id"][child]
+                    if child_rank != _NO_ID and child_rank not in seen_ids:
+                        seen_ids.add(child_rank)
+                        found.update(self._with_id(child_rank))  # Features can span several lines with one ID
+                        stack.append(child_rank)
+
+        return sorted(found)
+
+    def overlapping(self, contig: str, start: int, end: Optional[int] = None) -> List[int]:
+        """
+        Finds the features overlapping a region (1-based, inclusive; end=None runs to the end of the contig), using
+        the contig's interval tree. Returns feature numbers in order of start position.
+        """
+
+        c = self._contigs.find(contig)
+        if c is None:
+            return []
+
+        lo, n = self._s["contig_start"][c], self._s["contig_start"][c + 1] - self._s["contig_start"][c]
+        if n == 0:
+            return []
+
+        st = start - 1
+        en = end if end is not None else 1 << 62
+        starts, ends, maxes = (self._s[k][lo:lo + n] for k in ("iv_start", "iv_end", "iv_max"))
+        features = self._s["iv_feature"][lo:lo + n]
+
+        # Top-down traversal of the implicit interval tree, as in cgranges; results come out sorted by position
+        found = []
+        root_k = n.bit_length() - 1
+        stack = [(root_k, (1 << root_k) - 1, False)]
+        while stack:
+            k, x, left_done = stack.pop()
+            if k <= 3:
+                # Small subtree; just check all of it
+                i0 = x >> k << k
+                for i in range(i0, min(i0 + (1 << (k + 1)) - 1, n)):
+                    if starts[i] >= en:
+                        break
+                    if st < ends[i]:
+                        found.append(features[i])
+            elif not left_done:
+                stack.append((k, x, True))
+                y = x - (1 << (k - 1))
+                if y >= n or maxes[y] > st:
+                    stack.append((k - 1, y, False))
+            elif x < n and starts[x] < en:
+                if st < ends[x]:
+                    found.append(features[x])
+                stack.append((k - 1, x + (1 << (k - 1)), False))
+
+        return found
+
+    def _read_bgzf(self, voffset: int, length: int) -> bytes:
+        coffset, pos = voffset >> 16, voffset & 0xffff
+        out = b""
+        while len(out) < length:
+            block = self._blocks.get(coffset)
+            if block is None:
+                if len(self._blocks) >= 64:
+                    self._blocks.clear()
+                self._gff.seek(coffset)
+                block = read_block(self._gff)
+                if block is None:
+                    raise BCFExtrasInputError("Unexpected end of GFF3 file (is the index out of date?)")
+                self._blocks[coffset] = block
+            block_size, data = block
+            out += data[pos:pos + length - len(out)]
+            coffset += block_size
+            pos = 0
+        return out
+
+    def records(self, features: Iterable[int]) -> Iterator[bytes]:
+        offsets, lengths = self._s["feature_offset"], self._s["feature_length"]
+        for f in features:
+            if self._bgzf:
+                yield self._read_bgzf(offsets[f], lengths[f])
+            else:
+                yield self._gff_map[offsets[f]:offsets[f] + lengths[f]]
+
+    def close(self):
+        # Views into the map have to be released before it can be closed
+        for section in self._s.values():
+            section.release()
+        self._view.release()
+        self._s = {}
+        self._ids = self._contigs = None
+        self._map.close()
+        if self._gff_map is not None and not isinstance(self._gff_map, bytes):
+            self._gff_map.close()
+        self._gff.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def query_gff3(gff_file: str, feature_id: Optional[str] = None, region: Optional[str] = None,
+               descendants: bool = True, index_path: Optional[str] = None):
+    """
+    Writes the header of an indexed GFF3 file and the results of a query to stdout: either a feature (by ID) along
+    with its descendants, or all features overlapping a region.
+    """
+
+    if (feature_id is None) == (region is None):
+        raise BCFExtrasInputError("query_gff3: Exactly one of a feature ID or a region must be given")
+
+    with GFF3Index(gff_file, index_path) as idx:
+        with metrics.stage("lookup"):
+            features = idx.feature(feature_id, descendants) if feature_id is not None else idx.overlapping(
+                *parse_region(region))
+
+        with metrics.stage("read_records", features=len(features)):
+            sys.stdout.flush()
+            out = sys.stdout.buffer
+            out.write(idx.header)
+            for record in idx.records(features):
+                out.write(record if record.endswith(b"\n") else record + b"\n")
+            out.flush()
@@ -0,0 +1,11 @@
+__all__ = [
+    "ENGINE_MERGESTR",
+    "ENGINE_BUILTIN",
+    "MERGE_ENGINES",
+]
+
+
+# Kept apart from parallel_mergestr, so the CLI can offer these without importing TRTools
+ENGINE_MERGESTR = "mergestr"
+ENGINE_BUILTIN = "builtin"
+MERGE_ENGINES = (ENGINE_MERGESTR, ENGINE_BUILTIN)
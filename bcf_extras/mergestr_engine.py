@@ -0,0 +1,249 @@
+# bcf_extras is a set of variant file helper utilities built on top of bcftools and htslib.
+# Copyright (C) 2021  David Lougheed
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import sys
+import warnings
+
+from argparse import Namespace
+from typing import Iterator, List, Optional, Tuple
+
+from .exceptions import BCFExtrasDependencyError, BCFExtrasInputError
+
+try:
+    import numpy as np
+    import trtools.mergeSTR.mergeSTR as mergestr
+    import trtools.utils.common as trtools_common
+    import trtools.utils.mergeutils as mergeutils
+    import trtools.utils.utils as trtools_utils
+except ModuleNotFoundError:
+    mergestr = None
+
+__all__ = [
+    "merge_str_vcfs",
+]
+
+
+def _join_columns(arr, sep: str):
+    # Joins the columns of a 2D string array row-wise, i.e. [",".join(row) for row in arr], without a Python loop
+    # over the rows.
+    joined = arr[:, 0]
+    for col in range(1, arr.shape[1]):
+        joined = np.char.add(np.char.add(joined, sep), arr[:, col])
+    return joined
+
+
+def _batched(arrays: list, fn):
+    # Applies fn to all arrays at once if they can be stacked (the usual case, since records at the same locus tend
+    # to have the same shape of data), or to each one separately if they can't.
+    if len({a.shape[1:] for a in arrays}) == 1:
+        return fn(np.concatenate(arrays))
+    return np.concatenate([fn(a) for a in arrays])
+
+
+def _format_strings(values, fmt_type: str):
+    # Same string conversion rules as mergeSTR's WriteSampleData
+    if fmt_type == "String":
+        return values.astype(str)
+    if fmt_type == "Float":
+        nans = np.isnan(values)
+        values = values.astype(str)
+        values[nans] = "."
+        return _join_columns(values, ",")
+    return _join_columns(values.astype(str), ",")
+
+
+def _genotype_strings(alleles_and_phases):
+    alleles, phase_chars = alleles_and_phases[:, :-1], alleles_and_phases[:, -1]
+    gts = alleles[:, 0]
+    for col in range(1, alleles.shape[1]):
+        gts = np.char.add(np.char.add(gts, phase_chars), alleles[:, col])
+    return gts
+
+
+def _sample_columns(records: list, mappings: list, formats: List[str], format_type: List[str]):
+    """
+    Vectorized equivalent of mergeSTR's WriteSampleData: builds the GT:FORMAT... column of every sample of every
+    merged record at once, as a single NumPy string array, instead of writing out each sample and field separately.
+    """
+
+    genotypes = [r.genotype.array() for r in records]
+    not_called = [np.all(np.logical_or(g[:, :-1] == -1, g[:, :-1] == -2), axis=1) for g in genotypes]
+
+    # Missing alleles index into the mapping from the end, exactly as they do in mergeSTR. mergeSTR never looks up
+    # not-called samples at all though (their -2 padding may be out of range), so point those at the reference.
+    columns = _batched([
+        np.column_stack((mapping[np.where(nc[:, None], 0, g[:, :-1])], np.array(["/", "|"])[g[:, -1]]))
+        for g, nc, mapping in zip(genotypes, not_called, mappings)
+    ], _genotype_strings)
+
+    for fmt, fmt_type in zip(formats, format_type):
+        values = _batched([r.format(fmt) for r in records], lambda v: _format_strings(v, fmt_type))
+        columns = np.char.add(np.char.add(columns, ":"), values)
+
+    columns[np.concatenate(not_called)] = mergestr.NOCALLSTRING
+    return columns
+
+
+def _merge_records(vcf_type, num_samples: List[int], current_records: list, use_info, use_format: List[str],
+                   format_type: List[str]) -> str:
+    """
+    Equivalent of mergeSTR's MergeRecords, returning the merged record line (or an empty string if the records could
+    not be merged) rather than writing it out piece by piece. Records which are None are not part of the merge.
+    """
+
+    merge_list = [r is not None for r in current_records]
+    merged = [r for r in current_records if r is not None]
+    first = merged[0]
+
+    ref_allele = mergestr.GetRefAllele(current_records, merge_list)
+    if ref_allele is None:
+        trtools_common.WARNING(f"Conflicting refs found at {first.CHROM}:{first.POS}. Skipping.")
+        return ""
+
+    alt_alleles, mappings = mergestr.GetAltAlleles(current_records, merge_list, vcf_type)
+
+    info = []
+    for field, reqd in use_info:
+        inf = mergestr.GetInfoItem(current_records, merge_list, field, fail=reqd)
+        if inf is not None:
+            info.append(inf)
+
+    line = [
+        first.CHROM,
+        str(first.POS),
+        mergestr.GetID(first.ID),
+        ref_allele,
+        ",".join(alt_alleles) if alt_alleles else ".",
+        ".",  # QUAL
+        ".",  # FILTER
+        ";".join(info),
+        ":".join(["GT"] + use_format),
+    ]
+
+    sample_columns = _sample_columns(merged, mappings, use_format, format_type).tolist()
+
+    offset = 0
+    for record, n_samples in zip(current_records, num_samples):
+        if n_samples == 0:
+            continue
+        if record is None:
+            line.append("\t".join([mergestr.NOCALLSTRING] * n_samples))
+        else:
+            line.append("\t".join(sample_columns[offset:offset + n_samples]))
+            offset += n_samples
+
+    return "\t".join(line) + "\n"
+
+
+def _region_records(reader, contig: str, start: int, end: Optional[int]) -> Iterator:
+    # Region queries return every record overlapping the region; only keep the ones which start in it, so that records
+    # spanning the boundary between two regions are only merged once.
+    with warnings.catch_warnings():
+        # Plenty of inputs have no records in any given region, which is fine here
+        warnings.filterwarnings("ignore", message="no intervals found")
+        records = reader(contig if end is None else f"{contig}:{start}-{end}")
+        first = next(records, None)
+
+    if first is None:
+        return
+
+    for record in itertools.chain((first,), records):
+        if start <= record.POS and (end is None or record.POS <= end):
+            yield record
+
+
+def merge_str_vcfs(
+        vcfs: List[str],
+        out_prefix: str,
+        vcf_type: str = "auto",
+        update_sample_from_file: bool = False,
+        region: Optional[Tuple[str, int, Optional[int]]] = None,
+):
+    """
+    Built-in, streaming alternative to running TRTools' mergeSTR. Inputs are read in lockstep with a heap-based k-way
+    merge on (contig, position), and sample data for each merged record is assembled with vectorized NumPy operations
+    rather than sample by sample. Header and record merging rules are TRTools' own, and genotypes are written exactly
+    as mergeSTR writes them (phasing, mixed ploidy and missing values included), so output is the same as mergeSTR's.
+    :param vcfs: The bgzipped, tabix-indexed STR VCFs to merge.
+    :param out_prefix: The output prefix; the merged VCF is written to {out_prefix}.vcf.
+    :param vcf_type: The type of VCFs being merged (see mergeSTR docs for more info.)
+    :param update_sample_from_file: Whether to prefix sample names with their file names.
+    :param region: If set, only records starting in this (contig, start, end) region are merged, read straight from
+                   the indexed inputs. Coordinates are 1-based and inclusive; an end of None means the end of the
+                   contig. Inputs without any records in the region just contribute no-call sample columns.
+    """
+
+    if mergestr is None:
+        raise BCFExtrasDependencyError("Could not import trtools.mergeSTR.mergeSTR (missing TRTools dependency?)")
+
+    readers = trtools_utils.LoadReaders(vcfs, checkgz=True)
+    if not readers:
+        raise BCFExtrasInputError("Could not load VCFs for merging (are they all bgzipped and indexed?)")
+
+    num_samples = [len(reader.samples) for reader in readers]
+    chroms = trtools_utils.GetContigs(readers[0])
+    chrom_order = {c: i for i, c in enumerate(chroms)}
+
+    try:
+        vcf_type = mergeutils.GetAndCheckVCFType(readers, vcf_type)
+    except (TypeError, ValueError) as e:
+        raise BCFExtrasInputError(str(e))
+
+    # Only needed for file-based sample names, so don't build a potentially huge string otherwise
+    header_args = Namespace(
+        update_sample_from_file=update_sample_from_file,
+        vcfs=",".join(vcfs) if update_sample_from_file else "")
+
+    with open(f"{out_prefix}.vcf", "w", buffering=1024 * 1024) as vcfw:
+        use_info, use_format = mergestr.WriteMergedHeader(vcfw, header_args, readers, " ".join(sys.argv), vcf_type)
+        if use_info is None or use_format is None:
+            raise BCFExtrasInputError("Could not write merged VCF header")
+
+        format_type = [readers[0].get_header_type(fmt)["Type"] for fmt in use_format]
+
+        records = readers if region is None else [_region_records(reader, *region) for reader in readers]
+        heap = []
+
+        def _advance(reader_idx: int):
+            record = next(records[reader_idx], None)
+            if record is None:
+                return
+            if record.CHROM not in chrom_order:
+                raise BCFExtrasInputError(
+                    f"Found a record in {vcfs[reader_idx]} with contig '{record.CHROM}', which was not found in the "
+                    f"contig header lines")
+            # The reader index breaks ties, so records themselves are never compared
+            heapq.heappush(heap, (chrom_order[record.CHROM], record.POS, reader_idx, record))
+
+        for idx in range(len(readers)):
+            _advance(idx)
+
+        while heap:
+            current_records = [None] * len(readers)
+
+            chrom_idx, pos, reader_idx, record = heapq.heappop(heap)
+            current_records[reader_idx] = record
+            while heap and heap[0][0] == chrom_idx and heap[0][1] == pos:
+                _, _, reader_idx, record = heapq.heappop(heap)
+                current_records[reader_idx] = record
+
+            vcfw.write(_merge_records(vcf_type, num_samples, current_records, use_info, use_format, format_type))
+
+            for idx, record in enumerate(current_records):
+                if record is not None:
+                    _advance(idx)
@@ -0,0 +1,400 @@
+# bcf_extras is a set of variant file helper utilities built on top of bcftools and htslib.
+# Copyright (C) 2021  David Lougheed
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Opt-in timing and resource instrumentation. While a collector is active (see collect()), every stage wrapped in
+stage() and every external process run through popen()/wait(), check_call() or check_output() produces a record of
+its wall time, CPU time, peak RSS and bytes read and written. Without an active collector, these are all plain
+pass-throughs to subprocess, so instrumented code costs (next to) nothing when metrics aren't wanted.
+"""
+
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+__all__ = [
+    "SCHEMA",
+    "SCHEMA_VERSION",
+    "RECORD_FIELDS",
+    "KIND_STAGE",
+    "KIND_PROCESS",
+    "MetricsCollector",
+    "collect",
+    "active",
+    "stage",
+    "popen",
+    "wait",
+    "check_call",
+    "check_output",
+    "wrap",
+    "unwrap",
+    "peak_rss_bytes",
+]
+
+
+SCHEMA = "bcf-extras-metrics"
+SCHEMA_VERSION = 1
+
+KIND_STAGE = "stage"
+KIND_PROCESS = "process"
+
+# Every record has exactly these keys; fields which don't apply (or can't be measured on this platform) are null.
+RECORD_FIELDS = (
+    "id",
+    "parent",
+    "kind",
+    "name",
+    "labels",
+    "pid",
+    "started_at",
+    "status",
+    "wall_seconds",
+    "cpu_user_seconds",
+    "cpu_system_seconds",
+    "peak_rss_bytes",
+    "read_bytes",
+    "write_bytes",
+    "args",
+    "returncode",
+)
+
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024  # ru_maxrss: Linux reports kilobytes, macOS reports bytes
+
+_collector: Optional["MetricsCollector"] = None
+
+
+def peak_rss_bytes(*rusages) -> int:
+    """
+    Converts the ru_maxrss of one or more resource.getrusage() results to bytes, taking the largest.
+    """
+    return max(ru.ru_maxrss for ru in rusages) * _RSS_UNIT
+
+
+def _io_counters(pid: str = "self") -> Tuple[Optional[int], Optional[int]]:
+    # Bytes passed through read()/write()-like calls (including pipes and page cache hits), from Linux's per-process
+    # I/O accounting. A process' counters include those of its children once they have been waited on.
+    try:
+        with open(f"/proc/{pid}/io", "rb") as fh:
+            counters = dict(line.split(b":", 1) for line in fh if b":" in line)
+        return int(counters[b"rchar"]), int(counters[b"wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _delta(end: Optional[int], start: Optional[int]) -> Optional[int]:
+    return None if end is None or start is None else end - start
+
+
+class _Usage:
+    """
+    A snapshot of this process' (and its waited-on children's) resource use.
+    """
+
+    __slots__ = ("wall", "self_ru", "children_ru", "io")
+
+    def __init__(self):
+        self.wall = time.perf_counter()
+        self.self_ru = resource.getrusage(resource.RUSAGE_SELF)
+        self.children_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io = _io_counters()
+
+    def since(self, start: "_Usage") -> Dict[str, Any]:
+        # Peak RSS can't be measured over an interval, so it is the high-water mark of this process or any of its
+        # finished children at the end of the interval.
+        return {
+            "wall_seconds": self.wall - start.wall,
+            "cpu_user_seconds": (self.self_ru.ru_utime + self.children_ru.ru_utime
+                                 - start.self_ru.ru_utime - start.children_ru.ru_utime),
+            "cpu_system_seconds": (self.self_ru.ru_stime + self.children_ru.ru_stime
+                                   - start.self_ru.ru_stime - start.children_ru.ru_stime),
+            "peak_rss_bytes": peak_rss_bytes(self.self_ru, self.children_ru),
+            "read_bytes": _delta(self.io[0], start.io[0]),
+            "write_bytes": _delta(self.io[1], start.io[1]),
+        }
+
+
+def _labels(labels: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v if v is None or isinstance(v, (str, int, float, bool)) else str(v) for k, v in labels.items()}
+
+
+class MetricsCollector:
+    """
+    Accumulates the metrics records of a run, in the order they finish. Each record's parent is the stage which was
+    running when it started (or null for top-level records.) Stage figures include everything which ran inside them,
+    like the cumulative times of a profiler.
+    """
+
+    def __init__(self, hook: Optional[Callable[[dict], None]] = None):
+        """
+        :param hook: Optionally, a function to call with each record as soon as it is finished.
+        """
+        self.hook = hook
+        self.records: List[dict] = []
+        self.started_at = time.time()
+        self._start = _Usage()
+        self._stack: List[int] = []
+        self._last_id = 0
+
+    def _next_id(self) -> int:
+        self._last_id += 1
+        return self._last_id
+
+    @property
+    def current(self) -> Optional[int]:
+        return self._stack[-1] if self._stack else None
+
+    def _add(self, record: dict):
+        self.records.append(record)
+        if self.hook is not None:
+            self.hook(record)
+
+    def _add_new(self, record_id: int, parent: Optional[int], kind: str, name: str, labels: Dict[str, Any],
+                 pid: int, started_at: float, status: str, usage: Dict[str, Any],
+                 args: Optional[List[str]] = None, returncode: Optional[int] = None):
+        self._add({
+            "id": record_id,
+            "parent": parent,
+            "kind": kind,
+            "name": name,
+            "labels": _labels(labels),
+            "pid": pid,
+            "started_at": started_at,
+            "status": status,
+            **usage,
+            "args": args,
+            "returncode": returncode,
+        })
+
+    def merge(self, records: List[dict]):
+        """
+        Adds records collected by another process (see wrap()), re-numbering them and placing their top-level
+        records under the current stage.
+        """
+        ids = {r["id"]: self._next_id() for r in records}
+        parent = self.current
+        for r in records:
+            self._add({**r, "id": ids[r["id"]], "parent": ids.get(r["parent"], parent)})
+
+    def to_dict(self, command: Optional[str] = None, argv: Optional[List[str]] = None, status: str = "ok",
+                error: Optional[str] = None) -> dict:
+        return {
+            "schema": SCHEMA,
+            "schema_version": SCHEMA_VERSION,
+            "command": command,
+            "argv": argv,
+            "status": status,
+            "error": error,
+            "started_at": self.started_at,
+            "totals": _Usage().since(self._start),
+            "records": list(self.records),
+        }
+
+    def write_json(self, path: str, **kwargs):
+        """
+        Writes the collected metrics as a JSON document; keyword arguments are passed on to to_dict().
+        """
+        with open(path, "w") as fh:
+            json.dump(self.to_dict(**kwargs), fh, indent=2)
+            fh.write("\n")
+
+
+@contextlib.contextmanager
+def collect(hook: Optional[Callable[[dict], None]] = None):
+    """
+    Collects metrics for everything run inside the with-block, e.g.:
+        with metrics.collect() as collector:
+            filter_gff3(...)
+        print(collector.to_dict())
+    :param hook: Optionally, a function to call with each record as soon as it is finished.
+    """
+    global _collector
+    previous = _collector
+    _collector = MetricsCollector(hook)
+    try:
+        yield _collector
+    finally:
+        _collector = previous
+
+
+def active() -> Optional[MetricsCollector]:
+    return _collector
+
+
+@contextlib.contextmanager
+def stage(name: str, **labels):
+    """
+    Records the resource use of the with-block as a stage, if metrics are being collected.
+    :param name: The stage name.
+    :param labels: Extra details for the record, e.g. the file being worked on.
+    """
+    c = _collector
+    if c is None:
+        yield
+        return
+
+    record_id = c._next_id()
+    parent = c.current
+    started_at = time.time()
+    start = _Usage()
+    status = "error"
+
+    c._stack.append(record_id)
+    try:
+        yield
+        status = "ok"
+    finally:
+        c._stack.pop()
+        c._add_new(record_id, parent, KIND_STAGE, name, labels, os.getpid(), started_at, status, _Usage().since(start))
+
+
+def popen(args: Sequence[str], **kwargs) -> subprocess.Popen:
+    """
+    Starts an external process with subprocess.Popen; wait on it with wait() to get it recorded.
+    """
+    proc = subprocess.Popen(args, **kwargs)
+    if _collector is not None:
+        proc._bcf_extras_metrics = (time.time(), time.perf_counter(), _collector.current)
+    return proc
+
+
+def wait(proc: subprocess.Popen, name: Optional[str] = None) -> int:
+    """
+    Waits for a process started with popen(), recording its exact resource use if metrics are being collected.
+    :return: The process' return code, as with Popen.wait().
+    """
+
+    c = _collector
+    started = getattr(proc, "_bcf_extras_metrics", None)
+    if c is None or started is None or proc.returncode is not None or not hasattr(os, "wait4"):
+        return proc.wait()
+
+    read_bytes = write_bytes = None
+    if hasattr(os, "waitid"):
+        # Wait without reaping first, while the finished process' I/O counters can still be read
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        read_bytes, write_bytes = _io_counters(str(proc.pid))
+
+    _, status, ru = os.wait4(proc.pid, 0)
+    end = time.perf_counter()
+    # We reaped the process ourselves, so Popen needs to be told how it ended
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+    started_at, start, parent = started
+    args = [os.fsdecode(a) for a in ([proc.args] if isinstance(proc.args, (str, bytes)) else proc.args)]
+    c._add_new(c._next_id(), parent, KIND_PROCESS, name or os.path.basename(args[0]), {}, proc.pid, started_at,
+               "ok" if proc.returncode == 0 else "error", {
+                   "wall_seconds": end - start,
+                   "cpu_user_seconds": ru.ru_utime,
+                   "cpu_system_seconds": ru.ru_stime,
+                   "peak_rss_bytes": peak_rss_bytes(ru),
+                   "read_bytes": read_bytes,
+                   "write_bytes": write_bytes,
+               }, args=args, returncode=proc.returncode)
+
+    return proc.returncode
+
+
+def _kill(proc: subprocess.Popen):
+    proc.kill()
+    wait(proc)
+
+
+def check_call(args: Sequence[str], name: Optional[str] = None, **kwargs) -> int:
+    """
+    subprocess.check_call, with the process recorded if metrics are being collected.
+    """
+    if _collector is None:
+        return subprocess.check_call(args, **kwargs)
+
+    proc = popen(args, **kwargs)
+    try:
+        ret = wait(proc, name)
+    except BaseException:
+        _kill(proc)
+        raise
+
+    if ret:
+        raise subprocess.CalledProcessError(ret, args)
+    return 0
+
+
+def check_output(args: Sequence[str], name: Optional[str] = None, **kwargs) -> bytes:
+    """
+    subprocess.check_output, with the process recorded if metrics are being collected.
+    """
+    if _collector is None:
+        return subprocess.check_output(args, **kwargs)
+
+    proc = popen(args, stdout=subprocess.PIPE, **kwargs)
+    try:
+        with proc.stdout:
+            output = proc.stdout.read()
+        ret = wait(proc, name)
+    except BaseException:
+        _kill(proc)
+        raise
+
+    if ret:
+        raise subprocess.CalledProcessError(ret, args, output=output)
+    return output
+
+
+class _WorkerResult:
+    def __init__(self, result: Any, records: List[dict]):
+        self.result = result
+        self.records = records
+
+
+class _Collected:
+    # A picklable wrapper for functions run in a process pool, which collects the metrics of each call in the worker
+    # so that the parent can merge them in (see unwrap().)
+
+    def __init__(self, fn: Callable):
+        self.fn = fn
+        self.enabled = _collector is not None
+
+    def __call__(self, *args):
+        if not self.enabled:
+            return self.fn(*args)
+        with collect() as c:
+            result = self.fn(*args)
+        return _WorkerResult(result, c.records)
+
+
+def wrap(fn: Callable) -> Callable:
+    """
+    Wraps a function to be run in a worker process, so that its metrics records can be passed back to this process
+    along with its result. Results must be passed through unwrap() before use.
+    """
+    return _Collected(fn)
+
+
+def unwrap(result: Any) -> Any:
+    """
+    Merges any metrics records returned by a wrap()-ed function into the active collector, and returns the function's
+    actual result.
+    """
+    if not isinstance(result, _WorkerResult):
+        return result
+    if _collector is not None:
+        _collector.merge(result.records)
+    return result.result
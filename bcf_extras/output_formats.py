@@ -0,0 +1,13 @@
+__all__ = [
+    "OUTPUT_VCF",
+    "OUTPUT_BCF",
+    "OUTPUT_BOTH",
+    "OUTPUT_FORMATS",
+]
+
+
+# Kept apart from copy_compress_index, so the CLI can offer these without importing it
+OUTPUT_VCF = "vcf"  # bgzipped VCF, with a tabix index (or a CSI index, for contigs too long for tabix)
+OUTPUT_BCF = "bcf"  # BCF, with a CSI index
+OUTPUT_BOTH = "both"
+OUTPUT_FORMATS = (OUTPUT_VCF, OUTPUT_BCF, OUTPUT_BOTH)
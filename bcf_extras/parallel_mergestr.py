@@ -1,13 +1,26 @@
+import gzip
+import hashlib
+import json
 import math
 import multiprocessing
 import os
+import queue
+import re
+import resource
+import shutil
 import subprocess
+import time
 
 from argparse import Namespace
+from dataclasses import dataclass, field, replace
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
-from .exceptions import BCFExtrasDependencyError, BCFExtrasInputError
+from . import metrics
+from .bgzf import has_bgzf_eof
+from .exceptions import BCFExtrasDependencyError, BCFExtrasInputError, BCFExtrasProcessError
+from .merge_engines import ENGINE_BUILTIN, ENGINE_MERGESTR, MERGE_ENGINES
+from .mergestr_engine import merge_str_vcfs
 
 try:
     from trtools.mergeSTR.mergeSTR import main as mergestr_main
@@ -15,36 +28,242 @@ except ModuleNotFoundError:
     mergestr_main = None
 
 __all__ = [
+    "ENGINE_MERGESTR",
+    "ENGINE_BUILTIN",
+    "MERGE_ENGINES",
     "parallel_mergestr",
+    "PLAN_SCHEMA",
+    "plan_mergestr",
+    "run_merge_plan",
+    "run_merge_plan_node",
 ]
 
 
-def _merge_small_last(vcfs: List[List[str]], group_size: int):
-    # If there's a small leftovers group, merge it in with its predecessor (if one exists)
-    # Otherwise, keep the list as-is
-    return vcfs[:-2] + [vcfs[-2] + vcfs[-1]] if len(vcfs[-1]) < group_size and len(vcfs) > 1 else vcfs
+_LOGGED_INPUTS = 10  # Inputs listed by name in a merge's log line
 
 
-def _intermediate_file_name(prefix: str, idx: Optional[int]):
-    return f"{prefix}_{idx}" if idx is not None else prefix
+@dataclass
+class _MergeNode:
+    """
+    A single step in the merge plan. Intermediate nodes of a merge tree produce a bgzipped, tabix-indexed VCF at
+    {out_prefix}.vcf.gz which is consumed by the node(s) listed as depending on them. Region shard nodes merge only
+    one region of their inputs, producing {out_prefix}.vcf, and the final node (either a merge or a concatenation of
+    shards) produces {out_prefix}.vcf.
+    """
+    id: str
+    out_prefix: str
+    level: int
+    inputs: List[str]
+    deps: List[str] = field(default_factory=list)
+    final: bool = False
+    cost: int = 0  # Estimated relative cost of the merge; the total size of the original input VCFs involved
+    region: Optional[Tuple[str, int, Optional[int]]] = None
+    concat: bool = False
+    samples: int = 0  # Number of samples in the merge output; only counted when scheduling against a memory budget
+
+    @property
+    def output(self) -> str:
+        return f"{self.out_prefix}.vcf" if self.final or self.region is not None else f"{self.out_prefix}.vcf.gz"
+
+
+@dataclass
+class _MergeOptions:
+    vcf_type: str = "auto"
+    stream_intermediates: bool = False  # Whether to pipe intermediate merges straight into bgzip
+    engine: str = ENGINE_MERGESTR
+
+
+def _merge_small_last(vcfs: List[List[str]], group_size: int, max_size: Optional[int] = None):
+    # If there's a small leftovers group, merge it in with its predecessor (if one exists and the result isn't
+    # larger than max_size.) Otherwise, keep the list as-is
+    if len(vcfs) > 1 and len(vcfs[-1]) < group_size and (
+            max_size is None or len(vcfs[-2]) + len(vcfs[-1]) <= max_size):
+        return vcfs[:-2] + [vcfs[-2] + vcfs[-1]]
+    return vcfs
+
+
+def _group(items: list, group_size: int, max_size: Optional[int] = None) -> list:
+    return _merge_small_last([items[i:i+group_size] for i in range(0, len(items), group_size)], group_size, max_size)
+
+
+def _even_groups(items: list, max_size: int) -> list:
+    # Splits items into as few contiguous groups of at most max_size items as possible, with sizes differing by at
+    # most one, so that no merge in a level ends up with a much larger (or smaller) set of inputs than the others
+    n_groups = math.ceil(len(items) / max_size)
+    size, extra = divmod(len(items), n_groups)
+    groups = []
+    start = 0
+    for i in range(n_groups):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(items[start:end])
+        start = end
+    return groups
+
+
+def _input_weights(vcfs: List[str]) -> List[int]:
+    # File size is a cheap stand-in for the number of records/samples a VCF holds, and so for how long it takes
+    # to merge. Files we can't stat (e.g. not created yet) count as a single byte.
+    weights = []
+    for vcf in vcfs:
+        try:
+            weights.append(max(os.path.getsize(vcf), 1))
+        except OSError:
+            weights.append(1)
+    return weights
+
+
+def _balanced_groups(items: list, weights: List[int], n_groups: int, max_size: Optional[int] = None) -> list:
+    """
+    Splits items into at most n_groups contiguous groups (preserving input, and thus sample, order) so that the
+    heaviest group is as light as possible. If max_size is set, no group will contain more than max_size items.
+    """
+
+    def _pack(limit: int) -> list:
+        groups = [[]]
+        total = 0
+        for item, weight in zip(items, weights):
+            if groups[-1] and (total + weight > limit or (max_size is not None and len(groups[-1]) >= max_size)):
+                groups.append([])
+                total = 0
+            groups[-1].append(item)
+            total += weight
+        return groups
+
+    # Binary search for the smallest feasible heaviest-group weight
+    lo, hi = max(weights), sum(weights)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if len(_pack(mid)) <= n_groups:
+            hi = mid
+        else:
+            lo = mid + 1
+
+    return _pack(lo)
+
+
+def _intermediate_file_name(prefix: str, idx: Optional[int], level: int = 0):
+    # Level 0 names are kept as {prefix}_{idx} so that they stay stable for --step2-only runs of a two-level tree
+    if idx is None:
+        return prefix
+    return f"{prefix}_{idx}" if level == 0 else f"{prefix}_L{level}_{idx}"
+
+
+def _build_merge_tree(
+        vcfs: List[str],
+        out: str,
+        intermediate_prefix: str,
+        group_size: int,
+        fan_in: Optional[int] = None,
+        weights: Optional[List[int]] = None,
+) -> List[_MergeNode]:
+    """
+    Builds the merge tree for a set of VCFs, returning its nodes in a valid execution order (final node last.)
+    The input VCFs are merged in groups of group_size; if fan_in is set, the resulting intermediates are then merged
+    fan_in at a time, level by level, until at most fan_in inputs remain for the final merge.
+    If input weights are given, the same number of groups is made, but they are balanced by total weight instead of
+    by count.
+    """
+
+    n_groups = len(_group(vcfs, group_size, fan_in))
+
+    if weights is None:
+        leaf_groups = _group(vcfs, group_size, fan_in)
+        vcf_weights = {vcf: 1 for vcf in vcfs}
+    else:
+        leaf_groups = _balanced_groups(vcfs, weights, n_groups, max_size=fan_in)
+        vcf_weights = dict(zip(vcfs, weights))
+
+    if len(leaf_groups) == 1:
+        # Don't bother with intermediates if everything fits into a single merge
+        return [_MergeNode(
+            id=out, out_prefix=out, level=0, inputs=leaf_groups[0], final=True,
+            cost=sum(vcf_weights[v] for v in leaf_groups[0]))]
+
+    nodes: List[_MergeNode] = []
+    level_nodes: List[_MergeNode] = []
+
+    for idx, group in enumerate(leaf_groups):
+        name = _intermediate_file_name(intermediate_prefix, idx)
+        level_nodes.append(_MergeNode(
+            id=name, out_prefix=name, level=0, inputs=group, cost=sum(vcf_weights[v] for v in group)))
+
+    nodes.extend(level_nodes)
+
+    level = 0
+    while fan_in is not None and len(level_nodes) > fan_in:
+        level += 1
+        next_nodes: List[_MergeNode] = []
+        n_merges = 0
+        for group in _even_groups(level_nodes, fan_in):
+            if len(group) == 1:
+                # A lone node doesn't need merging by itself (only happens with a fan-in of 2); carry it up instead
+                next_nodes.append(group[0])
+                continue
+            name = _intermediate_file_name(intermediate_prefix, n_merges, level)
+            n_merges += 1
+            next_nodes.append(_MergeNode(
+                id=name,
+                out_prefix=name,
+                level=level,
+                inputs=[n.output for n in group],
+                deps=[n.id for n in group],
+                cost=sum(n.cost for n in group),
+            ))
+            nodes.append(next_nodes[-1])
+        level_nodes = next_nodes
+
+    nodes.append(_MergeNode(
+        id=out,
+        out_prefix=out,
+        level=level + 1,
+        inputs=[n.output for n in level_nodes],
+        deps=[n.id for n in level_nodes],
+        final=True,
+        cost=sum(n.cost for n in level_nodes),
+    ))
+
+    return nodes
+
+
+def _describe_inputs(vcfs: List[str]) -> str:
+    # Merges can have tens of thousands of inputs, which would make for unreadably (and uselessly) long log lines
+    if len(vcfs) <= _LOGGED_INPUTS:
+        return f"[{', '.join(vcfs)}]"
+    return f"[{', '.join(vcfs[:_LOGGED_INPUTS])}, ... ({len(vcfs)} files)]"
+
+
+def _describe_region(region: Tuple[str, int, Optional[int]]) -> str:
+    contig, start, end = region
+    return f"{contig}:{start}-{end or ''}"
 
 
 def _merge(
         out_file_prefix: str,
         vcfs: List[str],
-        vcf_type: str,
-        remove_previous: bool
+        options: _MergeOptions,
+        remove_previous: bool,
+        region: Optional[Tuple[str, int, Optional[int]]] = None,
 ):
-    print(f"\tMerging [{', '.join(vcfs)}] to {out_file_prefix}.vcf", flush=True)
-
-    mergestr_main(Namespace(
-        out=out_file_prefix,
-        vcfs=",".join(vcfs),
-        vcftype=vcf_type,
-        update_sample_from_file=False,   # TODO: Pass in
-        verbose=False,   # TODO: Pass in
-        quiet=False,   # TODO: Pass in
-    ))
+    # Only the builtin engine can merge a region of its inputs directly; mergeSTR needs them extracted first.
+    region_note = "" if region is None else f" (region {_describe_region(region)})"
+    print(f"\tMerging {_describe_inputs(vcfs)}{region_note} to {out_file_prefix}.vcf", flush=True)
+
+    with metrics.stage("merge", engine=options.engine, inputs=len(vcfs)):
+        if options.engine == ENGINE_BUILTIN:
+            merge_str_vcfs(vcfs, out_file_prefix, options.vcf_type, region=region)
+        else:
+            ret = mergestr_main(Namespace(
+                out=out_file_prefix,
+                vcfs=",".join(vcfs),
+                vcftype=options.vcf_type,
+                update_sample_from_file=False,   # TODO: Pass in
+                verbose=False,   # TODO: Pass in
+                quiet=False,   # TODO: Pass in
+            ))
+
+            if ret:
+                raise BCFExtrasProcessError(
+                    f"mergeSTR exited with status {ret} while merging to {out_file_prefix}.vcf")
 
     if remove_previous:
         for vcf in vcfs:
@@ -57,13 +276,779 @@ def _merge(
     return f"{out_file_prefix}.vcf"
 
 
+def _merge_compress_streaming(
+        out_file_prefix: str,
+        vcfs: List[str],
+        options: _MergeOptions,
+        remove_previous: bool
+):
+    """
+    Merges VCFs into a bgzipped, tabix-indexed VCF without ever writing the uncompressed merge result to disk:
+    mergeSTR writes its output into a named pipe, which bgzip compresses as it is produced. Compared to writing,
+    re-reading and then compressing the VCF, this saves two full passes over uncompressed data.
+    """
+
+    fifo = f"{out_file_prefix}.vcf"
+    gz = f"{fifo}.gz"
+
+    if os.path.lexists(fifo):  # Left over from an interrupted run
+        os.remove(fifo)
+    os.mkfifo(fifo)
+
+    try:
+        with open(gz, "wb") as gz_fh:
+            bgzip = metrics.popen(["bgzip", "-c", fifo], stdout=gz_fh)
+            try:
+                _merge(out_file_prefix, vcfs, options, remove_previous)
+            except BaseException:
+                # If mergeSTR failed before opening its output, bgzip will wait on the pipe forever
+                bgzip.kill()
+                metrics.wait(bgzip)
+                raise
+            bgzip_ret = metrics.wait(bgzip)
+    finally:
+        os.remove(fifo)
+
+    if bgzip_ret != 0:
+        raise subprocess.CalledProcessError(bgzip_ret, bgzip.args)
+
+    metrics.check_call(["tabix", "-f", "-p", "vcf", gz])
+    return gz
+
+
 def _compress(vcf: str):
-    subprocess.check_call(["bgzip", vcf])
+    metrics.check_call(["bgzip", "-f", vcf])
     gz = f"{vcf}.gz"
-    subprocess.check_call(["tabix", "-f", "-p", "vcf", gz])
+    metrics.check_call(["tabix", "-f", "-p", "vcf", gz])
     return gz
 
 
+def _header_contigs(vcf: str) -> List[Tuple[str, Optional[int]]]:
+    contigs = []
+    for line in metrics.check_output(["tabix", "-H", vcf]).decode("utf-8").split("\n"):
+        if not line.startswith("##contig=<"):
+            continue
+        contig_id = re.search(r"[<,]ID=([^,>]+)", line)
+        contig_len = re.search(r"[<,]length=(\d+)", line)
+        if contig_id:
+            contigs.append((contig_id.group(1), int(contig_len.group(1)) if contig_len else None))
+    return contigs
+
+
+def _indexed_contigs(vcf: str) -> List[str]:
+    # Only lists contigs which actually have records, straight from the index - no need to read the VCF body
+    return metrics.check_output(["tabix", "-l", vcf]).decode("utf-8").split()
+
+
+def _shard_regions(vcfs: List[str], shard_size: Optional[int] = None) -> List[Tuple[str, int, Optional[int]]]:
+    """
+    Splits the genome into merge shards, based on the contigs which have records in at least one of the inputs. Each
+    shard is a (contig, start, end) tuple with 1-based, inclusive coordinates; an end of None means the shard runs to
+    the end of the contig. Shards are ordered by the header contig order of the first input.
+    :param vcfs: The tabix-indexed VCFs to shard.
+    :param shard_size: If set, contigs with a known length are further split into regions of this many bases.
+    """
+
+    header_contigs = _header_contigs(vcfs[0])
+    contig_lengths = dict(header_contigs)
+
+    present = set()
+    indexed_order = []
+    for vcf in vcfs:
+        for contig in _indexed_contigs(vcf):
+            if contig not in present:
+                present.add(contig)
+                indexed_order.append(contig)
+
+    # Contigs missing from the header go at the end, in the order the indices saw them
+    ordered = [c for c, _ in header_contigs if c in present]
+    ordered.extend(c for c in indexed_order if c not in contig_lengths)
+
+    shards = []
+    for contig in ordered:
+        contig_len = contig_lengths.get(contig)
+        if shard_size is None or contig_len is None:
+            shards.append((contig, 1, None))
+            continue
+        shards.extend((contig, s, min(s + shard_size - 1, contig_len)) for s in range(1, contig_len + 1, shard_size))
+
+    return shards
+
+
+def _build_shard_plan(
+        vcfs: List[str],
+        out: str,
+        intermediate_prefix: str,
+        shard_size: Optional[int] = None,
+) -> List[_MergeNode]:
+    """
+    Builds a merge plan which merges all VCFs one region shard at a time, followed by an ordered concatenation of
+    the shard results. Shard costs are their region lengths; contigs of unknown length are assumed to be small (e.g.
+    unplaced scaffolds.)
+    """
+
+    contig_lengths = dict(_header_contigs(vcfs[0]))
+
+    nodes = []
+    for idx, (contig, start, end) in enumerate(_shard_regions(vcfs, shard_size)):
+        name = f"{intermediate_prefix}_shard_{idx}"
+        nodes.append(_MergeNode(
+            id=name,
+            out_prefix=name,
+            level=0,
+            inputs=list(vcfs),
+            cost=(end or contig_lengths.get(contig) or start) - start + 1,
+            region=(contig, start, end),
+        ))
+
+    nodes.append(_MergeNode(
+        id=out,
+        out_prefix=out,
+        level=1,
+        inputs=[n.output for n in nodes],
+        deps=[n.id for n in nodes],
+        final=True,
+        cost=0,
+        concat=True,
+    ))
+
+    return nodes
+
+
+def _merge_shard(
+        out_file_prefix: str,
+        shard: Tuple[str, int, Optional[int]],
+        vcfs: List[str],
+        options: _MergeOptions,
+):
+    if options.engine == ENGINE_BUILTIN:
+        # The builtin engine reads the shard's region straight from the indexed inputs, and copes with inputs which
+        # have no records in it, so nothing needs to be extracted.
+        return _merge(out_file_prefix, vcfs, options, remove_previous=False, region=shard)
+
+    contig, start, end = shard
+
+    extract_cmd = ["bcftools", "view", "-O", "z"]
+    if end is None:
+        extract_cmd.extend(("-r", contig))
+    else:
+        # Region queries return every record overlapping the region, so records which span a shard boundary would
+        # end up in two shards; only keep records which start in this shard.
+        extract_cmd.extend(("-r", f"{contig}:{start}-{end}", "-i", f"POS>={start} && POS<={end}"))
+
+    shard_inputs = []
+    input_samples = []
+    for idx, vcf in enumerate(vcfs):
+        shard_input = f"{out_file_prefix}_in_{idx}.vcf.gz"
+        metrics.check_call([*extract_cmd, "-o", shard_input, vcf])
+
+        samples, has_records = _extract_samples(shard_input)
+        input_samples.append((samples, has_records))
+
+        if has_records:
+            metrics.check_call(["tabix", "-f", "-p", "vcf", shard_input])
+            shard_inputs.append(shard_input)
+        else:
+            # mergeSTR crashes on inputs without any records, which are common here (not every sample has calls in
+            # every region), so these are left out of the merge and get no-call columns added afterwards.
+            os.remove(shard_input)
+
+    if not shard_inputs:
+        # Nothing to merge in this shard; an empty file is skipped when the shards are concatenated.
+        out_vcf = f"{out_file_prefix}.vcf"
+        open(out_vcf, "w").close()
+        return out_vcf
+
+    n_empty = len(vcfs) - len(shard_inputs)
+    if n_empty:
+        print(f"\t{n_empty} of {len(vcfs)} inputs have no records in region {_describe_region(shard)}; their samples "
+              f"are added to {out_file_prefix}.vcf as no-calls", flush=True)
+
+    out_vcf = _merge(out_file_prefix, shard_inputs, options, remove_previous=True)
+    if n_empty:
+        _add_no_call_samples(out_vcf, input_samples)
+    return out_vcf
+
+
+def _extract_samples(vcf_gz: str) -> Tuple[List[str], bool]:
+    """
+    Reads the sample names from a (b)gzipped VCF, and checks whether it has any records at all, without reading more
+    than its header and first record.
+    """
+    samples = []
+    with gzip.open(vcf_gz, "rt") as vf:
+        for line in vf:
+            if line.startswith("#CHROM"):
+                samples = line.rstrip("\n").split("\t")[9:]
+            elif not line.startswith("#"):
+                return samples, True
+    return samples, False
+
+
+def _add_no_call_samples(vcf: str, input_samples: List[Tuple[List[str], bool]]):
+    """
+    Adds the sample columns of inputs which were left out of a merge (since they had no records) back into the merged
+    VCF, in input order and with the same no-call values mergeSTR writes for inputs without a record at a locus.
+    :param vcf: The merged VCF, which is rewritten in place.
+    :param input_samples: (sample names, merged) for every input, in the order they would have been merged in.
+    """
+    tmp_vcf = f"{vcf}.tmp"
+    with open(vcf) as vf, open(tmp_vcf, "w") as of:
+        for line in vf:
+            if line.startswith("##"):
+                of.write(line)
+                continue
+
+            is_header = line.startswith("#")
+            cols = line.rstrip("\n").split("\t")
+            merged_cols = iter(cols[9:])
+
+            new_cols = cols[:9]
+            for samples, merged in input_samples:
+                if merged:
+                    new_cols.extend(next(merged_cols) for _ in samples)
+                else:
+                    new_cols.extend(samples if is_header else ["."] * len(samples))
+
+            of.write("\t".join(new_cols) + "\n")
+
+    os.replace(tmp_vcf, vcf)
+
+
+def _concat_vcfs(vcfs: List[str], out_vcf: str):
+    """
+    Concatenates already-ordered, non-overlapping VCFs with the same samples, using the header of the first one. Empty
+    files (from shards without any records) are skipped entirely.
+    """
+    with open(out_vcf, "wb") as of:
+        have_header = False
+        for vcf in vcfs:
+            with open(vcf, "rb") as vf:
+                if have_header:
+                    line = vf.readline()
+                    while line.startswith(b"#"):
+                        line = vf.readline()
+                    of.write(line)
+                shutil.copyfileobj(vf, of, 1024 * 1024)
+                have_header = have_header or vf.tell() > 0
+
+
+def _run_node(node: _MergeNode, options: _MergeOptions):
+    # Each node is one group of the merge plan, so its metrics record is labelled with where it sits in the plan
+    region = None if node.region is None else _describe_region(node.region)
+    with metrics.stage("merge_node", node=node.id, level=node.level, inputs=len(node.inputs), output=node.output,
+                       final=node.final, concat=node.concat, region=region, cost=node.cost):
+        return _execute_node(node, options)
+
+
+def _execute_node(node: _MergeNode, options: _MergeOptions):
+    if node.concat:
+        print(f"\tConcatenating {len(node.inputs)} shards to {node.output}", flush=True)
+        _concat_vcfs(node.inputs, node.output)
+        for vcf in node.inputs:
+            os.remove(vcf)
+        return node.output
+
+    if node.region is not None:
+        return _merge_shard(node.out_prefix, node.region, node.inputs, options)
+
+    # Only intermediates produced by other nodes get cleaned up; the original input VCFs are left alone.
+    remove_previous = bool(node.deps)
+
+    if not node.final and options.stream_intermediates:
+        return _merge_compress_streaming(node.out_prefix, node.inputs, options, remove_previous)
+
+    out_vcf = _merge(node.out_prefix, node.inputs, options, remove_previous)
+    return out_vcf if node.final else _compress(out_vcf)
+
+
+def _peak_rss() -> int:
+    # Peak resident set size in bytes of this process or any of its (finished) subprocesses, e.g. bgzip/bcftools
+    return metrics.peak_rss_bytes(
+        resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+
+
+def _run_node_timed(node: _MergeNode, options: _MergeOptions) -> Tuple[float, int]:
+    start = time.perf_counter()
+    _run_node(node, options)
+    return time.perf_counter() - start, _peak_rss()
+
+
+def _sample_count(vcf: str) -> int:
+    # Reads just the VCF header, to count the sample columns of the #CHROM line
+    try:
+        with (gzip.open(vcf, "rt") if vcf.endswith(".gz") else open(vcf, "r")) as fh:
+            for line in fh:
+                if line.startswith("#CHROM"):
+                    return max(len(line.rstrip("\n").split("\t")) - 9, 0)
+                if not line.startswith("#"):
+                    break
+    except (OSError, EOFError):
+        pass
+    return 0
+
+
+def _count_samples(nodes: List[_MergeNode], vcfs: List[str]):
+    # Each node's output holds all of the samples of its inputs, whether those are original VCFs or intermediates
+    samples = {vcf: _sample_count(vcf) for vcf in vcfs}
+    for node in nodes:
+        node.samples = sum(samples.get(i, 0) for i in node.inputs)
+        samples[node.output] = node.samples
+
+
+_MEM_BASE = 256 * 1024 ** 2  # Python interpreter, TRTools and its dependencies
+_MEM_PER_INPUT = 8 * 1024 ** 2  # Reader state and htslib buffers for each open VCF
+_MEM_PER_SAMPLE = 64 * 1024  # Per-sample header and record data held by the readers and the merge
+
+
+def _format_mem(n_bytes: float) -> str:
+    return f"{n_bytes / 1024 ** 2:.0f} MiB"
+
+
+class _MemoryModel:
+    """
+    Estimates the peak memory use of a merge from the number of inputs and samples it involves. Estimates start out
+    from fixed per-process, per-input and per-sample costs, and are scaled up or down to match the peak resident
+    set sizes measured for the merges which have finished so far (including any recorded by a previous run.)
+    """
+
+    def __init__(self):
+        self.ratios: List[float] = []
+
+    @staticmethod
+    def base_estimate(node: _MergeNode) -> int:
+        return _MEM_BASE + _MEM_PER_INPUT * len(node.inputs) + _MEM_PER_SAMPLE * node.samples
+
+    @property
+    def scale(self) -> float:
+        # Use the worst ratio seen so far; under-estimating risks getting workers OOM-killed, over-estimating only
+        # costs some concurrency.
+        return max(self.ratios) if self.ratios else 1.0
+
+    def estimate(self, node: _MergeNode) -> int:
+        return math.ceil(self.base_estimate(node) * self.scale)
+
+    def observe(self, node: _MergeNode, peak_rss: int):
+        self.ratios.append(peak_rss / self.base_estimate(node))
+
+
+# Merge throughput assumed until one has been measured, in bytes of input VCF per second (measured on the benchmark
+# suite's generated STR VCFs.)
+_DEFAULT_MERGE_RATES = {
+    ENGINE_MERGESTR: 512 * 1024,
+    ENGINE_BUILTIN: 1024 * 1024,
+}
+
+
+def _default_merge_rate(nodes: List[_MergeNode], engine: str) -> float:
+    # Merge tree costs are input sizes in bytes, so the default rate applies as-is. Shard costs are region lengths,
+    # so for sharded plans the rate is converted as if the input bytes were spread evenly across the shards.
+    rate = _DEFAULT_MERGE_RATES[engine]
+    shards = [n for n in nodes if n.region is not None]
+    if not shards:
+        return rate
+    input_bytes = sum(os.path.getsize(vcf) for vcf in shards[0].inputs if os.path.exists(vcf))
+    return rate * sum(n.cost for n in shards) / max(input_bytes, 1)
+
+
+class _ThroughputModel:
+    """
+    Predicts how long merges will take from their estimated costs. Predictions start out from a default merge rate,
+    and switch over to the throughput (cost per second) measured for the merges which have finished so far, including
+    any recorded by a previous run.
+    """
+
+    def __init__(self, default_rate: float):
+        self.default_rate = default_rate
+        self.cost = 0
+        self.time = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.cost / self.time if self.cost and self.time > 0 else self.default_rate
+
+    def predict(self, node: _MergeNode) -> Optional[float]:
+        # Concatenating shards has no cost estimate, so its time can't be predicted
+        return node.cost / self.rate if node.cost else None
+
+    def observe(self, node: _MergeNode, elapsed: float):
+        if node.cost:
+            self.cost += node.cost
+            self.time += elapsed
+
+
+_MANIFEST_VERSION = 1
+
+
+def _file_fingerprint(path: str) -> list:
+    try:
+        st = os.stat(path)
+        return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+    except OSError:
+        return [os.path.abspath(path), None, None]
+
+
+def _node_fingerprints(nodes: List[_MergeNode], vcf_type: str) -> Dict[str, str]:
+    """
+    Computes a fingerprint for each node from the paths, sizes and modification times of the original input VCFs
+    feeding into it, the fingerprints of the nodes it depends on and the merge options. Since intermediates are
+    fingerprinted through their dependencies rather than their own files, a node's fingerprint can still be computed
+    after the intermediates it consumed have been cleaned up.
+    """
+
+    fingerprints: Dict[str, str] = {}
+    outputs = {n.output: n.id for n in nodes}
+
+    for node in nodes:  # Nodes are in execution order, so dependencies are always fingerprinted first
+        fp = {
+            "version": _MANIFEST_VERSION,
+            "vcf_type": vcf_type,
+            "region": node.region,
+            "concat": node.concat,
+            "deps": [fingerprints.get(d) for d in node.deps],
+            "inputs": [_file_fingerprint(i) for i in node.inputs if i not in outputs],
+        }
+        fingerprints[node.id] = hashlib.sha256(json.dumps(fp).encode("utf-8")).hexdigest()
+
+    return fingerprints
+
+
+def _is_complete(output: str) -> bool:
+    # Intermediates are bgzipped and indexed; either being cut short (or missing) means the merge didn't finish
+    try:
+        if output.endswith(".gz"):
+            return has_bgzf_eof(output) and os.path.exists(f"{output}.tbi")
+        return os.path.exists(output)
+    except OSError:
+        return False
+
+
+class _MergeCheckpoint:
+    """
+    A JSON manifest of completed merge plan nodes, keyed by node ID, which allows a merge run to pick up where a
+    previous one left off. Nodes are only considered done if their fingerprint still matches and their output is
+    still present and unchanged since it was recorded.
+    """
+
+    def __init__(self, path: str, fingerprints: Dict[str, str], enabled: bool = True):
+        self.path = path
+        self.fingerprints = fingerprints
+        self.enabled = enabled
+        self.manifest = {"version": _MANIFEST_VERSION, "nodes": {}}
+
+        if enabled and os.path.exists(path):
+            try:
+                with open(path, "r") as fh:
+                    manifest = json.load(fh)
+                if manifest.get("version") == _MANIFEST_VERSION:
+                    self.manifest = manifest
+            except (OSError, ValueError):
+                print(f"\tWarning: could not read merge manifest {path}; starting from scratch", flush=True)
+
+    def is_done(self, node: _MergeNode) -> bool:
+        if not self.enabled:
+            return False
+
+        record = self.manifest["nodes"].get(node.id)
+        if record is None or record["fingerprint"] != self.fingerprints[node.id]:
+            return False
+
+        if _file_fingerprint(node.output)[1:] != record["output"]:
+            return False
+
+        return _is_complete(node.output)
+
+    def mark_done(self, node: _MergeNode, peak_rss: Optional[int] = None, elapsed: Optional[float] = None):
+        if not self.enabled:
+            return
+
+        self.manifest["nodes"][node.id] = {
+            "fingerprint": self.fingerprints[node.id],
+            "output": _file_fingerprint(node.output)[1:],
+            "peak_rss": peak_rss,
+            "elapsed": elapsed,
+        }
+        self._save()
+
+    def _recorded(self, node: _MergeNode, key: str):
+        # A measurement taken when the node was last run, if it was recorded for the same merge
+        record = self.manifest["nodes"].get(node.id)
+        if not self.enabled or record is None or record["fingerprint"] != self.fingerprints.get(node.id):
+            return None
+        return record.get(key)
+
+    def peak_rss(self, node: _MergeNode) -> Optional[int]:
+        return self._recorded(node, "peak_rss")
+
+    def elapsed(self, node: _MergeNode) -> Optional[float]:
+        return self._recorded(node, "elapsed")
+
+    def _save(self):
+        # Write the manifest atomically, so that an interrupted run can never leave a half-written one behind
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(self.manifest, fh, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def record_final(self, plan_key: str, node: _MergeNode):
+        # Remember which intermediates the final step needs, so that step 2 can be run separately without having to
+        # re-derive the same merge plan (e.g. with the same number of tasks.)
+        if not self.enabled:
+            return
+        self.manifest["final"] = {"plan": plan_key, "inputs": node.inputs, "deps": node.deps}
+        self._save()
+
+    def recorded_final(self, plan_key: str, node: _MergeNode) -> _MergeNode:
+        record = self.manifest.get("final")
+        if not self.enabled or record is None or record["plan"] != plan_key:
+            return node
+        return replace(node, inputs=record["inputs"], deps=record["deps"])
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _models_from_checkpoint(
+        nodes: List[_MergeNode],
+        options: _MergeOptions,
+        checkpoint: _MergeCheckpoint,
+) -> Tuple[_MemoryModel, _ThroughputModel]:
+    # Peak memory use and run times measured by a previous, interrupted run give us a head start on refining estimates
+    memory = _MemoryModel()
+    throughput = _ThroughputModel(_default_merge_rate(nodes, options.engine))
+    for node in nodes:
+        peak_rss = checkpoint.peak_rss(node)
+        if peak_rss is not None:
+            memory.observe(node, peak_rss)
+        elapsed = checkpoint.elapsed(node)
+        if elapsed is not None:
+            throughput.observe(node, elapsed)
+    return memory, throughput
+
+
+def _nodes_to_run(nodes: List[_MergeNode], targets: List[_MergeNode], checkpoint: _MergeCheckpoint):
+    """
+    Finds the nodes which need to run to produce the target nodes' outputs, skipping any node which was completed
+    by a previous run (along with everything it depended on.) Returns nodes in execution order.
+    """
+
+    by_id = {n.id: n for n in nodes}
+    needed = set()
+    to_visit = list(targets)
+
+    while to_visit:
+        node = to_visit.pop()
+        if node.id in needed or checkpoint.is_done(node):
+            continue
+        needed.add(node.id)
+        to_visit.extend(by_id[d] for d in node.deps)
+
+    return [n for n in nodes if n.id in needed]
+
+
+def _format_prediction(predicted: Optional[float]) -> str:
+    return f"{predicted:.1f}s" if predicted is not None else "unknown"
+
+
+def _run_merge_tree(
+        nodes: List[_MergeNode],
+        options: _MergeOptions,
+        ntasks: int,
+        checkpoint: Optional[_MergeCheckpoint] = None,
+        max_mem: Optional[int] = None,
+        memory: Optional[_MemoryModel] = None,
+        throughput: Optional[_ThroughputModel] = None,
+):
+    """
+    Runs a set of merge tree nodes in a process pool, starting each node as soon as all of its dependencies have
+    finished rather than waiting for the whole previous level. Dependencies which are not part of the set of nodes
+    passed are assumed to have been completed already (e.g. by a previous --step1-only run.)
+    Ready nodes are queued longest-first (by estimated cost), so that workers finish at around the same time.
+    Predicted times come from the throughput model: a default merge rate until merges have been timed, then the
+    throughput (cost per second) measured so far.
+    If a memory budget (in bytes) is given, a node is only started if its estimated peak memory use fits alongside
+    the estimates of the merges already running; if nothing is running, the next node is started regardless.
+    """
+
+    if not nodes:
+        return
+
+    if memory is None:
+        memory = _MemoryModel()
+    if throughput is None:
+        throughput = _ThroughputModel(_default_merge_rate(nodes, options.engine))
+
+    node_ids = {n.id for n in nodes}
+    remaining = [n for n in nodes]
+    done = set()
+    finished: queue.Queue = queue.Queue()
+    n_running = 0
+
+    predictions: Dict[str, Optional[float]] = {}
+
+    reserved = 0
+    reservations: Dict[str, int] = {}
+
+    # With a memory budget, each merge gets a fresh worker process, so that its measured peak RSS is its own.
+    with multiprocessing.Pool(ntasks, maxtasksperchild=1 if max_mem is not None else None) as p:
+        while remaining or n_running:
+            ready = [n for n in remaining if all(d in done or d not in node_ids for d in n.deps)]
+            ready.sort(key=lambda n: n.cost, reverse=True)
+
+            for node in ready:
+                mem_note = ""
+
+                if max_mem is not None:
+                    if n_running >= ntasks:
+                        break
+
+                    estimate = memory.estimate(node)
+                    if n_running and reserved + estimate > max_mem:
+                        continue  # Try a smaller merge instead, or wait for running ones to free up memory
+
+                    if estimate > max_mem:
+                        print(f"\tWarning: level {node.level} merge {node.output} is estimated to need "
+                              f"{_format_mem(estimate)}, more than the memory budget of {_format_mem(max_mem)}",
+                              flush=True)
+
+                    reserved += estimate
+                    reservations[node.id] = estimate
+                    mem_note = f", estimated memory: {_format_mem(estimate)}"
+
+                remaining.remove(node)
+                predictions[node.id] = throughput.predict(node)
+                print(f"\tQueued level {node.level} merge {node.output} ({len(node.inputs)} inputs, "
+                      f"predicted time: {_format_prediction(predictions[node.id])}{mem_note})", flush=True)
+                p.apply_async(
+                    metrics.wrap(_run_node_timed),
+                    (node, options),
+                    callback=lambda res, n=node: finished.put((n, res, None)),
+                    error_callback=lambda e, n=node: finished.put((n, None, e)))
+                n_running += 1
+
+            node, res, err = finished.get()
+            n_running -= 1
+
+            if err is not None:
+                raise err
+
+            elapsed, peak_rss = metrics.unwrap(res)
+            mem_note = ""
+
+            if max_mem is not None:
+                estimate = reservations.pop(node.id)
+                reserved -= estimate
+                memory.observe(node, peak_rss)
+                mem_note = f"; peak memory: {_format_mem(peak_rss)}, estimated: {_format_mem(estimate)}"
+
+            print(f"\tFinished level {node.level} merge {node.output} in {elapsed:.1f}s "
+                  f"(predicted: {_format_prediction(predictions[node.id])}{mem_note})", flush=True)
+
+            if checkpoint is not None:
+                checkpoint.mark_done(node, peak_rss if max_mem is not None else None, elapsed)
+
+            done.add(node.id)
+            throughput.observe(node, elapsed)
+
+
+def _run_plan(
+        nodes: List[_MergeNode],
+        options: _MergeOptions,
+        ntasks: int,
+        run_step_1: bool,
+        run_step_2: bool,
+        checkpoint: _MergeCheckpoint,
+        plan_key: str,
+        max_mem: Optional[int] = None,
+):
+    final = nodes[-1]
+
+    if run_step_1:
+        # Step 1 is every node except the final one, unless a single merge is all we need
+        step_1_targets = [final] if len(nodes) == 1 else [n for n in nodes if n.id in final.deps]
+        step_1_nodes = _nodes_to_run(nodes, step_1_targets, checkpoint)
+
+        n_skipped = len(nodes) - (len(nodes) > 1) - len(step_1_nodes)
+        if n_skipped:
+            print(f"\tReusing outputs of {n_skipped} merge(s) completed by a previous run", flush=True)
+
+        memory, throughput = _models_from_checkpoint(nodes, options, checkpoint)
+
+        with metrics.stage("step_1", nodes=len(step_1_nodes), ntasks=ntasks):
+            _run_merge_tree(step_1_nodes, options, ntasks, checkpoint, max_mem, memory, throughput)
+
+        if len(nodes) == 1:
+            print("\tStep 1 finished with only 1 output; step 2 is not needed")
+            checkpoint.remove()
+            return
+
+        checkpoint.record_final(plan_key, final)
+
+    elif run_step_2:
+        final = checkpoint.recorded_final(plan_key, final)
+
+    if run_step_2 and final.deps:
+        # All intermediates are ready - time to merge them! This runs in-process since it is a single step.
+        with metrics.stage("step_2"):
+            _run_node(final, options)
+        checkpoint.remove()
+
+
+def _require_mergestr():
+    if mergestr_main is None:
+        raise BCFExtrasDependencyError("Could not import trtools.mergeSTR.mergeSTR:main (missing TRTools dependency?)")
+
+
+def _check_plan_options(engine: str, fan_in: Optional[int], shard: bool, shard_size: Optional[int]):
+    if engine not in MERGE_ENGINES:
+        raise BCFExtrasInputError(f"Unknown merge engine: {engine} (must be one of {', '.join(MERGE_ENGINES)})")
+
+    if fan_in is not None and fan_in < 2:
+        raise BCFExtrasInputError("Merge fan-in must be at least 2")
+
+    if shard_size is not None and shard_size < 1:
+        raise BCFExtrasInputError("Shard size must be a positive number of bases")
+
+    if (shard or shard_size is not None) and fan_in is not None:
+        raise BCFExtrasInputError("Cannot specify a merge fan-in when sharding by region")
+
+
+def _default_intermediate_prefix(out: str, intermediate_prefix: Optional[str], tmp_dir: Optional[str]) -> str:
+    if intermediate_prefix is not None:
+        return intermediate_prefix
+    intermediate_prefix = f"pmerge_intermediate_{os.path.basename(out)}"
+    return os.path.join(tmp_dir, intermediate_prefix) if tmp_dir else intermediate_prefix
+
+
+def _clamp_ntasks(ntasks: int) -> int:
+    return min(max(ntasks, 2), 512)  # Keep ntasks between 2 and 512 inclusive
+
+
+def _build_plan(
+        vcfs: List[str],
+        out: str,
+        intermediate_prefix: str,
+        ntasks: int,
+        fan_in: Optional[int],
+        shard: bool,
+        shard_size: Optional[int],
+) -> List[_MergeNode]:
+    if shard:
+        nodes = _build_shard_plan(vcfs, out, intermediate_prefix, shard_size)
+        print(f"\tSplit inputs into {len(nodes) - 1} region shards")
+        return nodes
+
+    group_size = max(math.floor(len(vcfs) / ntasks), 1)
+    if fan_in is not None:
+        group_size = min(group_size, fan_in)
+    nodes = _build_merge_tree(vcfs, out, intermediate_prefix, group_size, fan_in, weights=_input_weights(vcfs))
+    print(f"\tMerge tree has {nodes[-1].level + 1} level(s) (group size: {group_size})")
+    return nodes
+
+
 def parallel_mergestr(
         vcfs: List[str],
         out: str,
@@ -72,27 +1057,36 @@ def parallel_mergestr(
         step_1_only: bool = False,
         step_2_only: bool = False,
         intermediate_prefix: Optional[str] = None,
+        fan_in: Optional[int] = None,
+        shard: bool = False,
+        shard_size: Optional[int] = None,
+        resume: bool = True,
+        tmp_dir: Optional[str] = None,
+        stream_intermediates: bool = False,
+        engine: str = ENGINE_MERGESTR,
+        max_mem: Optional[int] = None,
 ):
-    if mergestr_main is None:
-        raise BCFExtrasDependencyError("Could not import trtools.mergeSTR.mergeSTR:main (missing TRTools dependency?)")
+    _require_mergestr()
 
     if step_1_only and step_2_only:
         raise BCFExtrasInputError("Cannot specify both --step1-only and --step2-only")
 
+    _check_plan_options(engine, fan_in, shard, shard_size)
+
+    if max_mem is not None and max_mem < 1:
+        raise BCFExtrasInputError("Memory budget must be a positive number of bytes")
+
+    shard = shard or shard_size is not None
+
     run_step_1 = step_1_only or not (step_1_only or step_2_only)
     run_step_2 = step_2_only or not (step_1_only or step_2_only)
 
-    if intermediate_prefix is None:
-        intermediate_prefix = f"pmerge_intermediate_{out}"
-
-    ntasks = min(max(ntasks, 2), 512)  # Keep ntasks between 2 and 512 inclusive
-    group_size = math.floor(len(vcfs) / ntasks)
-    initial_merges = _merge_small_last(
-        [vcfs[i:i+group_size] for i in range(0, len(vcfs), group_size)], group_size)
+    intermediate_prefix = _default_intermediate_prefix(out, intermediate_prefix, tmp_dir)
+    ntasks = _clamp_ntasks(ntasks)
 
     start_time = datetime.utcnow()
 
-    print(f"Running parallel-mergeSTR with {ntasks} processes (group size: {group_size}, output: {out})")
+    print(f"Running {'region-sharded ' if shard else ''}parallel-mergeSTR with {ntasks} processes (output: {out})")
     print(f"\tStarted at {start_time}Z")
 
     if step_1_only:
@@ -100,32 +1094,205 @@ def parallel_mergestr(
     elif step_2_only:
         print("\tRunning step 2 only (bottlenecked final merge step; single-core only)")
 
-    # TODO: This could be slightly more efficient if it allowed the second level to process at the same time... oh well
+    with metrics.stage("plan", inputs=len(vcfs), shard=shard):
+        nodes = _build_plan(vcfs, out, intermediate_prefix, ntasks, fan_in, shard, shard_size)
 
-    intermediate_vcf_names = [_intermediate_file_name(intermediate_prefix, idx) for idx in range(len(initial_merges))]
+        if max_mem is not None:
+            _count_samples(nodes, vcfs)
+            print(f"\tScheduling merges within a memory budget of {_format_mem(max_mem)}")
 
-    if run_step_1:
-        with multiprocessing.Pool(ntasks) as p:
-            init_merge_jobs = [
-                p.apply_async(_merge, (out_name, vcfs, vcf_type, False))
-                for vcfs, out_name in zip(initial_merges, intermediate_vcf_names)
-            ]
-            init_outputs = [j.get() for j in init_merge_jobs]
-
-            if len(init_outputs) > 1:
-                compress_jobs = [p.apply_async(_compress, (vcf,)) for vcf in init_outputs]
-                for j in compress_jobs:
-                    j.get()
-
-        if len(initial_merges) == 1:
-            # Don't merge a single file, rename instead
-            os.rename(f"{intermediate_vcf_names[0]}.vcf", f"{out}.vcf")
-            print("\tStep 1 finished with only 1 output; step 2 is not needed")
+        checkpoint = _MergeCheckpoint(
+            f"{intermediate_prefix}.manifest.json", _node_fingerprints(nodes, vcf_type), enabled=resume)
+
+    plan_key = hashlib.sha256(json.dumps({
+        "vcf_type": vcf_type,
+        "shard": shard,
+        "inputs": [_file_fingerprint(v) for v in vcfs],
+    }).encode("utf-8")).hexdigest()
 
-    if run_step_2 and len(initial_merges) > 1:
-        # We've now merged every group_size VCFs into intermediate files - time to merge those!
-        _merge(out, [f"{ivn}.vcf.gz" for ivn in intermediate_vcf_names], vcf_type, True)
+    options = _MergeOptions(vcf_type=vcf_type, stream_intermediates=stream_intermediates, engine=engine)
+
+    _run_plan(nodes, options, ntasks, run_step_1, run_step_2, checkpoint, plan_key, max_mem)
 
     end_time = datetime.utcnow()
 
     print(f"\tFinished at {end_time}Z (took {end_time - start_time})")
+
+
+PLAN_SCHEMA = "bcf-extras-merge-plan"
+_PLAN_VERSION = 1
+
+
+def _node_to_json(node: _MergeNode, vcfs: List[str]) -> dict:
+    return {
+        "id": node.id,
+        "level": node.level,
+        "out_prefix": node.out_prefix,
+        "output": node.output,
+        # Every region shard merges all of the plan's inputs; listing them again for each shard would make plans for
+        # large cohorts enormous
+        "inputs": None if node.region is not None and node.inputs == vcfs else node.inputs,
+        "deps": node.deps,
+        "final": node.final,
+        "concat": node.concat,
+        "region": node.region,
+        "cost": node.cost,
+        "samples": node.samples,
+        "estimated_memory": _MemoryModel.base_estimate(node),
+    }
+
+
+def _node_from_json(record: dict, vcfs: List[str]) -> _MergeNode:
+    return _MergeNode(
+        id=record["id"],
+        out_prefix=record["out_prefix"],
+        level=record["level"],
+        inputs=list(vcfs) if record["inputs"] is None else record["inputs"],
+        deps=record["deps"],
+        final=record["final"],
+        cost=record["cost"],
+        region=None if record["region"] is None else tuple(record["region"]),
+        concat=record["concat"],
+        samples=record["samples"],
+    )
+
+
+def plan_mergestr(
+        vcfs: List[str],
+        out: str,
+        plan_path: str,
+        vcf_type: str = "auto",
+        ntasks: int = 2,
+        intermediate_prefix: Optional[str] = None,
+        fan_in: Optional[int] = None,
+        shard: bool = False,
+        shard_size: Optional[int] = None,
+        tmp_dir: Optional[str] = None,
+        stream_intermediates: bool = False,
+        engine: str = ENGINE_MERGESTR,
+) -> dict:
+    """
+    Plans a merge the same way parallel_mergestr would, and writes the plan to a JSON file instead of running it.
+    The plan lists every merge (node) with its inputs, output, the nodes it depends on and its estimated cost and
+    peak memory use, in a valid execution order; nodes are also listed level by level, since each level's nodes
+    only depend on nodes of earlier levels. The plan can be run by run_merge_plan, or one node at a time (e.g. as the
+    tasks of a cluster array job, one job per level) by run_merge_plan_node.
+    Paths in the plan are absolute, so that nodes can be run from any working directory.
+    :return: The plan, as written.
+    """
+
+    _check_plan_options(engine, fan_in, shard, shard_size)
+
+    if not vcfs:
+        raise BCFExtrasInputError("Cannot plan a merge without any VCFs")
+
+    vcfs = [os.path.abspath(v) for v in vcfs]
+    out = os.path.abspath(out)
+    intermediate_prefix = os.path.abspath(_default_intermediate_prefix(out, intermediate_prefix, tmp_dir))
+    shard = shard or shard_size is not None
+
+    with metrics.stage("plan", inputs=len(vcfs), shard=shard):
+        nodes = _build_plan(vcfs, out, intermediate_prefix, _clamp_ntasks(ntasks), fan_in, shard, shard_size)
+        _count_samples(nodes, vcfs)
+
+    levels: List[List[str]] = [[] for _ in range(nodes[-1].level + 1)]
+    for node in nodes:
+        levels[node.level].append(node.id)
+
+    plan = {
+        "schema": PLAN_SCHEMA,
+        "version": _PLAN_VERSION,
+        "out": out,
+        "options": {"vcf_type": vcf_type, "stream_intermediates": stream_intermediates, "engine": engine},
+        "manifest": f"{intermediate_prefix}.manifest.json",
+        "vcfs": vcfs,
+        "levels": levels,
+        "nodes": [_node_to_json(n, vcfs) for n in nodes],
+    }
+
+    # Written atomically, so that a scheduler can never pick up a half-written plan
+    tmp_path = f"{plan_path}.tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump(plan, fh, indent=2)
+    os.replace(tmp_path, plan_path)
+
+    print(f"\tWrote merge plan with {len(nodes)} node(s) in {len(levels)} level(s) to {plan_path}")
+    return plan
+
+
+def _load_plan(plan_path: str) -> Tuple[dict, List[_MergeNode], _MergeOptions]:
+    with open(plan_path, "r") as fh:
+        plan = json.load(fh)
+
+    if plan.get("schema") != PLAN_SCHEMA or plan.get("version") != _PLAN_VERSION:
+        raise BCFExtrasInputError(f"{plan_path} is not a merge plan (or is from an incompatible version)")
+
+    nodes = [_node_from_json(record, plan["vcfs"]) for record in plan["nodes"]]
+    options = _MergeOptions(**plan["options"])
+    if options.engine not in MERGE_ENGINES:
+        raise BCFExtrasInputError(f"Unknown merge engine in plan: {options.engine}")
+
+    return plan, nodes, options
+
+
+def run_merge_plan_node(plan_path: str, node_id: Optional[str] = None, level: Optional[int] = None,
+                        index: Optional[int] = None) -> str:
+    """
+    Runs a single node of a merge plan written by plan_mergestr, picked either by its ID or by its level and its
+    index within that level (e.g. a cluster array job's task index.) All of the nodes it depends on must have
+    finished already.
+    :return: The output of the node.
+    """
+
+    _require_mergestr()
+
+    if (node_id is None) == (level is None or index is None):
+        raise BCFExtrasInputError("Specify either a plan node ID, or a plan level and an index within it")
+
+    plan, nodes, options = _load_plan(plan_path)
+    by_id = {n.id: n for n in nodes}
+
+    if node_id is None:
+        if not (0 <= level < len(plan["levels"]) and 0 <= index < len(plan["levels"][level])):
+            raise BCFExtrasInputError(f"Merge plan {plan_path} has no node {index} at level {level}")
+        node_id = plan["levels"][level][index]
+
+    node = by_id.get(node_id)
+    if node is None:
+        raise BCFExtrasInputError(f"Merge plan {plan_path} has no node {node_id}")
+
+    for dep in node.deps:
+        if not _is_complete(by_id[dep].output):
+            raise BCFExtrasInputError(
+                f"Cannot run merge plan node {node.id}: node {dep}, which it depends on, has not finished")
+
+    print(f"\tRunning level {node.level} merge {node.output} ({len(node.inputs)} inputs)", flush=True)
+    return _run_node(node, options)
+
+
+def run_merge_plan(plan_path: str, ntasks: int = 2, max_mem: Optional[int] = None, resume: bool = True):
+    """
+    Runs a whole merge plan written by plan_mergestr on this machine, with a process pool of ntasks workers. Each
+    node starts as soon as the nodes it depends on have finished. As with parallel_mergestr, finished nodes are
+    recorded in a manifest, so that re-running an interrupted run only runs what is left.
+    """
+
+    _require_mergestr()
+
+    if ntasks < 1:
+        raise BCFExtrasInputError("ntasks must be at least 1")
+    if max_mem is not None and max_mem < 1:
+        raise BCFExtrasInputError("Memory budget must be a positive number of bytes")
+
+    plan, nodes, options = _load_plan(plan_path)
+    checkpoint = _MergeCheckpoint(plan["manifest"], _node_fingerprints(nodes, options.vcf_type), enabled=resume)
+
+    to_run = _nodes_to_run(nodes, [nodes[-1]], checkpoint)
+    if len(to_run) < len(nodes):
+        print(f"\tReusing outputs of {len(nodes) - len(to_run)} merge(s) completed by a previous run", flush=True)
+
+    memory, throughput = _models_from_checkpoint(nodes, options, checkpoint)
+
+    with metrics.stage("run_plan", nodes=len(to_run), ntasks=ntasks):
+        _run_merge_tree(to_run, options, ntasks, checkpoint, max_mem, memory, throughput)
+    checkpoint.remove()
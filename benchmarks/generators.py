@@ -0,0 +1,180 @@
+"""
+Deterministic generators for synthetic benchmark inputs. The same arguments (including the seed) always produce the
+same file, so timings from different runs and machines are comparable.
+"""
+
+import random
+import shutil
+import subprocess
+
+from typing import List, Sequence
+
+from bcf_extras.bgzf import BGZF_EOF, compress_blocks
+
+__all__ = [
+    "write_gff3",
+    "write_vcf",
+    "write_str_vcfs",
+    "bgzip_index",
+    "have_htslib",
+]
+
+
+FEATURE_TYPES = ("gene", "transcript", "exon", "CDS", "five_prime_UTR", "three_prime_UTR")
+GENE_TYPES = ("protein_coding", "lncRNA", "miRNA", "processed_pseudogene")
+
+CONTIGS = (("chr1", 248956422), ("chr2", 242193529), ("chr3", 198295559), ("chrX", 156040895))
+
+STR_HEADER = """##fileformat=VCFv4.1
+##command=GangSTR --bam sample.bam --ref ref.fa --regions regions.bed
+{contigs}
+##INFO=<ID=END,Number=1,Type=Integer,Description="End position of variant">
+##INFO=<ID=RU,Number=1,Type=String,Description="Repeat motif">
+##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="Repeat period (length of motif)">
+##INFO=<ID=REF,Number=1,Type=Float,Description="Reference copy number">
+##INFO=<ID=EXPTHRESH,Number=1,Type=Integer,Description="Threshold for calling expansions">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">
+##FORMAT=<ID=Q,Number=1,Type=Float,Description="Min joint likelihood">
+##FORMAT=<ID=REPCN,Number=2,Type=Integer,Description="Genotype given in number of copies of the repeat motif">
+##FORMAT=<ID=REPCI,Number=1,Type=String,Description="Confidence interval for REPCN">
+##FORMAT=<ID=RC,Number=1,Type=String,Description="Number of reads in each class">
+##FORMAT=<ID=ML,Number=1,Type=Float,Description="Maximum likelihood">
+##FORMAT=<ID=INS,Number=2,Type=Float,Description="Insert size mean and stddev">
+"""
+
+SNV_HEADER = """##fileformat=VCFv4.2
+{contigs}
+##INFO=<ID=DP,Number=1,Type=Integer,Description="Total depth">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">
+##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype quality">
+"""
+
+MOTIFS = ("AC", "AT", "AGAT", "AAAG", "CAG", "GGCCCC")
+
+
+def write_gff3(path: str, n_features: int, comment_density: float = 0.0, seed: int = 1, gzipped: bool = False):
+    """
+    Writes a synthetic, GENCODE-like GFF3 file with n_features records in random (unsorted) order.
+    :param comment_density: The chance of a comment line being written after each record.
+    :param gzipped: Whether to BGZF-compress the output.
+    """
+
+    rng = random.Random(seed)
+    lines = ["##gff-version 3\n", *(f"##sequence-region {c} 1 {length}\n" for c, length in CONTIGS)]
+    for i in range(n_features):
+        contig, length = rng.choice(CONTIGS)
+        start = rng.randint(1, length - 5000)
+        lines.append("\t".join((
+            contig,
+            "HAVANA",
+            rng.choice(FEATURE_TYPES),
+            str(start),
+            str(start + rng.randint(50, 5000)),
+            str(rng.randint(0, 100)) if rng.random() < 0.5 else ".",
+            rng.choice("+-"),
+            ".",
+            f"ID=feat{i};gene_id=ENSG{i // 10:011d};gene_type={rng.choice(GENE_TYPES)};gene_name=G{i // 10}",
+        )) + "\n")
+        if comment_density and rng.random() < comment_density:
+            lines.append(f"# synthetic comment {i}\n")
+
+    data = "".join(lines).encode("utf-8")
+    with open(path, "wb") as fh:
+        if gzipped:
+            for block in compress_blocks(data):
+                fh.write(block)
+            fh.write(BGZF_EOF)
+        else:
+            fh.write(data)
+
+
+def _contig_lines() -> str:
+    return "\n".join(f"##contig=<ID={c},length={length}>" for c, length in CONTIGS)
+
+
+def _str_sample(rng: random.Random, alleles: List[int], a: int, b: int) -> str:
+    return (
+        f"{alleles.index(a)}/{alleles.index(b)}:{rng.randint(1, 60)}:{rng.random():.4f}:{a},{b}:{a}-{a},{b}-{b}:"
+        f"1,2,0,3:{rng.random() * 100:.2f}:{rng.randint(300, 500)}.0,{rng.random() * 50:.2f}")
+
+
+def write_vcf(path: str, samples: Sequence[str], n_records: int, n_header_lines: int = 0, str_fields: bool = True,
+              seed: int = 1, missing_rate: float = 0.0, shuffled: bool = False):
+    """
+    Writes a synthetic VCF.
+    :param samples: Sample names.
+    :param n_records: Number of records (loci); they are spread evenly over the contigs, in order unless shuffled.
+    :param n_header_lines: Number of extra ## header lines, for making the header arbitrarily large.
+    :param str_fields: Whether to write GangSTR-style STR records (as used by TRTools) rather than plain SNVs.
+    :param seed: Random seed; genotypes and record order are determined entirely by it.
+    :param missing_rate: Fraction of records to leave out, so files for different samples have different loci.
+    :param shuffled: Whether to write records in random order (e.g. for benchmarking sorting.)
+    """
+
+    rng = random.Random(seed)
+    header = (STR_HEADER if str_fields else SNV_HEADER).format(contigs=_contig_lines())
+    header += "".join(f"##bench_filler_{i}=<Description=\"Filler header line {i}\">\n" for i in range(n_header_lines))
+    header += "\t".join(("#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", *samples)) + "\n"
+
+    per_contig = -(-n_records // len(CONTIGS))
+    records = []
+    for i in range(n_records):
+        contig, length = CONTIGS[i // per_contig]
+        pos = 10000 + (i % per_contig) * ((length - 20000) // per_contig)
+        # Always drawn, so that genotypes don't depend on missing_rate
+        skip = rng.random() < missing_rate
+
+        if str_fields:
+            motif = MOTIFS[i % len(MOTIFS)]
+            ref_cn = 5
+            cns = [(rng.randint(3, 8), rng.randint(3, 8)) for _ in samples]
+            alts = sorted({cn for pair in cns for cn in pair if cn != ref_cn})
+            alleles = [ref_cn, *alts]
+            sample_cols = [_str_sample(rng, alleles, a, b) if rng.random() >= 0.05 else "." for a, b in cns]
+            record = "\t".join((
+                contig, str(pos), ".", motif * ref_cn, ",".join(motif * cn for cn in alts) or ".", ".", "PASS",
+                f"END={pos + len(motif) * ref_cn - 1};RU={motif};PERIOD={len(motif)};REF={ref_cn};EXPTHRESH=-1",
+                "GT:DP:Q:REPCN:REPCI:RC:ML:INS", *sample_cols))
+        else:
+            sample_cols = [f"{rng.randint(0, 1)}/{rng.randint(0, 1)}:{rng.randint(1, 60)}:{rng.randint(1, 99)}"
+                           for _ in samples]
+            record = "\t".join((
+                contig, str(pos), ".", "A", "G", str(rng.randint(10, 60)), "PASS", f"DP={rng.randint(10, 500)}",
+                "GT:DP:GQ", *sample_cols))
+
+        if not skip:
+            records.append(record + "\n")
+
+    if shuffled:
+        rng.shuffle(records)
+
+    with open(path, "w") as fh:
+        fh.write(header)
+        fh.writelines(records)
+
+
+def write_str_vcfs(directory: str, n_files: int, samples_per_file: int, n_records: int, seed: int = 1) -> List[str]:
+    """
+    Writes a set of bgzipped, indexed GangSTR-style VCFs, each with its own samples but mostly shared loci, as input
+    for merging.
+    """
+
+    vcfs = []
+    for f in range(n_files):
+        path = f"{directory}/str_{f}.vcf"
+        write_vcf(path, [f"f{f}_s{s}" for s in range(samples_per_file)], n_records, seed=seed * 1000 + f,
+                  missing_rate=0.2)
+        vcfs.append(bgzip_index(path))
+    return vcfs
+
+
+def bgzip_index(path: str) -> str:
+    subprocess.check_call(["bgzip", "-f", path])
+    subprocess.check_call(["tabix", "-f", "-p", "vcf", f"{path}.gz"])
+    return f"{path}.gz"
+
+
+def have_htslib() -> bool:
+    return all(shutil.which(tool) is not None for tool in ("bcftools", "bgzip", "tabix"))
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+"""
+Benchmark suite for bcf-extras sub-commands, on deterministic synthetic inputs. Run from the repository root:
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --baseline results.json --threshold 0.2
+
+Results are saved as JSON. Given a baseline from an earlier run, any case which got slower than the threshold
+allows makes the run exit with status 1, so it can fail a build. Cases needing tools which aren't available
+(htslib/bcftools, TRTools) are reported as skipped.
+"""
+
+import argparse
+import contextlib
+import glob
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bcf_extras.add_header_lines import add_header_lines
+from bcf_extras.copy_compress_index import copy_compress_index
+from bcf_extras.filter_gff3 import filter_gff3
+from bcf_extras.gff3_index import GFF3Index, index_gff3
+from bcf_extras.output_formats import OUTPUT_BCF, OUTPUT_BOTH, OUTPUT_VCF
+from bcf_extras.parallel_mergestr import ENGINE_BUILTIN, ENGINE_MERGESTR, mergestr_main, parallel_mergestr
+
+from .generators import have_htslib, write_gff3, write_str_vcfs, write_vcf
+
+RESULTS_VERSION = 1
+
+# Cases faster than this (in both runs) aren't checked against the threshold, since they are mostly noise
+MIN_COMPARED_SECONDS = 0.05
+
+
+@dataclass
+class Case:
+    name: str
+    setup: Callable[[str, float], Any]  # (temporary directory, scale) -> state for run/reset
+    run: Callable[[Any], None]
+    reset: Optional[Callable[[Any], None]] = None  # Called (untimed) before each run, e.g. to restore inputs
+    requires: Callable[[], Optional[str]] = lambda: None  # Returns why the case can't run, if it can't
+
+
+def _requires_htslib() -> Optional[str]:
+    return None if have_htslib() else "bcftools, bgzip and tabix are required"
+
+
+def _requires_trtools() -> Optional[str]:
+    return _requires_htslib() or (None if mergestr_main is not None else "TRTools is required")
+
+
+def _n(base: int, scale: float) -> int:
+    return max(1, int(base * scale))
+
+
+# filter-gff3 / index-gff3 / query-gff3 --------------------------------------------------------------------------------
+
+def _filter_gff3(gff: str, **kwargs):
+    args = {k: kwargs.pop(k, None) for k in ("seq_id", "source", "feature_type", "strand", "phase")}
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        filter_gff3(gff, **args, **kwargs)
+
+
+def _gff3_setup(comment_density: float = 0.0, gzipped: bool = False) -> Callable[[str, float], str]:
+    def _setup(tmp: str, scale: float) -> str:
+        gff = os.path.join(tmp, "bench.gff3.gz" if gzipped else "bench.gff3")
+        write_gff3(gff, _n(300_000, scale), comment_density=comment_density, gzipped=gzipped)
+        return gff
+    return _setup
+
+
+def _fg3_case(name: str, comment_density: float = 0.0, gzipped: bool = False, **kwargs) -> Case:
+    return Case(f"filter-gff3: {name}", _gff3_setup(comment_density, gzipped), lambda gff: _filter_gff3(gff, **kwargs))
+
+
+def _fg3_indexed_output(gff: str):
+    _filter_gff3(gff, feature_type="^(gene|exon)$", output=f"{gff}.out.gff3.gz", index=True)
+
+
+def _ig3_setup(tmp: str, scale: float) -> Tuple[str, List[str]]:
+    gff = _gff3_setup()(tmp, scale)
+    index_gff3(gff)
+    return gff, [f"feat{i}" for i in range(0, _n(300_000, scale), 97)]
+
+
+def _ig3_queries(state: Tuple[str, List[str]]):
+    gff, ids = state
+    with GFF3Index(gff) as idx:
+        for i, feature_id in enumerate(ids):
+            list(idx.records(idx.feature(feature_id)))
+            list(idx.records(idx.overlapping("chr1", i * 10000 + 1, i * 10000 + 50000)))
+
+
+# add-header-lines -----------------------------------------------------------------------------------------------------
+
+_AHL_LINES = "##bench_added=<Description=\"Added by the benchmark\">\n"
+
+
+def _ahl_setup(n_files: int) -> Callable[[str, float], Tuple[str, List[str]]]:
+    def _setup(tmp: str, scale: float) -> Tuple[str, List[str]]:
+        d = os.path.join(tmp, f"ahl_{n_files}")
+        os.makedirs(os.path.join(d, "orig"))
+        vcfs = []
+        for f in range(n_files):
+            path = os.path.join(d, "orig", f"ahl_{f}.vcf")
+            write_vcf(path, [f"s{s}" for s in range(20)], _n(200_000 // n_files, scale), n_header_lines=200, seed=f)
+            subprocess.check_call(["bgzip", "-f", path])
+            subprocess.check_call(["tabix", "-f", "-p", "vcf", f"{path}.gz"])
+            vcfs.append(os.path.join(d, f"ahl_{f}.vcf.gz"))
+        with open(os.path.join(d, "lines.txt"), "w") as fh:
+            fh.write(_AHL_LINES)
+        return d, vcfs
+    return _setup
+
+
+def _ahl_reset(state: Tuple[str, List[str]]):
+    d, _ = state
+    for path in glob.glob(os.path.join(d, "*.gz*")):
+        os.remove(path)
+    for path in glob.glob(os.path.join(d, "orig", "*")):
+        shutil.copy(path, d)
+
+
+def _ahl_run(ntasks: int) -> Callable[[Tuple[str, List[str]]], None]:
+    def _run(state: Tuple[str, List[str]]):
+        d, vcfs = state
+        add_header_lines(vcfs if len(vcfs) > 1 else vcfs[0], os.path.join(d, "lines.txt"), delete_old=True,
+                         ntasks=ntasks)
+    return _run
+
+
+# copy-compress-index --------------------------------------------------------------------------------------------------
+
+def _cci_setup(shuffled: bool = True) -> Callable[[str, float], List[str]]:
+    def _setup(tmp: str, scale: float) -> List[str]:
+        d = os.path.join(tmp, "cci")
+        os.makedirs(d)
+        vcfs = []
+        for f in range(4):
+            path = os.path.join(d, f"cci_{f}.vcf")
+            write_vcf(path, [f"s{s}" for s in range(50)], _n(25_000, scale), str_fields=False, seed=f,
+                      shuffled=shuffled)
+            vcfs.append(path)
+        return vcfs
+    return _setup
+
+
+def _cci_run(ntasks: int, output_format: str = OUTPUT_VCF) -> Callable[[List[str]], None]:
+    def _run(vcfs: List[str]):
+        with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+            copy_compress_index(vcfs, ntasks=ntasks, output_format=output_format)
+    return _run
+
+
+def _read_setup(extension: str) -> Callable[[str, float], List[str]]:
+    # The same records as bgzipped VCFs and as BCFs, for comparing how fast downstream tools can read each format
+    def _setup(tmp: str, scale: float) -> List[str]:
+        vcfs = _cci_setup(shuffled=False)(tmp, scale)
+        _cci_run(1, OUTPUT_BOTH)(vcfs)
+        return [f"{vcf[:-4]}{extension}" for vcf in vcfs]
+    return _setup
+
+
+def _read_run(paths: List[str]):
+    for path in paths:
+        subprocess.check_call(["bcftools", "view", "-O", "u", "-o", os.devnull, path])
+
+
+# parallel-mergeSTR ----------------------------------------------------------------------------------------------------
+
+def _pms_setup(tmp: str, scale: float) -> Tuple[str, List[str]]:
+    d = os.path.join(tmp, "pms")
+    os.makedirs(d)
+    return d, write_str_vcfs(d, 8, 5, _n(5_000, scale))
+
+
+def _pms_run(engine: str) -> Callable[[Tuple[str, List[str]]], None]:
+    def _run(state: Tuple[str, List[str]]):
+        d, vcfs = state
+        with open(os.devnull, "w") as null, contextlib.redirect_stdout(null), contextlib.redirect_stderr(null):
+            parallel_mergestr(vcfs, os.path.join(d, f"merged_{engine}"), ntasks=2, resume=False, tmp_dir=d,
+                              engine=engine)
+    return _run
+
+
+# arg-join (CLI start-up) ----------------------------------------------------------------------------------------------
+
+def _cli_startup(_state):
+    for _ in range(10):
+        subprocess.run([sys.executable, "-m", "bcf_extras.entry", "arg-join", "a", "b"], stdout=subprocess.DEVNULL,
+                       check=True)
+
+
+CASES = (
+    _fg3_case("--type ^exon$", feature_type="^exon$"),
+    _fg3_case("--expr type ~ \"^exon$\"", expression='type ~ "^exon$"'),
+    _fg3_case("--type ^exon$ --strand +", feature_type="^exon$", strand=r"\+"),
+    _fg3_case("--expr type == \"exon\" and strand == \"+\"", expression='type == "exon" and strand == "+"'),
+    _fg3_case("--type ^gene$ --attr gene_type=^lnc", feature_type="^gene$", attributes=["gene_type=^lnc"]),
+    _fg3_case("--expr type == \"gene\" and attr.gene_type ~ \"^lnc\"",
+              expression='type == "gene" and attr.gene_type ~ "^lnc"'),
+    _fg3_case("--expr end - start > 1000 and score >= 10", expression="end - start > 1000 and score >= 10"),
+    _fg3_case("--expr ... --ntasks 4", expression="end - start > 1000 and score >= 10", ntasks=4),
+    _fg3_case("--type ^exon$ (bgzipped)", gzipped=True, feature_type="^exon$"),
+    _fg3_case("--no-body-comments (20% comments)", comment_density=0.2, no_body_comments=True),
+    Case("filter-gff3: --output .gz --index (unsorted)", _gff3_setup(), _fg3_indexed_output),
+    Case("index-gff3", _gff3_setup(), index_gff3),
+    Case("query-gff3: ID + descendants, regions", _ig3_setup, _ig3_queries),
+    Case("add-header-lines: 1 bgzipped VCF", _ahl_setup(1), _ahl_run(1), _ahl_reset, _requires_htslib),
+    Case("add-header-lines: 16 VCFs, --ntasks 4", _ahl_setup(16), _ahl_run(4), _ahl_reset, _requires_htslib),
+    Case("copy-compress-index: 4 VCFs", _cci_setup(), _cci_run(1), requires=_requires_htslib),
+    Case("copy-compress-index: 4 VCFs, --ntasks 4", _cci_setup(), _cci_run(4), requires=_requires_htslib),
+    Case("copy-compress-index: 4 sorted VCFs", _cci_setup(shuffled=False), _cci_run(1), requires=_requires_htslib),
+    Case("copy-compress-index: 4 sorted VCFs, --output-format bcf", _cci_setup(shuffled=False),
+         _cci_run(1, OUTPUT_BCF), requires=_requires_htslib),
+    Case("read (bcftools view): 4 .vcf.gz", _read_setup(".vcf.gz"), _read_run, requires=_requires_htslib),
+    Case("read (bcftools view): 4 .bcf", _read_setup(".bcf"), _read_run, requires=_requires_htslib),
+    Case("parallel-mergeSTR: mergeSTR engine", _pms_setup, _pms_run(ENGINE_MERGESTR), requires=_requires_trtools),
+    Case("parallel-mergeSTR: built-in engine", _pms_setup, _pms_run(ENGINE_BUILTIN), requires=_requires_trtools),
+    Case("arg-join: CLI start-up (x10)", lambda _tmp, _scale: None, _cli_startup),
+)
+
+
+def run_cases(cases, scale: float = 1.0, repeats: int = 3, log=print) -> Dict[str, dict]:
+    results = {}
+    for case in cases:
+        reason = case.requires()
+        if reason is not None:
+            results[case.name] = {"skipped": reason}
+            log(f"{case.name:<64} skipped ({reason})")
+            continue
+
+        with tempfile.TemporaryDirectory() as tmp:
+            state = case.setup(tmp, scale)
+            times = []
+            for _ in range(repeats):
+                if case.reset is not None:
+                    case.reset(state)
+                start = time.perf_counter()
+                case.run(state)
+                times.append(time.perf_counter() - start)
+
+        results[case.name] = {"best": min(times), "median": statistics.median(times), "runs": times}
+        log(f"{case.name:<64} {min(times):8.3f}s (median {statistics.median(times):.3f}s)")
+
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float,
+            min_seconds: Optional[float] = None) -> List[str]:
+    """
+    Compares best times against a baseline, returning a description of each case which got slower by more than the
+    threshold (a fraction, e.g. 0.2 for 20%.)
+    """
+
+    min_seconds = MIN_COMPARED_SECONDS if min_seconds is None else min_seconds
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name, {})
+        if "best" not in result or "best" not in base or max(result["best"], base["best"]) < min_seconds:
+            continue
+        ratio = result["best"] / base["best"]
+        if ratio > 1 + threshold:
+            regressions.append(f"{name}: {base['best']:.3f}s -> {result['best']:.3f}s ({(ratio - 1) * 100:+.0f}%)")
+    return regressions
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier for the size of generated inputs.")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of runs per case; the best one is compared.")
+    parser.add_argument("--only", type=str, default=None, help="Only run cases whose names match this regex.")
+    parser.add_argument("--output", type=str, default=None, help="JSON file to save results to.")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results of an earlier run to compare to.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="With --baseline, the fraction by which a case may get slower before it counts as a regression.")
+    p_args = parser.parse_args(args)
+
+    cases = [c for c in CASES if p_args.only is None or re.search(p_args.only, c.name)]
+    results = run_cases(cases, p_args.scale, p_args.repeats)
+
+    if p_args.output:
+        with open(p_args.output, "w") as fh:
+            json.dump({
+                "version": RESULTS_VERSION,
+                "created": datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "scale": p_args.scale,
+                "repeats": p_args.repeats,
+                "results": results,
+            }, fh, indent=2)
+
+    if p_args.baseline:
+        with open(p_args.baseline) as fh:
+            baseline = json.load(fh)
+        if baseline.get("scale") != p_args.scale:
+            print(f"warning: baseline was run with --scale {baseline.get('scale')}", file=sys.stderr)
+        regressions = compare(results, baseline["results"], p_args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {p_args.threshold * 100:.0f}%:")
+            for r in regressions:
+                print(f"\t{r}")
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
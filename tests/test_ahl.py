@@ -1,10 +1,14 @@
+import gzip
 import os
+import shutil
+import subprocess
 
 import pytest
 
 from bcf_extras.add_header_lines import add_header_lines
+from bcf_extras.bgzf import BGZF_EOF, compress_blocks
 from bcf_extras.entry import main
-from bcf_extras.exceptions import BCFExtrasInputError
+from bcf_extras.exceptions import BCFExtrasBatchError, BCFExtrasInputError
 
 
 f = os.path.join(os.path.dirname(__file__), "vcfs", "ahl.vcf")
@@ -81,3 +85,120 @@ def test_cli_1():
 def test_cli_raises():
     with pytest.raises(SystemExit):
         main(["add-header-lines", f, "--start", "0"])
+
+
+def test_add_header_lines_batch(tmp_path):
+    fs = [str(tmp_path / f"ahl_{i}.vcf") for i in range(3)]
+    for fc in fs:
+        shutil.copyfile(f, fc)
+    missing = str(tmp_path / "missing.vcf")
+
+    with pytest.raises(BCFExtrasBatchError) as e:
+        add_header_lines([*fs, missing], lf, start=0, delete_old=True, ntasks=2)
+
+    assert list(e.value.failures) == [missing]
+
+    for fc in fs:
+        with open(fc, "r") as nf, open(t1, "r") as tf:
+            assert nf.read() == tf.read()
+        assert not os.path.exists(f"{fc}.old")
+
+
+def test_cli_batch(tmp_path, capsys):
+    fs = [str(tmp_path / f"ahl_{i}.vcf") for i in range(2)]
+    for fc in fs:
+        shutil.copyfile(f, fc)
+
+    vcf_list = tmp_path / "vcfs.txt"
+    vcf_list.write_text(f"{fs[1]}\n\n")
+
+    main(["add-header-lines", fs[0], lf, "--vcf-list", str(vcf_list), "--end", "0", "--ntasks", "2"])
+
+    for fc in fs:
+        with open(fc, "r") as nf, open(t2, "r") as tf:
+            assert nf.read() == tf.read()
+        assert os.path.exists(f"{fc}.old")
+
+    assert capsys.readouterr().out == f"add-header-lines: 2 of 2 file(s) updated\n\t{fs[0]}: OK\n\t{fs[1]}: OK\n"
+
+    with pytest.raises(SystemExit):
+        main(["add-header-lines", fs[0], str(tmp_path / "missing.vcf"), lf])
+
+
+def _write_bgzf_vcf(path: str) -> bytes:
+    with open(f, "rb") as vf:
+        header = b"".join(line for line in vf if line.startswith(b"#"))
+    body = b"".join(
+        f"{chrom}\t{pos}\t.\tA\tT\t.\tPASS\tEND={pos + 1}\tGT\t0/1\n".encode("ascii")
+        for chrom in ("chr1", "chr2") for pos in range(1000, 400000, 100))
+
+    with open(path, "wb") as vf:
+        for block in compress_blocks(header + body):
+            vf.write(block)
+        vf.write(BGZF_EOF)
+
+    return body
+
+
+def _query(vcf: str, region: str) -> str:
+    return subprocess.check_output(["tabix", vcf, region]).decode("ascii")
+
+
+@pytest.mark.skipif(shutil.which("bcftools") is None or shutil.which("tabix") is None,
+                    reason="htslib/bcftools is not installed")
+@pytest.mark.parametrize("index_args", [["tabix", "-p", "vcf"], ["bcftools", "index", "-c"]])
+def test_add_header_lines_bgzf(tmp_path, index_args):
+    vcf = str(tmp_path / "ahl.vcf.gz")
+    body = _write_bgzf_vcf(vcf)
+    subprocess.check_call([*index_args, vcf])
+
+    regions = ["chr1:1000-1500", "chr1:250000-260000", "chr2:1-2000", "chr2:399000-400000"]
+    before = [_query(vcf, r) for r in regions]
+
+    add_header_lines(vcf=vcf, lines=lf, start=0, delete_old=True)
+
+    with gzip.open(vcf, "rb") as vf:
+        data = vf.read()
+    with open(lf, "rb") as nf:
+        new_lines = nf.read().splitlines()
+
+    # Header lines go in right after ##fileformat, and records are untouched
+    assert data.endswith(body)
+    assert data[:-len(body)].splitlines()[1:len(new_lines) + 1] == new_lines
+
+    assert [_query(vcf, r) for r in regions] == before
+    assert sorted(os.listdir(tmp_path)) == ["ahl.vcf.gz", "ahl.vcf.gz" + (".tbi" if index_args[0] == "tabix" else ".csi")]
+
+
+@pytest.mark.skipif(shutil.which("bcftools") is None, reason="bcftools is not installed")
+def test_add_header_lines_bcf(tmp_path):
+    vcf = str(tmp_path / "ahl.vcf")
+    bcf = str(tmp_path / "ahl.bcf")
+    new_lf = str(tmp_path / "new_lines.txt")
+
+    with open(vcf, "wb") as vf:
+        vf.write(b"##fileformat=VCFv4.2\n##contig=<ID=chr1,length=1000000>\n##contig=<ID=chr2,length=1000000>\n"
+                 b"##INFO=<ID=END,Number=1,Type=Integer,Description=\"End position of the variant\">\n"
+                 b"##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n"
+                 b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample1\n")
+        for chrom in ("chr1", "chr2"):
+            for pos in range(1000, 400000, 100):
+                vf.write(f"{chrom}\t{pos}\t.\tA\tT\t.\tPASS\tEND={pos + 1}\tGT\t0/1\n".encode("ascii"))
+    with open(new_lf, "wb") as nf:
+        nf.write(b"##source=test\n##INFO=<ID=DP,Number=1,Type=Integer,Description=\"Total depth\">\n")
+
+    subprocess.check_call(["bcftools", "view", "-Ob", "-o", bcf, vcf])
+    subprocess.check_call(["bcftools", "index", "-c", bcf])
+    os.remove(vcf)
+
+    regions = ["chr1:1000-1500", "chr1:250000-260000", "chr2:1-2000", "chr2:399000-400000"]
+    before = [subprocess.check_output(["bcftools", "view", "-H", bcf, r]) for r in regions]
+
+    add_header_lines(vcf=bcf, lines=new_lf, delete_old=True)
+
+    header = subprocess.check_output(["bcftools", "view", "--no-version", "-h", bcf]).splitlines()
+    assert b"##source=test" in header
+    assert b"##INFO=<ID=DP,Number=1,Type=Integer,Description=\"Total depth\">" in header
+
+    assert [subprocess.check_output(["bcftools", "view", "-H", bcf, r]) for r in regions] == before
+    assert sorted(os.listdir(tmp_path)) == ["ahl.bcf", "ahl.bcf.csi", "new_lines.txt"]
@@ -0,0 +1,135 @@
+import asyncio
+import gzip
+import os
+import random
+import shutil
+
+import pytest
+
+from bcf_extras import aio
+from bcf_extras.exceptions import BCFExtrasBatchError, BCFExtrasInputError, BCFExtrasProcessError
+
+from .test_cci import SORTED_VCF
+
+
+def test_limiter():
+    async def _test():
+        limiter = aio.Limiter(3)
+        order = []
+
+        async def _job(name: str, n: int, hold: float):
+            async with limiter.acquire(n):
+                order.append(name)
+                assert limiter.in_use <= limiter.slots
+                await asyncio.sleep(hold)
+
+        small = asyncio.ensure_future(_job("small", 2, 0.05))
+        await asyncio.sleep(0)
+        # Too big to run alongside small; later jobs queue up behind it rather than starving it
+        await asyncio.gather(_job("big", 5, 0.01), _job("after", 1, 0), small)
+        assert order == ["small", "big", "after"]
+        assert limiter.in_use == 0
+
+        # Waiting jobs which get cancelled give up their place in the queue
+        async with limiter.acquire(3):
+            waiting = asyncio.ensure_future(_job("cancelled", 1, 0))
+            await asyncio.sleep(0)
+            waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert limiter.in_use == 0 and "cancelled" not in order
+
+    asyncio.run(_test())
+
+    with pytest.raises(BCFExtrasInputError):
+        aio.Limiter(0)
+
+
+def test_aio_cci(tmp_path):
+    vcfs = [str(tmp_path / f"sorted_{i}.vcf") for i in range(3)]
+    for vcf in vcfs:
+        with open(vcf, "w") as fh:
+            fh.write(SORTED_VCF)
+    missing = str(tmp_path / "does_not_exist.vcf")
+
+    events = []
+
+    async def _progress(event: aio.ProgressEvent):
+        events.append(event)
+
+    async def _test():
+        limiter = aio.Limiter(2)
+        with pytest.raises(BCFExtrasBatchError) as e:
+            await aio.copy_compress_index([*vcfs, missing], ntasks=4, limiter=limiter, progress=_progress)
+        assert list(e.value.failures) == [missing]
+        assert "does_not_exist.vcf" in e.value.failures[missing]
+
+    asyncio.run(_test())
+
+    for vcf in vcfs:
+        with gzip.open(f"{vcf}.gz", "rt") as fh:
+            assert fh.read() == SORTED_VCF
+        assert os.path.exists(f"{vcf}.gz.tbi")
+        kinds = [e.kind for e in events if e.job == vcf]
+        assert kinds == [aio.EVENT_STARTED, aio.EVENT_OUTPUT, aio.EVENT_FINISHED]
+        assert "already sorted" in next(e.message for e in events if e.job == vcf and e.kind == aio.EVENT_OUTPUT)
+    assert [e.kind for e in events if e.job == missing][-1] == aio.EVENT_FAILED
+
+    with pytest.raises(BCFExtrasInputError):
+        asyncio.run(aio.copy_compress_index(vcfs, threads=0))
+
+
+@pytest.mark.skipif(shutil.which("bgzip") is None, reason="htslib is not installed")
+def test_aio_add_header_lines(tmp_path):
+    vcf = str(tmp_path / "sorted.vcf")
+    with open(vcf, "w") as fh:
+        fh.write(SORTED_VCF)
+    lines = tmp_path / "lines.txt"
+    lines.write_text("##test=aio\n")
+
+    asyncio.run(aio.add_header_lines(vcf, str(lines), delete_old=True))
+    with open(vcf) as fh:
+        assert "##test=aio\n#CHROM" in fh.read()
+
+
+def test_aio_cancel(tmp_path):
+    # Reading from a FIFO nobody writes to blocks forever
+    fifo = str(tmp_path / "blocked.vcf")
+    os.mkfifo(fifo)
+    started = []
+
+    async def _test():
+        job = asyncio.ensure_future(aio.copy_compress_index([fifo], progress=started.append))
+        while not started:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+        job.cancel()
+        # The job's process is stopped, rather than being waited on forever
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(job, timeout=10)
+
+    asyncio.run(_test())
+    assert [e.kind for e in started] == [aio.EVENT_STARTED]
+
+
+@pytest.mark.skipif(shutil.which("bgzip") is None or shutil.which("tabix") is None, reason="htslib is not installed")
+def test_aio_parallel_mergestr(tmp_path, monkeypatch):
+    from bcf_extras.parallel_mergestr import mergestr_main
+    if mergestr_main is None:
+        pytest.skip("TRTools is not installed")
+
+    from .test_mergestr_engine import _write_gangstr_vcf
+
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(5)
+    inputs = [_write_gangstr_vcf(str(tmp_path / f"in_{i}.vcf"), [f"s{i}"], rng) for i in range(3)]
+
+    async def _test():
+        limiter = aio.Limiter(1)
+        await aio.parallel_mergestr(inputs, str(tmp_path / "out"), ntasks=2, limiter=limiter, vcf_type="gangstr",
+                                    engine="builtin")
+        with pytest.raises(BCFExtrasProcessError):
+            await aio.parallel_mergestr(inputs, str(tmp_path / "out"), fan_in=1)
+
+    asyncio.run(_test())
+    assert os.path.exists(str(tmp_path / "out.vcf"))
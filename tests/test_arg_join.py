@@ -19,3 +19,24 @@ def test_arg_join_3():
 def test_arg_join_4():
     s = subprocess.check_output(["python", "-m", "bcf_extras.entry", "arg-join", "--sep", "a", "b", "c"])
     assert s == b"bac"
+
+
+def test_arg_join_items_from(tmp_path):
+    items = tmp_path / "items.txt"
+    items.write_text("f2\n\n# comment\n  f3  \n")
+
+    s = subprocess.check_output(["python", "-m", "bcf_extras.entry", "arg-join", "--items-from", str(items), "f1"])
+    assert s == b"f1,f2,f3"
+
+    s = subprocess.check_output(
+        ["python", "-m", "bcf_extras.entry", "arg-join", "--sep", ";", "--items-from", "-"], input=b"a\nb\n")
+    assert s == b"a;b"
+
+
+def test_arg_join_output(tmp_path):
+    out = tmp_path / "joined.txt"
+    s = subprocess.check_output(
+        ["python", "-m", "bcf_extras.entry", "arg-join", "--items-from", "-", "--output", str(out)],
+        input="".join(f"sample_{i}.vcf.gz\n" for i in range(50000)).encode())
+    assert s == b""
+    assert out.read_text() == ",".join(f"sample_{i}.vcf.gz" for i in range(50000))
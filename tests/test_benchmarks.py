@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+from benchmarks.generators import write_gff3, write_vcf
+from benchmarks import run
+from benchmarks.run import compare, main
+
+
+def test_generators_deterministic(tmp_path):
+    for i in range(2):
+        write_gff3(str(tmp_path / f"{i}.gff3"), 100, comment_density=0.5, seed=3)
+        write_vcf(str(tmp_path / f"{i}.vcf"), ["a", "b"], 50, n_header_lines=5, missing_rate=0.2, seed=3)
+
+    for ext in ("gff3", "vcf"):
+        assert (tmp_path / f"0.{ext}").read_text() == (tmp_path / f"1.{ext}").read_text()
+
+    gff3 = (tmp_path / "0.gff3").read_text().splitlines()
+    assert len([ln for ln in gff3 if not ln.startswith("#")]) == 100
+    assert any(ln.startswith("# synthetic comment") for ln in gff3)
+
+    vcf = (tmp_path / "0.vcf").read_text().splitlines()
+    assert len([ln for ln in vcf if ln.startswith("##bench_filler_")]) == 5
+    assert vcf[[ln.startswith("#CHROM") for ln in vcf].index(True)].endswith("FORMAT\ta\tb")
+    assert 25 < len([ln for ln in vcf if not ln.startswith("#")]) < 50
+
+
+def test_compare():
+    baseline = {"a": {"best": 1.0}, "b": {"best": 1.0}, "c": {"best": 0.01}, "d": {"skipped": "x"}}
+    results = {"a": {"best": 1.1}, "b": {"best": 1.5}, "c": {"best": 0.03}, "d": {"best": 1.0}, "e": {"best": 9.0}}
+    regressions = compare(results, baseline, 0.2)
+    assert len(regressions) == 1 and regressions[0].startswith("b:")
+
+
+def test_main(tmp_path, monkeypatch):
+    out = str(tmp_path / "results.json")
+    main(["--only", "^filter-gff3: --type \\^exon\\$$", "--scale", "0.001", "--repeats", "1", "--output", out])
+
+    with open(out) as fh:
+        results = json.load(fh)
+    assert list(results["results"]) == ["filter-gff3: --type ^exon$"]
+    assert results["results"]["filter-gff3: --type ^exon$"]["best"] > 0
+
+    # An impossibly fast baseline is a regression
+    monkeypatch.setattr(run, "MIN_COMPARED_SECONDS", 0)
+    results["results"]["filter-gff3: --type ^exon$"]["best"] = 1e-9
+    with open(out, "w") as fh:
+        json.dump(results, fh)
+    with pytest.raises(SystemExit):
+        main(["--only", "^filter-gff3: --type \\^exon\\$$", "--scale", "0.001", "--repeats", "1", "--baseline", out])
@@ -1,6 +1,13 @@
+import gzip
 import os
+import shutil
+import subprocess
 
-from bcf_extras.copy_compress_index import copy_compress_index
+import pytest
+
+from bcf_extras import copy_compress_index as cci
+from bcf_extras.copy_compress_index import _compress_index_sorted, copy_compress_index
+from bcf_extras.exceptions import BCFExtrasBatchError, BCFExtrasInputError
 
 
 def test_cci():
@@ -17,3 +24,221 @@ def test_cci():
     # Clean up
     os.remove(o1)
     os.remove(o2)
+
+
+SORTED_VCF = """##fileformat=VCFv4.2
+##contig=<ID=chr2,length=1000000>
+##contig=<ID=chr10,length=1000000>
+##INFO=<ID=END,Number=1,Type=Integer,Description="End position">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+chr2\t100\t.\tA\tC\t.\tPASS\t.
+chr2\t100\t.\tA\tG\t.\tPASS\t.
+chr2\t20000\t.\tACGT\t.\t.\tPASS\tEND=90000
+chr10\t5\t.\tT\tA\t.\tPASS\t.
+chr10\t500000\t.\tG\tGA\t.\tPASS\tDP=3;END=500010
+chrUn\t1\t.\tC\tT\t.\tPASS\t.
+"""
+
+
+def test_compress_index_sorted(tmp_path):
+    vcf = str(tmp_path / "sorted.vcf")
+    with open(vcf, "w") as fh:
+        fh.write(SORTED_VCF)
+
+    assert _compress_index_sorted(vcf, f"{vcf}.gz", threads=2)
+    with gzip.open(f"{vcf}.gz", "rt") as fh:
+        assert fh.read() == SORTED_VCF
+    assert os.path.exists(f"{vcf}.gz.tbi")
+
+    # Out of header contig order, and out of allele order at the same position
+    lines = SORTED_VCF.splitlines(keepends=True)
+    for unsorted in (lines[:5] + lines[8:9] + lines[5:8], lines[:5] + [lines[6], lines[5]] + lines[7:]):
+        with open(vcf, "w") as fh:
+            fh.writelines(unsorted)
+        assert not _compress_index_sorted(vcf, f"{vcf}.gz", threads=1)
+        assert not os.path.exists(f"{vcf}.gz")
+
+
+@pytest.mark.skipif(shutil.which("tabix") is None, reason="htslib is not installed")
+def test_cci_sorted_index_matches_tabix(tmp_path, capsys):
+    vcf = str(tmp_path / "sorted.vcf")
+    with open(vcf, "w") as fh:
+        fh.write(SORTED_VCF)
+
+    copy_compress_index([vcf])
+    assert "already sorted" in capsys.readouterr().out
+
+    shutil.copyfile(f"{vcf}.gz", str(tmp_path / "ref.vcf.gz"))
+    subprocess.check_call(["tabix", "-p", "vcf", str(tmp_path / "ref.vcf.gz")])
+
+    for region in ("chr2", "chr2:150-160", "chr2:50000-50001", "chr10:1-10", "chr10:500005", "chrUn", "chr10"):
+        assert subprocess.check_output(["tabix", f"{vcf}.gz", region]) == subprocess.check_output(
+            ["tabix", str(tmp_path / "ref.vcf.gz"), region])
+
+
+def test_cci_unsorted_fallback(tmp_path, capsys):
+    f = str(tmp_path / "cci.vcf")
+    shutil.copyfile(os.path.join(os.path.dirname(__file__), "vcfs", "cci.vcf"), f)
+
+    copy_compress_index([f], sort_mem=64 * 1024 * 1024, tmp_dir=str(tmp_path))
+    assert "not sorted" in capsys.readouterr().out
+
+    with gzip.open(f"{f}.gz", "rt") as fh:
+        positions = [int(ln.split("\t")[1]) for ln in fh if not ln.startswith("#")]
+    assert positions == sorted(positions)
+    assert os.path.exists(f"{f}.gz.tbi")
+
+
+def test_cci_incremental(tmp_path, capsys):
+    vcf = str(tmp_path / "sorted.vcf")
+    with open(vcf, "w") as fh:
+        fh.write(SORTED_VCF)
+
+    def _run() -> str:
+        copy_compress_index([vcf], incremental=True)
+        return capsys.readouterr().out
+
+    assert "already sorted" in _run()
+    assert os.path.exists(f"{vcf}.gz{cci.SIDECAR_EXTENSION}")
+    assert "up to date" in _run()
+
+    # Same content with a newer modification time
+    st = os.stat(vcf)
+    os.utime(vcf, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert "up to date" in _run()
+    assert "up to date" in _run()
+
+    # Changed content, even with the same size and modification time
+    st = os.stat(vcf)
+    with open(vcf, "w") as fh:
+        fh.write(SORTED_VCF.replace("PASS", "pass"))
+    os.utime(vcf, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert "already sorted" in _run()
+    with gzip.open(f"{vcf}.gz", "rt") as fh:
+        assert "pass" in fh.read()
+
+    # Truncated or missing outputs
+    with open(f"{vcf}.gz", "r+b") as fh:
+        fh.truncate(os.path.getsize(f"{vcf}.gz") - 10)
+    assert "already sorted" in _run()
+    os.remove(f"{vcf}.gz.tbi")
+    assert "already sorted" in _run()
+    assert "up to date" in _run()
+
+    # Without incremental mode, everything is rebuilt and the fingerprints are dropped
+    copy_compress_index([vcf])
+    assert "already sorted" in capsys.readouterr().out
+    assert not os.path.exists(f"{vcf}.gz{cci.SIDECAR_EXTENSION}")
+
+
+def test_cci_atomic_outputs(tmp_path, monkeypatch):
+    vcf = str(tmp_path / "sorted.vcf")
+    with open(vcf, "w") as fh:
+        fh.write(SORTED_VCF)
+    copy_compress_index([vcf], incremental=True)
+    with open(f"{vcf}.gz", "rb") as fh:
+        previous = fh.read()
+
+    with open(vcf, "a") as fh:
+        fh.write("chrUn\t2\t.\tC\tT\t.\tPASS\t.\n")
+
+    def _interrupted(writer, data):
+        writer._fh.write(data[:10])
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(cci.BGZFWriter, "write", _interrupted)
+    with pytest.raises(BCFExtrasBatchError):
+        copy_compress_index([vcf], incremental=True)
+
+    # The previous output is left alone and no temporary files are left behind, but it is no longer up to date
+    with open(f"{vcf}.gz", "rb") as fh:
+        assert fh.read() == previous
+    assert sorted(os.listdir(tmp_path)) == ["sorted.vcf", "sorted.vcf.gz", "sorted.vcf.gz.tbi"]
+    monkeypatch.undo()
+    assert not cci._is_up_to_date(vcf, f"{vcf}.gz")
+
+
+def _records(path: str) -> bytes:
+    return subprocess.check_output(["bcftools", "view", "-H", path])
+
+
+@pytest.mark.skipif(shutil.which("bcftools") is None, reason="htslib is not installed")
+def test_cci_bcf(tmp_path, capsys):
+    vcf = str(tmp_path / "sorted.vcf")
+    with open(vcf, "w") as fh:
+        # BCF records can only refer to contigs and tags defined in the header
+        fh.write(SORTED_VCF.replace(
+            "##INFO", "##contig=<ID=chrUn>\n##INFO=<ID=DP,Number=1,Type=Integer,Description=\"Depth\">\n##INFO", 1))
+    bcf = str(tmp_path / "sorted.bcf")
+
+    copy_compress_index([vcf], output_format="bcf")
+    assert "converting to BCF" in capsys.readouterr().out
+    assert sorted(os.listdir(tmp_path)) == ["sorted.bcf", "sorted.bcf.csi", "sorted.vcf"]
+
+    copy_compress_index([vcf], output_format="both", incremental=True)
+    assert "already sorted" in capsys.readouterr().out
+    assert _records(bcf) == _records(f"{vcf}.gz")
+    assert subprocess.check_output(["bcftools", "view", "-H", bcf, "chr10:500005"]).count(b"\n") == 1
+
+    # Only the out-of-date output is rebuilt, from the up-to-date bgzipped copy
+    os.remove(f"{bcf}.csi")
+    copy_compress_index([vcf], output_format="both", incremental=True)
+    out = capsys.readouterr().out
+    assert "converting to BCF" in out and "already sorted" not in out
+    copy_compress_index([vcf], output_format="both", incremental=True)
+    assert "up to date" in capsys.readouterr().out
+
+    # Unsorted input is sorted straight into BCF
+    f = str(tmp_path / "cci.vcf")
+    shutil.copyfile(os.path.join(os.path.dirname(__file__), "vcfs", "cci.vcf"), f)
+    copy_compress_index([f], output_format="bcf")
+    assert "not sorted" in capsys.readouterr().out
+    positions = [int(ln.split(b"\t")[1]) for ln in _records(str(tmp_path / "cci.bcf")).splitlines()]
+    assert positions == sorted(positions)
+    assert os.path.exists(str(tmp_path / "cci.bcf.csi"))
+
+
+@pytest.mark.skipif(shutil.which("tabix") is None, reason="htslib is not installed")
+@pytest.mark.parametrize("declared", (True, False))
+def test_cci_long_contig(tmp_path, capsys, declared):
+    vcf = str(tmp_path / "long.vcf")
+    with open(vcf, "w") as fh:
+        fh.write(SORTED_VCF.replace("##contig=<ID=chr10,length=1000000>", "##contig=<ID=chr10,length=700000000>")
+                 if declared else SORTED_VCF.replace("chrUn\t1", "chrUn\t600000000"))
+
+    copy_compress_index([vcf])
+    assert "already sorted" in capsys.readouterr().out
+    assert sorted(os.listdir(tmp_path)) == ["long.vcf", "long.vcf.gz", "long.vcf.gz.csi"]
+    assert subprocess.check_output(["tabix", f"{vcf}.gz", "chr10:500005"]).count(b"\n") == 1
+    assert subprocess.check_output(["tabix", f"{vcf}.gz", "chr2:100-100"]).count(b"\n") == 2
+
+
+def test_cci_parallel(tmp_path):
+    f = os.path.join(os.path.dirname(__file__), "vcfs", "cci.vcf")
+    fs = [str(tmp_path / f"cci_{i}.vcf") for i in range(3)]
+    for fc in fs:
+        shutil.copyfile(f, fc)
+
+    copy_compress_index(fs, ntasks=2, threads=2)
+
+    for fc in fs:
+        assert os.path.exists(f"{fc}.gz")
+        assert os.path.exists(f"{fc}.gz.tbi")
+
+
+def test_cci_failures_collected():
+    fs = [os.path.join(os.path.dirname(__file__), "vcfs", f"does_not_exist_{i}.vcf") for i in range(2)]
+
+    with pytest.raises(BCFExtrasBatchError) as e:
+        copy_compress_index(fs, ntasks=2)
+
+    assert list(e.value.failures.keys()) == fs
+
+
+def test_cci_raises():
+    with pytest.raises(BCFExtrasInputError):
+        copy_compress_index([], ntasks=0)
+    with pytest.raises(BCFExtrasInputError):
+        copy_compress_index([], sort_mem=0)
+    with pytest.raises(BCFExtrasInputError):
+        copy_compress_index([], output_format="cram")
@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import bcf_extras
+
+
+# Modules which only some actions need, and which are (or pull in) slow imports
+HEAVY_MODULES = (
+    "bcf_extras.add_header_lines",
+    "bcf_extras.copy_compress_index",
+    "bcf_extras.filter_gff3",
+    "bcf_extras.gff3_index",
+    "bcf_extras.mergestr_engine",
+    "bcf_extras.parallel_mergestr",
+    "multiprocessing",
+    "numpy",
+    "trtools",
+)
+
+
+def _import_times(*args: str):
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.dirname(bcf_extras.__file__))}
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import sys; from bcf_extras.entry import main; main(sys.argv[1:])",
+         *args],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, check=True)
+
+    # Lines look like: "import time:       self [us] |  cumulative | imported package"
+    times = {}
+    for line in proc.stderr.decode().splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return proc.stdout.decode(), times
+
+
+@pytest.mark.parametrize("args, expected", [
+    (["arg-join", "a", "b"], "a,b"),
+    (["arg-join", "--sep", " ", "a", "b"], "a b"),
+])
+def test_lightweight_startup(args, expected):
+    out, times = _import_times(*args)
+    assert out == expected
+
+    assert "bcf_extras.entry" in times
+    for module in HEAVY_MODULES:
+        assert module not in times, f"{module} imported by {' '.join(args)}"
+
+    # Generous, but well under what importing TRTools and NumPy costs
+    assert times["bcf_extras.entry"] < 500_000
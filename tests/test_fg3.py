@@ -0,0 +1,218 @@
+import gzip
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from bcf_extras.bgzf import BGZF_EOF, compress_blocks
+from bcf_extras.exceptions import BCFExtrasInputError
+from bcf_extras.filter_gff3 import filter_gff3
+from bcf_extras.gff3_expr import attribute_value, compile_filter
+
+
+HEADER = "##gff-version 3\n##sequence-region chr1 1 1000\n"
+RECORDS = [
+    "chr1\ttest\tgene\t10\t100\t.\t+\t.\tID=g1\n",
+    "chr1\ttest\texon\t10\t50\t.\t+\t.\tID=e1;Parent=g1\n",
+    "chr1\ttest\tgene\t500\t900\t.\t-\t.\tID=g2\n",
+    "chr2\ttest\tgene\t20\t80\t.\t+\t.\tID=g3\n",
+    "chr10\ttest\tgene\t30\t60\t.\t+\t.\tID=g4\n",
+]
+
+
+def _write_gff3(path, gzipped: bool) -> str:
+    data = (HEADER + "".join(RECORDS)).encode("utf-8")
+    with open(path, "wb") as gf:
+        if gzipped:
+            for block in compress_blocks(data):
+                gf.write(block)
+            gf.write(BGZF_EOF)
+        else:
+            gf.write(data)
+    return str(path)
+
+
+def _filter(capsys, gff, **kwargs) -> str:
+    args = {k: kwargs.pop(k, None) for k in ("seq_id", "source", "feature_type", "strand", "phase")}
+    filter_gff3(gff, **args, **kwargs)
+    return capsys.readouterr().out
+
+
+@pytest.mark.parametrize("gzipped", [False, True])
+def test_filter_gff3(tmp_path, capsys, gzipped):
+    gff = _write_gff3(tmp_path / ("test.gff3.gz" if gzipped else "test.gff3"), gzipped)
+
+    assert _filter(capsys, gff, seq_id=r"chr1$") == HEADER + "".join(RECORDS[:3])
+    assert _filter(capsys, gff, feature_type="^gene$", strand=r"\+") == HEADER + RECORDS[0] + "".join(RECORDS[3:])
+    assert _filter(capsys, gff, region="chr1:60-600") == HEADER + RECORDS[0] + RECORDS[2]
+    assert _filter(capsys, gff, region="chr1:60-600", feature_type="exon") == HEADER
+
+    with pytest.raises(BCFExtrasInputError):
+        _filter(capsys, gff, region="chr1:600-60")
+
+
+@pytest.mark.skipif(shutil.which("tabix") is None, reason="htslib is not installed")
+def test_filter_gff3_indexed(tmp_path, capsys):
+    gff = _write_gff3(tmp_path / "test.gff3.gz", True)
+    subprocess.check_call(["tabix", "-p", "gff", gff])
+
+    assert _filter(capsys, gff, seq_id=r"chr1") == HEADER + "".join(RECORDS[:3]) + RECORDS[4]
+    assert _filter(capsys, gff, seq_id=r"chr2") == HEADER + RECORDS[3]
+    assert _filter(capsys, gff, region="chr1:60-600") == HEADER + RECORDS[0] + RECORDS[2]
+    assert _filter(capsys, gff, region="chr1:60-600", seq_id="chr2") == HEADER
+    assert _filter(capsys, gff, region="chr3") == HEADER
+
+
+def test_filter_gff3_attributes(tmp_path, capsys):
+    gff = _write_gff3(tmp_path / "test.gff3", False)
+
+    assert _filter(capsys, gff, attributes=["ID=^g"]) == HEADER + RECORDS[0] + "".join(RECORDS[2:])
+    assert _filter(capsys, gff, attributes=["Parent"]) == HEADER + RECORDS[1]
+    assert _filter(capsys, gff, attributes=["Parent=g1", "ID=e1"]) == HEADER + RECORDS[1]
+    assert _filter(capsys, gff, attributes=["Parent=g2"]) == HEADER
+    assert _filter(capsys, gff, seq_id="chr2", attributes=["ID=g3$"]) == HEADER + RECORDS[3]
+
+    with pytest.raises(BCFExtrasInputError):
+        _filter(capsys, gff, attributes=["=g1"])
+
+
+def test_attribute_value():
+    attributes = "ID=gene1;Name=ABC%3B1;gene_name=XYZ; Alias=a,b"
+    assert attribute_value(attributes, "ID") == "gene1"
+    assert attribute_value(attributes, "Name") == "ABC;1"
+    assert attribute_value(attributes, "name") is None
+    assert attribute_value(attributes, "gene_name") == "XYZ"
+    assert attribute_value(attributes, "Alias") == "a,b"
+
+
+@pytest.mark.parametrize("expression, expected", [
+    ('type ~ "^gene$"', [0, 2, 3, 4]),
+    ('type == "gene" and end - start > 300', [2]),
+    ('type == "exon" or (seqid != "chr1" and start >= 30)', [1, 4]),
+    ('not attr.Parent and strand == "+"', [0, 3, 4]),
+    ('attr.ID !~ "^g[12]$"', [1, 3, 4]),
+    ('attr.Parent == "g1"', [1]),
+    ("start * 2 < 50 and -end < -60", [0, 3]),
+    ("score >= 0 or score < 0", [2]),
+    ("attr.n > 2.5", [1]),
+    ("start / (start - 10) > 0", [2, 3, 4]),  # Division by zero is nan, which never compares as true
+    ("not attr.n / 0 <= 0", [0, 1, 2, 3, 4]),
+])
+def test_compile_filter(expression, expected):
+    records = [*RECORDS[:2], RECORDS[2].replace("\t.\t-", "\t12.5\t-"), *RECORDS[3:]]
+    records[1] = records[1].replace("Parent=g1", "Parent=g1;n=3")
+
+    predicate = compile_filter(expression)
+    assert [i for i, r in enumerate(records) if predicate(r)] == expected
+
+
+@pytest.mark.parametrize("expression", [
+    "", "type", "start ~ 'x'", "type < 'a'", "type == 1", "(type == 'gene'", "type == 'gene' start", "foo == 1",
+    "type ~ gene", "(start > 1) == 1",
+])
+def test_compile_filter_invalid(expression):
+    with pytest.raises(BCFExtrasInputError):
+        compile_filter(expression)
+
+
+def test_compile_filter_only_splits_needed_columns():
+    assert 'split("\\t", 3)' in compile_filter('type == "gene"').source
+    assert 'split("\\t", 9)' in compile_filter("attr.ID").source
+
+
+def test_filter_gff3_expression(tmp_path, capsys):
+    gff = _write_gff3(tmp_path / "test.gff3", False)
+    assert _filter(capsys, gff, expression="end - start > 300") == HEADER + RECORDS[2]
+    assert _filter(capsys, gff, seq_id="chr1", expression="start < 30") == HEADER + "".join(RECORDS[:2])
+
+
+@pytest.mark.parametrize("expression, expected", [
+    ('type ~ "^gene$"', [0, 2, 3, 4]),
+    ('attr.Parent == "g1"', [1]),
+    ('seqid == "chr1" and end - start > 60', [0, 2]),
+])
+def test_compile_filter_binary(expression, expected):
+    predicate = compile_filter(expression, binary=True)
+    assert [i for i, r in enumerate(RECORDS) if predicate(r.encode("utf-8"))] == expected
+
+
+@pytest.mark.parametrize("ntasks", [1, 3])
+def test_filter_gff3_invalid_record(tmp_path, capsys, monkeypatch, ntasks):
+    import bcf_extras.filter_gff3 as fg3
+
+    gff = str(tmp_path / "test.gff3")
+    with open(gff, "w") as gf:
+        gf.write(HEADER)
+        for _ in range(40):
+            gf.write("".join(RECORDS))
+        gf.write(RECORDS[0].replace("\t10\t", "\tten\t"))  # Line 203
+        gf.write("".join(RECORDS))
+
+    monkeypatch.setattr(fg3, "_CHUNK_SIZE", 256)
+    monkeypatch.setattr(fg3, "_READ_SIZE", 256)
+
+    # Columns the filter doesn't need aren't checked
+    assert _filter(capsys, gff, ntasks=ntasks, expression='type == "exon"').count("\n") == 2 + 41
+
+    with pytest.raises(BCFExtrasInputError, match="line 203"):
+        _filter(capsys, gff, ntasks=ntasks, expression="start > 10")
+
+
+@pytest.mark.parametrize("no_body_comments", [False, True])
+def test_filter_gff3_parallel(tmp_path, capsys, monkeypatch, no_body_comments):
+    import bcf_extras.filter_gff3 as fg3
+
+    gff = str(tmp_path / "test.gff3")
+    with open(gff, "w") as gf:
+        gf.write(HEADER)
+        for i in range(200):
+            gf.write("".join(RECORDS).replace("ID=g", f"ID=g{i}_"))
+            if i % 7 == 0:
+                gf.write(f"###\n# comment {i}\n")
+
+    kwargs = dict(feature_type="gene", expression="start >= 20", no_body_comments=no_body_comments)
+    expected = _filter(capsys, gff, **kwargs)
+
+    monkeypatch.setattr(fg3, "_CHUNK_SIZE", 256)
+    assert _filter(capsys, gff, ntasks=3, **kwargs) == expected
+    assert ("# comment 7\n" in expected) != no_body_comments
+
+    with pytest.raises(BCFExtrasInputError):
+        _filter(capsys, gff, ntasks=0)
+
+
+@pytest.mark.parametrize("shuffled", [False, True])
+def test_filter_gff3_sorted_indexed_output(tmp_path, capsys, monkeypatch, shuffled):
+    import bcf_extras.filter_gff3 as fg3
+
+    gff = str(tmp_path / "test.gff3")
+    records = [RECORDS[i] for i in ((4, 3, 2, 1, 0) if shuffled else range(5))]
+    with open(gff, "w") as gf:
+        gf.write(HEADER + "".join(records[:3]) + "# body comment\n" + "".join(records[3:]))
+
+    # Tiny runs force the unsorted case through spilling to disk and multi-level merging
+    monkeypatch.setattr(fg3, "_SORT_MAX_RUNS", 2)
+    out = str(tmp_path / "out.gff3.gz")
+    assert _filter(capsys, gff, output=out, index=True, sort_mem=1, tmp_dir=str(tmp_path)) == ""
+
+    expected = [RECORDS[i] for i in ((4, 3, 1, 0, 2) if shuffled else range(5))]  # Contigs in order of appearance
+    with gzip.open(out, "rt") as gf:
+        assert gf.read() == HEADER + "".join(expected)
+    assert sorted(os.listdir(tmp_path)) == ["out.gff3.gz", "out.gff3.gz.tbi", "test.gff3"]
+
+    if shutil.which("tabix") is not None:
+        assert subprocess.check_output(["tabix", out, "chr1:60-600"]).decode() == RECORDS[0] + RECORDS[2]
+        assert subprocess.check_output(["tabix", out, "chr2"]).decode() == RECORDS[3]
+
+
+def test_filter_gff3_output(tmp_path, capsys):
+    gff = _write_gff3(tmp_path / "test.gff3", False)
+
+    out = str(tmp_path / "out.gff3.gz")
+    _filter(capsys, gff, seq_id="chr1$", output=out)
+    with gzip.open(out, "rt") as gf:
+        assert gf.read() == HEADER + "".join(RECORDS[:3])
+
+    with pytest.raises(BCFExtrasInputError):
+        _filter(capsys, gff, output=str(tmp_path / "out.gff3"), index=True)
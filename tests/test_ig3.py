@@ -0,0 +1,111 @@
+import os
+import random
+
+import pytest
+
+from bcf_extras.bgzf import BGZF_EOF, compress_blocks
+from bcf_extras.entry import main
+from bcf_extras.exceptions import BCFExtrasInputError
+from bcf_extras.gff3_index import GFF3Index, index_gff3, query_gff3
+
+
+HEADER = "##gff-version 3\n##sequence-region chr1 1 10000\n"
+RECORDS = [
+    "chr1\ttest\tgene\t100\t900\t.\t+\t.\tID=g1;Name=A\n",
+    "chr1\ttest\tmRNA\t100\t900\t.\t+\t.\tID=t1;Parent=g1\n",
+    "chr1\ttest\texon\t100\t300\t.\t+\t.\tParent=t1\n",
+    "chr1\ttest\tCDS\t150\t300\t.\t+\t0\tID=c1;Parent=t1\n",
+    "chr1\ttest\tCDS\t700\t850\t.\t+\t0\tID=c1;Parent=t1\n",
+    "chr1\ttest\tgene\t2000\t3000\t.\t-\t.\tID=g%3B2\n",
+    "chr1\ttest\tmRNA\t2000\t3000\t.\t-\t.\tID=t2;Parent=g%3B2,g1\n",
+    "chr2\ttest\tgene\t50\t60\t.\t+\t.\tID=g3\n",
+]
+
+
+def _write_gff3(path, gzipped: bool) -> str:
+    data = (HEADER + "".join(RECORDS)).encode("utf-8")
+    with open(path, "wb") as gf:
+        if gzipped:
+            for block in compress_blocks(data):
+                gf.write(block)
+            gf.write(BGZF_EOF)
+        else:
+            gf.write(data)
+    return str(path)
+
+
+def _records(idx, features):
+    return [r.decode("utf-8") for r in idx.records(features)]
+
+
+@pytest.mark.parametrize("gzipped", [False, True])
+def test_gff3_index(tmp_path, gzipped):
+    gff = _write_gff3(tmp_path / ("test.gff3.gz" if gzipped else "test.gff3"), gzipped)
+    assert index_gff3(gff) == f"{gff}.gffidx"
+
+    with GFF3Index(gff) as idx:
+        assert idx.header == HEADER.encode("utf-8")
+
+        assert _records(idx, idx.feature("g1")) == [*RECORDS[:5], RECORDS[6]]
+        assert _records(idx, idx.feature("g1", descendants=False)) == RECORDS[:1]
+        assert _records(idx, idx.feature("t1")) == RECORDS[1:5]
+        assert _records(idx, idx.feature("c1")) == RECORDS[3:5]
+        assert _records(idx, idx.feature("g;2")) == RECORDS[5:7]
+        assert idx.feature("g2") == []
+
+        assert _records(idx, idx.overlapping("chr1", 850, 2000)) == [*RECORDS[:2], RECORDS[4], *RECORDS[5:7]]
+        assert _records(idx, idx.overlapping("chr1", 301, 699)) == RECORDS[:2]
+        assert _records(idx, idx.overlapping("chr2", 1)) == RECORDS[7:]
+        assert idx.overlapping("chr2", 61) == []
+        assert idx.overlapping("chr3", 1) == []
+
+
+def test_gff3_index_interval_tree(tmp_path):
+    rng = random.Random(1)
+    records = []
+    for i in range(2000):
+        start = rng.randint(1, 100000)
+        records.append(f"chr1\ttest\tgene\t{start}\t{start + rng.choice((0, 10, 500, 20000))}\t.\t+\t.\tID=g{i}\n")
+
+    gff = str(tmp_path / "test.gff3")
+    with open(gff, "w") as gf:
+        gf.write("".join(records))
+    index_gff3(gff)
+
+    with GFF3Index(gff) as idx:
+        for _ in range(200):
+            start = rng.randint(1, 110000)
+            end = start + rng.choice((0, 100, 5000))
+            expected = [
+                r for r in records if int(r.split("\t")[3]) <= end and int(r.split("\t")[4]) >= start]
+            assert sorted(_records(idx, idx.overlapping("chr1", start, end))) == sorted(expected)
+
+
+def test_gff3_index_raises(tmp_path):
+    gff = _write_gff3(tmp_path / "test.gff3", False)
+
+    with pytest.raises(BCFExtrasInputError):
+        GFF3Index(gff)  # Not indexed yet
+
+    index_gff3(gff)
+    with open(gff, "a") as gf:
+        gf.write(RECORDS[0])
+    with pytest.raises(BCFExtrasInputError):
+        GFF3Index(gff)  # Out of date
+
+    with pytest.raises(BCFExtrasInputError):
+        query_gff3(gff)
+
+
+def test_cli(tmp_path, capsys):
+    gff = _write_gff3(tmp_path / "test.gff3", False)
+    index_path = str(tmp_path / "idx")
+
+    main(["index-gff3", "--index-path", index_path, gff])
+    assert os.path.exists(index_path)
+
+    main(["query-gff3", "--index-path", index_path, "--id", "t1", gff])
+    assert capsys.readouterr().out == HEADER + "".join(RECORDS[1:5])
+
+    main(["query-gff3", "--index-path", index_path, "--region", "chr2:1-100", gff])
+    assert capsys.readouterr().out == HEADER + RECORDS[7]
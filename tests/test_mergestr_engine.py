@@ -0,0 +1,279 @@
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from bcf_extras.mergestr_engine import merge_str_vcfs, mergestr
+from bcf_extras.parallel_mergestr import mergestr_main
+
+pytestmark = pytest.mark.skipif(
+    mergestr is None or shutil.which("bgzip") is None or shutil.which("tabix") is None,
+    reason="TRTools and htslib are required")
+
+
+GANGSTR_HEADER = """##fileformat=VCFv4.1
+##command=GangSTR --bam sample.bam --ref ref.fa --regions regions.bed
+##contig=<ID=chr1,length=248956422>
+##contig=<ID=chr2,length=242193529>
+##INFO=<ID=END,Number=1,Type=Integer,Description="End position of variant">
+##INFO=<ID=RU,Number=1,Type=String,Description="Repeat motif">
+##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="Repeat period (length of motif)">
+##INFO=<ID=REF,Number=1,Type=Float,Description="Reference copy number">
+##INFO=<ID=EXPTHRESH,Number=1,Type=Integer,Description="Threshold for calling expansions">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">
+##FORMAT=<ID=Q,Number=1,Type=Float,Description="Min joint likelihood">
+##FORMAT=<ID=REPCN,Number=2,Type=Integer,Description="Genotype given in number of copies of the repeat motif">
+##FORMAT=<ID=REPCI,Number=1,Type=String,Description="Confidence interval for REPCN">
+##FORMAT=<ID=RC,Number=1,Type=String,Description="Number of reads in each class">
+##FORMAT=<ID=ML,Number=1,Type=Float,Description="Maximum likelihood">
+##FORMAT=<ID=INS,Number=2,Type=Float,Description="Insert size mean and stddev">
+"""
+
+HIPSTR_HEADER = """##fileformat=VCFv4.1
+##command=HipSTR --bams sample.bam --fasta ref.fa --regions regions.bed --str-vcf out.vcf.gz
+##contig=<ID=chr1,length=248956422>
+##contig=<ID=chrX,length=156040895>
+##INFO=<ID=START,Number=1,Type=Integer,Description="Start of the reference repeat">
+##INFO=<ID=END,Number=1,Type=Integer,Description="End of the reference repeat">
+##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="Length of STR motif">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=GB,Number=1,Type=String,Description="Base pair differences of genotype from reference">
+##FORMAT=<ID=Q,Number=1,Type=Float,Description="Posterior probability of unphased genotype">
+##FORMAT=<ID=PQ,Number=1,Type=Float,Description="Posterior probability of phased genotype">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Number of valid reads used for sample's genotype">
+##FORMAT=<ID=PDP,Number=1,Type=String,Description="Fractional reads supporting each haploid genotype">
+##FORMAT=<ID=ALLREADS,Number=1,Type=String,Description="Base pair difference in each read">
+"""
+
+EH_HEADER = """##fileformat=VCFv4.1
+##contig=<ID=chr1,length=248956422>
+##contig=<ID=chrX,length=156040895>
+##INFO=<ID=END,Number=1,Type=Integer,Description="End position of the variant">
+##INFO=<ID=REF,Number=1,Type=Integer,Description="Reference copy number">
+##INFO=<ID=REPID,Number=1,Type=String,Description="Repeat identifier as specified in the variant catalog">
+##INFO=<ID=RL,Number=1,Type=Integer,Description="Reference length in bp">
+##INFO=<ID=RU,Number=1,Type=String,Description="Repeat unit in the reference orientation">
+##INFO=<ID=VARID,Number=1,Type=String,Description="Variant identifier as specified in the variant catalog">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=SO,Number=1,Type=String,Description="Type of reads that support the allele">
+##FORMAT=<ID=REPCN,Number=1,Type=String,Description="Number of repeat units spanned by the allele">
+##FORMAT=<ID=REPCI,Number=1,Type=String,Description="Confidence interval for REPCN">
+##FORMAT=<ID=ADSP,Number=1,Type=String,Description="Number of spanning reads consistent with the allele">
+##FORMAT=<ID=ADFL,Number=1,Type=String,Description="Number of flanking reads consistent with the allele">
+##FORMAT=<ID=ADIR,Number=1,Type=String,Description="Number of in-repeat reads consistent with the allele">
+##FORMAT=<ID=LC,Number=1,Type=Float,Description="Locus coverage">
+""" + "".join(f'##ALT=<ID=STR{cn},Description="Allele comprised of {cn} repeat units">\n' for cn in range(3, 9))
+
+LOCI = [("chr1", 1000 + 100 * i, "AC") for i in range(20)] + [("chr2", 500 + 50 * i, "AGAT") for i in range(10)]
+
+# chrX loci, where every other sample is haploid, so records mix ploidies (for the HipSTR and EH generators)
+PLOIDY_LOCI = [("chr1", 1000 + 100 * i, "AC") for i in range(15)] + [("chrX", 2000 + 80 * i, "TTG") for i in range(10)]
+
+
+def _write_vcf(path: str, header: str, samples, records) -> str:
+    lines = [header.rstrip("\n"), "\t".join(
+        ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", *samples]), *records]
+
+    with open(path, "w") as fh:
+        fh.write("\n".join(lines) + "\n")
+
+    subprocess.check_call(["bgzip", "-f", path])
+    subprocess.check_call(["tabix", "-f", "-p", "vcf", f"{path}.gz"])
+    return f"{path}.gz"
+
+
+def _write_gangstr_vcf(path: str, samples, rng: random.Random, loci=None):
+    records = []
+
+    for chrom, pos, motif in (loci or LOCI):
+        if rng.random() < 0.25:  # Not every sample has every locus
+            continue
+
+        ref_cn = 5
+        cns = [(rng.randint(3, 8), rng.randint(3, 8)) for _ in samples]
+        alts = sorted({cn for pair in cns for cn in pair if cn != ref_cn})
+        alleles = [ref_cn, *alts]
+
+        sample_cols = []
+        for a, b in cns:
+            if rng.random() < 0.1:
+                sample_cols.append(".")
+                continue
+            sample_cols.append(
+                f"{alleles.index(a)}/{alleles.index(b)}:{rng.randint(1, 60)}:{rng.random():.4f}:{a},{b}:"
+                f"{a}-{a},{b}-{b}:1,2,0,3:{rng.random() * 100:.2f}:{rng.randint(300, 500)}.0,{rng.random() * 50:.2f}")
+
+        end = pos + len(motif) * ref_cn - 1
+        records.append("\t".join([
+            chrom, str(pos), ".", motif * ref_cn, ",".join(motif * cn for cn in alts) or ".", ".", "PASS",
+            f"END={end};RU={motif};PERIOD={len(motif)};REF={ref_cn};EXPTHRESH=-1",
+            "GT:DP:Q:REPCN:REPCI:RC:ML:INS", *sample_cols]))
+
+    return _write_vcf(path, GANGSTR_HEADER, samples, records)
+
+
+def _sample_copy_numbers(chrom: str, samples, rng: random.Random):
+    # Diploid copy numbers, except for every other sample on chrX, which is haploid
+    return [
+        (rng.randint(3, 8),) if chrom == "chrX" and idx % 2 == 0 else (rng.randint(3, 8), rng.randint(3, 8))
+        for idx in range(len(samples))
+    ]
+
+
+def _write_hipstr_vcf(path: str, samples, rng: random.Random):
+    records = []
+
+    for chrom, pos, motif in PLOIDY_LOCI:
+        if rng.random() < 0.25:
+            continue
+
+        ref_cn = 5
+        cns = _sample_copy_numbers(chrom, samples, rng)
+        alts = sorted({cn for cn_tuple in cns for cn in cn_tuple if cn != ref_cn})
+        alleles = [ref_cn, *alts]
+
+        sample_cols = []
+        for cn_tuple in cns:
+            if rng.random() < 0.1:
+                sample_cols.append(".")
+                continue
+            # HipSTR genotypes are phased; some posteriors are missing, to exercise the Float "." conversion
+            q = f"{rng.random():.3f}" if rng.random() < 0.8 else "."
+            sample_cols.append(":".join((
+                "|".join(str(alleles.index(cn)) for cn in cn_tuple),
+                "|".join(str((cn - ref_cn) * len(motif)) for cn in cn_tuple),
+                q,
+                f"{rng.random():.3f}",
+                str(rng.randint(1, 60)),
+                "|".join(f"{rng.random() * 20:.2f}" for _ in cn_tuple),
+                ";".join(f"{(cn - ref_cn) * len(motif)}|{rng.randint(1, 9)}" for cn in sorted(set(cn_tuple))),
+            )))
+
+        start, end = pos, pos + len(motif) * ref_cn - 1
+        records.append("\t".join([
+            chrom, str(pos), ".", motif * ref_cn, ",".join(motif * cn for cn in alts) or ".", ".", "PASS",
+            f"START={start};END={end};PERIOD={len(motif)}", "GT:GB:Q:PQ:DP:PDP:ALLREADS", *sample_cols]))
+
+    return _write_vcf(path, HIPSTR_HEADER, samples, records)
+
+
+def _write_eh_vcf(path: str, samples, rng: random.Random):
+    records = []
+
+    for chrom, pos, motif in PLOIDY_LOCI:
+        if rng.random() < 0.25:
+            continue
+
+        ref_cn = 5
+        cns = _sample_copy_numbers(chrom, samples, rng)
+        alts = sorted({cn for cn_tuple in cns for cn in cn_tuple if cn != ref_cn})
+        alleles = [ref_cn, *alts]
+
+        sample_cols = []
+        for cn_tuple in cns:
+            if rng.random() < 0.1:
+                sample_cols.append(".")
+                continue
+            sample_cols.append(":".join((
+                "/".join(str(alleles.index(cn)) for cn in cn_tuple),
+                "/".join("SPANNING" for _ in cn_tuple),
+                "/".join(str(cn) for cn in cn_tuple),
+                "/".join(f"{cn}-{cn + rng.randint(0, 1)}" for cn in cn_tuple),
+                "/".join(str(rng.randint(0, 9)) for _ in cn_tuple),
+                "/".join(str(rng.randint(0, 9)) for _ in cn_tuple),
+                "/".join(str(rng.randint(0, 9)) for _ in cn_tuple),
+                f"{rng.random() * 40:.6f}",
+            )))
+
+        rep_id = f"{chrom}_{pos}"
+        records.append("\t".join([
+            chrom, str(pos), ".", "C", ",".join(f"<STR{cn}>" for cn in alts) or ".", ".", "PASS",
+            f"END={pos + len(motif) * ref_cn};REF={ref_cn};REPID={rep_id};RL={len(motif) * ref_cn};RU={motif};"
+            f"VARID={rep_id}",
+            "GT:SO:REPCN:REPCI:ADSP:ADFL:ADIR:LC", *sample_cols]))
+
+    return _write_vcf(path, EH_HEADER, samples, records)
+
+
+VCF_WRITERS = {
+    "gangstr": _write_gangstr_vcf,
+    "hipstr": _write_hipstr_vcf,
+    "eh": _write_eh_vcf,
+}
+
+
+@pytest.mark.parametrize("vcf_type", list(VCF_WRITERS))
+def test_merge_str_vcfs_matches_mergestr(tmp_path, vcf_type):
+    from argparse import Namespace
+
+    rng = random.Random(42)
+    vcfs = [
+        VCF_WRITERS[vcf_type](str(tmp_path / f"in_{i}.vcf"), [f"s{i}_{j}" for j in range(i + 1)], rng)
+        for i in range(4)
+    ]
+
+    ref_prefix = str(tmp_path / "ref")
+    assert mergestr_main(Namespace(
+        out=ref_prefix, vcfs=",".join(vcfs), vcftype=vcf_type, update_sample_from_file=False, verbose=False,
+        quiet=True)) == 0
+
+    out_prefix = str(tmp_path / "out")
+    merge_str_vcfs(vcfs, out_prefix, vcf_type)
+
+    with open(f"{ref_prefix}.vcf") as rf, open(f"{out_prefix}.vcf") as of:
+        ref_lines = rf.read().split("\n")
+        out_lines = of.read().split("\n")
+
+    assert len(out_lines) > 30
+    assert out_lines == ref_lines
+
+
+
+def test_merge_str_vcfs_region(tmp_path):
+    rng = random.Random(5)
+    vcfs = [_write_gangstr_vcf(str(tmp_path / f"in_{i}.vcf"), [f"s{i}"], rng) for i in range(3)]
+    # No records in the region at all, which only adds no-call sample columns
+    vcfs.append(_write_gangstr_vcf(str(tmp_path / "in_chr2.vcf"), ["s_chr2"], rng, loci=LOCI[20:]))
+
+    merge_str_vcfs(vcfs, str(tmp_path / "all"), "gangstr")
+    # Records are only merged into the region they start in; chr1:1000 spans the region's start.
+    merge_str_vcfs(vcfs, str(tmp_path / "region"), "gangstr", region=("chr1", 1001, 1800))
+
+    with open(tmp_path / "all.vcf") as af, open(tmp_path / "region.vcf") as rf:
+        all_lines = af.read().split("\n")
+        region_lines = rf.read().split("\n")
+
+    header = [ln for ln in all_lines if ln.startswith("#")]
+    records = [ln for ln in all_lines if ln.startswith("chr1\t") and 1001 <= int(ln.split("\t")[1]) <= 1800]
+
+    assert len(records) > 3
+    assert all(ln.endswith("\t.") for ln in records)
+    assert region_lines == header + records + [""]
+
+
+def test_merge_str_vcfs_no_call_without_alts(tmp_path):
+    from argparse import Namespace
+
+    # A reference-only record where a sample is not called at all, as in the output of an earlier merge
+    info = "END=1009;RU=AC;PERIOD=2;REF=5;EXPTHRESH=-1"
+    fmt = "GT:DP:Q:REPCN:REPCI:RC:ML:INS"
+    call = "0/0:20:0.9:5,5:5-5,5-5:1,2,0,3:10.00:400.0,20.00"
+    vcfs = [
+        _write_vcf(str(tmp_path / "in_0.vcf"), GANGSTR_HEADER, ["a1", "a2"],
+                   ["\t".join(["chr1", "1000", ".", "AC" * 5, ".", ".", "PASS", info, fmt, call, "."])]),
+        _write_vcf(str(tmp_path / "in_1.vcf"), GANGSTR_HEADER, ["b1"],
+                   ["\t".join(["chr1", "1000", ".", "AC" * 5, ".", ".", "PASS", info, fmt, call])]),
+    ]
+
+    ref_prefix = str(tmp_path / "ref")
+    assert mergestr_main(Namespace(
+        out=ref_prefix, vcfs=",".join(vcfs), vcftype="gangstr", update_sample_from_file=False, verbose=False,
+        quiet=True)) == 0
+
+    out_prefix = str(tmp_path / "out")
+    merge_str_vcfs(vcfs, out_prefix, "gangstr")
+
+    with open(f"{ref_prefix}.vcf") as rf, open(f"{out_prefix}.vcf") as of:
+        assert of.read() == rf.read()
@@ -0,0 +1,134 @@
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from bcf_extras import metrics
+from bcf_extras.entry import main
+from bcf_extras.exceptions import BCFExtrasInputError
+from bcf_extras.parallel_mergestr import mergestr_main
+
+
+def _echo(text: str) -> str:
+    with metrics.stage("worker_step", text=text):
+        return metrics.check_output([sys.executable, "-c", f"print({text!r})"]).decode().strip()
+
+
+def test_metrics_disabled():
+    assert metrics.active() is None
+    with metrics.stage("not_recorded"):
+        assert metrics.check_output([sys.executable, "-c", "print('hi')"]) == b"hi\n"
+    proc = metrics.popen([sys.executable, "-c", "pass"])
+    assert metrics.wait(proc) == 0
+    assert metrics.unwrap(metrics.wrap(_echo)("x")) == "x"
+
+
+def test_metrics_collect():
+    seen = []
+    with metrics.collect(hook=seen.append) as collector:
+        with metrics.stage("outer", label=["a"]):
+            with metrics.stage("inner"):
+                metrics.check_call(
+                    [sys.executable, "-c", "import sys; sys.stdout.write('x' * 100000)"], stdout=subprocess.DEVNULL)
+            with pytest.raises(subprocess.CalledProcessError):
+                metrics.check_call([sys.executable, "-c", "raise SystemExit(3)"])
+        assert metrics.active() is collector
+    assert metrics.active() is None
+
+    assert seen == collector.records
+    assert all(tuple(r) == metrics.RECORD_FIELDS for r in collector.records)
+
+    ok, inner, failed, outer = collector.records
+    assert (outer["name"], outer["parent"], outer["labels"]) == ("outer", None, {"label": "['a']"})
+    assert (inner["name"], inner["parent"]) == ("inner", outer["id"])
+    assert ok["kind"] == metrics.KIND_PROCESS and ok["parent"] == inner["id"]
+    assert (ok["status"], ok["returncode"], failed["status"], failed["returncode"]) == ("ok", 0, "error", 3)
+    assert ok["args"][0] == sys.executable and ok["name"] == os.path.basename(sys.executable)
+
+    for r in collector.records:
+        assert r["wall_seconds"] > 0
+        assert r["peak_rss_bytes"] > 0
+        assert r["cpu_user_seconds"] + r["cpu_system_seconds"] > 0
+    assert outer["wall_seconds"] >= inner["wall_seconds"] >= ok["wall_seconds"]
+    assert failed["parent"] == outer["id"]
+
+    if sys.platform.startswith("linux"):
+        assert ok["write_bytes"] >= 100000
+        assert inner["write_bytes"] >= ok["write_bytes"]
+
+    doc = json.loads(json.dumps(collector.to_dict(command="test")))
+    assert (doc["schema"], doc["schema_version"], doc["command"]) == (metrics.SCHEMA, metrics.SCHEMA_VERSION, "test")
+    assert doc["totals"]["wall_seconds"] >= outer["wall_seconds"]
+
+
+def test_peak_rss_bytes():
+    from types import SimpleNamespace
+
+    unit = 1 if sys.platform == "darwin" else 1024
+    assert metrics.peak_rss_bytes(SimpleNamespace(ru_maxrss=3), SimpleNamespace(ru_maxrss=7)) == 7 * unit
+    assert metrics.peak_rss_bytes(SimpleNamespace(ru_maxrss=5)) == 5 * unit
+
+
+def test_metrics_worker_records():
+    with metrics.collect() as collector:
+        with metrics.stage("batch"):
+            with multiprocessing.Pool(2) as p:
+                jobs = [p.apply_async(metrics.wrap(_echo), (t,)) for t in ("a", "b")]
+                assert [metrics.unwrap(j.get()) for j in jobs] == ["a", "b"]
+
+    batch = collector.records[-1]
+    steps = [r for r in collector.records if r["name"] == "worker_step"]
+    assert sorted(r["labels"]["text"] for r in steps) == ["a", "b"]
+    assert all(r["parent"] == batch["id"] and r["pid"] != batch["pid"] for r in steps)
+    assert len({r["id"] for r in collector.records}) == len(collector.records)
+    for step in steps:
+        assert [r["kind"] for r in collector.records if r["parent"] == step["id"]] == [metrics.KIND_PROCESS]
+
+
+def test_metrics_json_cli(tmp_path, capsys):
+    gff = tmp_path / "test.gff3"
+    gff.write_text("##gff-version 3\nchr1\ttest\tgene\t10\t100\t.\t+\t.\tID=g1\n")
+    out = tmp_path / "metrics.json"
+
+    main(["--metrics-json", str(out), "filter-gff3", "--type", "gene", str(gff)])
+    assert "ID=g1" in capsys.readouterr().out
+
+    doc = json.loads(out.read_text())
+    assert (doc["command"], doc["status"], doc["error"]) == ("filter-gff3", "ok", None)
+    assert [r["name"] for r in doc["records"]] == ["filter", "filter-gff3"]
+    assert doc["records"][0]["labels"]["mode"] == "sequential"
+
+    with pytest.raises(BCFExtrasInputError):
+        main(["--metrics-json", str(out), "query-gff3", "--id", "g1", str(gff)])
+    doc = json.loads(out.read_text())
+    assert doc["status"] == "error" and "No index found" in doc["error"]
+
+
+@pytest.mark.skipif(
+    shutil.which("bgzip") is None or shutil.which("tabix") is None or mergestr_main is None,
+    reason="htslib or TRTools is not installed")
+def test_metrics_merge_tree(tmp_path, monkeypatch):
+    from .test_mergestr_engine import _write_gangstr_vcf
+    from bcf_extras.parallel_mergestr import parallel_mergestr
+
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(3)
+    inputs = [_write_gangstr_vcf(str(tmp_path / f"in_{i}.vcf"), [f"s{i}"], rng) for i in range(4)]
+
+    with metrics.collect() as collector:
+        parallel_mergestr(inputs, "out", "gangstr", ntasks=2, fan_in=2, engine="builtin")
+
+    nodes = [r for r in collector.records if r["name"] == "merge_node"]
+    assert sorted((r["labels"]["level"], r["labels"]["final"]) for r in nodes) == [
+        (0, False), (0, False), (1, True)]
+    assert all(r["labels"]["inputs"] == 2 and r["labels"]["output"] for r in nodes)
+
+    by_id = {r["id"]: r for r in collector.records}
+    for r in nodes:
+        assert by_id[r["parent"]]["name"] == ("step_2" if r["labels"]["final"] else "step_1")
+    assert any(r["kind"] == metrics.KIND_PROCESS and r["name"] in ("bgzip", "tabix") for r in collector.records)
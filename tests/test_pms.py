@@ -0,0 +1,442 @@
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+
+import pytest
+
+from bcf_extras import parallel_mergestr as pms
+from bcf_extras.bgzf import BGZF_EOF, has_bgzf_eof
+from bcf_extras.exceptions import BCFExtrasInputError, BCFExtrasProcessError
+from bcf_extras.parallel_mergestr import (
+    _balanced_groups,
+    _build_merge_tree,
+    _concat_vcfs,
+    parallel_mergestr,
+    mergestr_main,
+)
+
+
+requires_htslib = pytest.mark.skipif(
+    shutil.which("bgzip") is None or shutil.which("tabix") is None, reason="htslib is not installed")
+
+vcfs = [f"s{i}.vcf.gz" for i in range(10)]
+
+
+def test_merge_tree_two_level():
+    nodes = _build_merge_tree(vcfs, "out", "pmi", 3)
+
+    assert [n.inputs for n in nodes[:-1]] == [vcfs[0:3], vcfs[3:6], vcfs[6:10]]
+    assert [n.out_prefix for n in nodes[:-1]] == ["pmi_0", "pmi_1", "pmi_2"]
+    assert nodes[-1].final
+    assert nodes[-1].inputs == ["pmi_0.vcf.gz", "pmi_1.vcf.gz", "pmi_2.vcf.gz"]
+    assert nodes[-1].deps == ["pmi_0", "pmi_1", "pmi_2"]
+    assert nodes[-1].output == "out.vcf"
+
+
+def test_merge_tree_single_group():
+    nodes = _build_merge_tree(vcfs[:3], "out", "pmi", 5)
+    assert len(nodes) == 1
+    assert nodes[0].final
+    assert nodes[0].inputs == vcfs[:3]
+    assert nodes[0].deps == []
+
+
+def test_merge_tree_multi_level():
+    nodes = _build_merge_tree(vcfs, "out", "pmi", 2, fan_in=2)
+
+    # The leftover pmi_4 isn't merged by itself, but carried up until it can go into the final merge
+    assert [n.level for n in nodes] == [0, 0, 0, 0, 0, 1, 1, 2, 3]
+    assert nodes[5].deps == ["pmi_0", "pmi_1"]
+    assert nodes[6].deps == ["pmi_2", "pmi_3"]
+    assert nodes[6].inputs == ["pmi_2.vcf.gz", "pmi_3.vcf.gz"]
+    assert nodes[7].deps == ["pmi_L1_0", "pmi_L1_1"]
+    assert nodes[-1].deps == ["pmi_L2_0", "pmi_4"]
+
+    # Every dependency must come before the node which depends on it
+    seen = set()
+    for n in nodes:
+        assert all(d in seen for d in n.deps)
+        seen.add(n.id)
+
+
+@pytest.mark.parametrize("n_vcfs,ntasks,fan_in", [(30, 30, 4), (70, 10, 3), (14, 7, 3), (10, 5, 2), (100, 3, 8)])
+def test_merge_tree_fan_in_cap(n_vcfs, ntasks, fan_in):
+    inputs = [f"s{i}.vcf.gz" for i in range(n_vcfs)]
+    nodes = pms._build_plan(inputs, "out", "pmi", ntasks, fan_in, shard=False, shard_size=None)
+
+    assert max(len(n.inputs) for n in nodes) <= fan_in
+    assert all(len(n.inputs) >= 2 for n in nodes if n.level > 0)  # No merges of a single intermediate
+    assert sorted(sum((n.inputs for n in nodes if n.level == 0), [])) == sorted(inputs)
+
+
+def test_balanced_groups():
+    items = list("abcdefgh")
+    weights = [10, 1, 1, 1, 1, 1, 1, 10]
+
+    groups = _balanced_groups(items, weights, 3)
+    assert groups == [["a"], ["b", "c", "d", "e", "f", "g"], ["h"]]
+    assert sum(groups, []) == items  # Order is preserved
+
+    # Capping group size takes precedence over balance
+    assert _balanced_groups(items, weights, 3, max_size=3) == [["a", "b", "c"], ["d", "e", "f"], ["g", "h"]]
+
+
+def test_merge_tree_weighted():
+    weights = [100, 1, 1, 1, 1, 1, 1, 1, 1, 100]
+    nodes = _build_merge_tree(vcfs, "out", "pmi", 3, weights=weights)
+
+    # Same number of groups as an unweighted tree, but the heavy VCFs get groups to themselves
+    assert [n.inputs for n in nodes[:-1]] == [vcfs[0:1], vcfs[1:9], vcfs[9:10]]
+    assert [n.cost for n in nodes] == [100, 8, 100, 208]
+
+
+def test_shard_regions(monkeypatch):
+    monkeypatch.setattr(pms, "_header_contigs", lambda _vcf: [("chr1", 25), ("chr2", 10), ("chr3", None)])
+    monkeypatch.setattr(pms, "_indexed_contigs", lambda vcf: {"a": ["chr3", "chr1"], "b": ["chrUn", "chr1"]}[vcf])
+
+    assert pms._shard_regions(["a", "b"]) == [("chr1", 1, None), ("chr3", 1, None), ("chrUn", 1, None)]
+    assert pms._shard_regions(["a", "b"], shard_size=10) == [
+        ("chr1", 1, 10), ("chr1", 11, 20), ("chr1", 21, 25), ("chr3", 1, None), ("chrUn", 1, None)]
+
+
+def test_concat_vcfs(tmp_path):
+    header = "##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n"
+    shards = []
+    for idx, body in enumerate((None, "chr1\t1\n", "", "chr2\t5\nchr2\t7\n")):
+        shard = tmp_path / f"shard_{idx}.vcf"
+        shard.write_text("" if body is None else f"##command=merge {idx}\n{header}{body}")  # None: no records at all
+        shards.append(str(shard))
+
+    _concat_vcfs(shards, str(tmp_path / "out.vcf"))
+
+    assert (tmp_path / "out.vcf").read_text() == f"##command=merge 1\n{header}chr1\t1\nchr2\t5\nchr2\t7\n"
+
+
+def test_add_no_call_samples(tmp_path):
+    empty = tmp_path / "empty.vcf.gz"
+    with gzip.open(empty, "wt") as fh:
+        fh.write("##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tb1\tb2\n")
+    assert pms._extract_samples(str(empty)) == (["b1", "b2"], False)
+
+    merged = tmp_path / "merged.vcf"
+    merged.write_text(
+        "##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ta\tc\n"
+        "chr1\t5\t.\tA\t.\t.\t.\t.\tGT\t0/0\t.\n")
+
+    pms._add_no_call_samples(str(merged), [(["a"], True), (["b1", "b2"], False), (["c"], True)])
+
+    assert merged.read_text() == (
+        "##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ta\tb1\tb2\tc\n"
+        "chr1\t5\t.\tA\t.\t.\t.\t.\tGT\t0/0\t.\t.\t.\n")
+
+
+@pytest.mark.skipif(mergestr_main is None, reason="TRTools is not installed")
+def test_pms_raises():
+    with pytest.raises(BCFExtrasInputError):
+        parallel_mergestr(vcfs, "out", step_1_only=True, step_2_only=True)
+    with pytest.raises(BCFExtrasInputError):
+        parallel_mergestr(vcfs, "out", fan_in=1)
+    with pytest.raises(BCFExtrasInputError):
+        parallel_mergestr(vcfs, "out", shard_size=0)
+    with pytest.raises(BCFExtrasInputError):
+        parallel_mergestr(vcfs, "out", shard=True, fan_in=4)
+    with pytest.raises(BCFExtrasInputError):
+        parallel_mergestr(vcfs, "out", max_mem=0)
+
+
+def test_checkpoint(tmp_path):
+    inputs = []
+    for i in range(4):
+        vcf = tmp_path / f"s{i}.vcf.gz"
+        vcf.write_bytes(b"x" * (i + 1))
+        inputs.append(str(vcf))
+
+    nodes = _build_merge_tree(inputs, str(tmp_path / "out"), str(tmp_path / "pmi"), 2)
+    manifest = str(tmp_path / "pmi.manifest.json")
+
+    checkpoint = pms._MergeCheckpoint(manifest, pms._node_fingerprints(nodes, "gangstr"))
+    assert pms._nodes_to_run(nodes, nodes[:2], checkpoint) == nodes[:2]
+
+    # Pretend the first intermediate merge finished
+    (tmp_path / "pmi_0.vcf.gz").write_bytes(BGZF_EOF)
+    (tmp_path / "pmi_0.vcf.gz.tbi").write_bytes(b"")
+    checkpoint.mark_done(nodes[0])
+
+    checkpoint = pms._MergeCheckpoint(manifest, pms._node_fingerprints(nodes, "gangstr"))
+    assert pms._nodes_to_run(nodes, nodes[:2], checkpoint) == nodes[1:2]
+
+    # Different options invalidate the cached merge
+    checkpoint = pms._MergeCheckpoint(manifest, pms._node_fingerprints(nodes, "hipstr"))
+    assert pms._nodes_to_run(nodes, nodes[:2], checkpoint) == nodes[:2]
+
+    # ... as do changed inputs
+    (tmp_path / "s0.vcf.gz").write_bytes(b"changed")
+    checkpoint = pms._MergeCheckpoint(manifest, pms._node_fingerprints(nodes, "gangstr"))
+    assert pms._nodes_to_run(nodes, nodes[:2], checkpoint) == nodes[:2]
+
+    # ... and so does resuming being turned off
+    checkpoint = pms._MergeCheckpoint(manifest, pms._node_fingerprints(nodes, "gangstr"), enabled=False)
+    assert not checkpoint.is_done(nodes[0])
+
+
+def test_checkpoint_truncated_output(tmp_path):
+    inputs = [str(tmp_path / f"s{i}.vcf.gz") for i in range(4)]
+    nodes = _build_merge_tree(inputs, str(tmp_path / "out"), str(tmp_path / "pmi"), 2)
+
+    checkpoint = pms._MergeCheckpoint(str(tmp_path / "m.json"), pms._node_fingerprints(nodes, "gangstr"))
+    (tmp_path / "pmi_0.vcf.gz").write_bytes(b"truncated")
+    (tmp_path / "pmi_0.vcf.gz.tbi").write_bytes(b"")
+    checkpoint.mark_done(nodes[0])
+
+    assert not checkpoint.is_done(nodes[0])
+
+
+def test_memory_model(tmp_path):
+    inputs = []
+    for i in range(4):
+        vcf = tmp_path / f"s{i}.vcf"
+        samples = "".join(f"\ts{i}_{j}" for j in range(i + 1))
+        vcf.write_text(f"##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT{samples}\n")
+        inputs.append(str(vcf))
+
+    nodes = _build_merge_tree(inputs, str(tmp_path / "out"), str(tmp_path / "pmi"), 2)
+    pms._count_samples(nodes, inputs)
+    assert [n.samples for n in nodes] == [3, 7, 10]
+
+    memory = pms._MemoryModel()
+    estimate = memory.estimate(nodes[0])
+    assert estimate == pms._MEM_BASE + 2 * pms._MEM_PER_INPUT + 3 * pms._MEM_PER_SAMPLE
+    assert memory.estimate(nodes[1]) > estimate
+
+    # Measured peaks scale later estimates, erring on the side of the largest ratio seen
+    memory.observe(nodes[0], estimate * 2)
+    memory.observe(nodes[1], memory.base_estimate(nodes[1]) // 2)
+    assert memory.estimate(nodes[0]) == estimate * 2
+
+    # Peaks are kept in the manifest for resumed runs
+    manifest = str(tmp_path / "pmi.manifest.json")
+    checkpoint = pms._MergeCheckpoint(manifest, pms._node_fingerprints(nodes, "gangstr"))
+    checkpoint.mark_done(nodes[0], estimate * 2)
+    checkpoint = pms._MergeCheckpoint(manifest, pms._node_fingerprints(nodes, "gangstr"))
+    assert checkpoint.peak_rss(nodes[0]) == estimate * 2
+    assert checkpoint.peak_rss(nodes[1]) is None
+
+
+def test_throughput_model(tmp_path):
+    inputs = []
+    for i in range(4):
+        vcf = tmp_path / f"s{i}.vcf"
+        vcf.write_bytes(b"#" * 1024 * (i + 1))
+        inputs.append(str(vcf))
+
+    nodes = _build_merge_tree(
+        inputs, str(tmp_path / "out"), str(tmp_path / "pmi"), 2, weights=pms._input_weights(inputs))
+    options = pms._MergeOptions(vcf_type="gangstr")
+    default_rate = pms._DEFAULT_MERGE_RATES[options.engine]
+
+    # Before anything has been timed, predictions come from the default merge rate
+    throughput = pms._ThroughputModel(pms._default_merge_rate(nodes, options.engine))
+    assert nodes[0].cost > 1024
+    assert throughput.predict(nodes[0]) == pytest.approx(nodes[0].cost / default_rate)
+
+    throughput.observe(nodes[0], 2.0)
+    assert throughput.predict(nodes[-1]) == pytest.approx(nodes[-1].cost / nodes[0].cost * 2.0)
+
+    # Run times are kept in the manifest, so that a resumed run can predict with them straight away
+    manifest = str(tmp_path / "pmi.manifest.json")
+    checkpoint = pms._MergeCheckpoint(manifest, pms._node_fingerprints(nodes, "gangstr"))
+    checkpoint.mark_done(nodes[0], elapsed=2.0)
+    checkpoint = pms._MergeCheckpoint(manifest, pms._node_fingerprints(nodes, "gangstr"))
+    _memory, throughput = pms._models_from_checkpoint(nodes, options, checkpoint)
+    assert throughput.predict(nodes[-1]) == pytest.approx(nodes[-1].cost / nodes[0].cost * 2.0)
+
+    # Shard costs are region lengths, so the default rate is spread over the sharded bases
+    shards = [
+        pms._MergeNode(id=f"sh{i}", out_prefix=f"sh{i}", level=0, inputs=inputs, cost=500, region=("chr1", 1, 500))
+        for i in range(2)
+    ]
+    assert pms._default_merge_rate(shards, options.engine) == pytest.approx(default_rate * 1000 / (10 * 1024))
+
+
+@requires_htslib
+def test_merge_compress_streaming(tmp_path, monkeypatch):
+    vcf = "##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n" + "chr1\t10\t.\tA\tT\t.\tPASS\t.\n"
+
+    def _fake_mergestr(args):
+        with open(f"{args.out}.vcf", "w") as fh:
+            fh.write(vcf)
+        return 0
+
+    monkeypatch.setattr(pms, "mergestr_main", _fake_mergestr)
+
+    prefix = str(tmp_path / "pmi_0")
+    assert pms._merge_compress_streaming(prefix, ["a.vcf.gz"], pms._MergeOptions(), False) == f"{prefix}.vcf.gz"
+    assert not os.path.exists(f"{prefix}.vcf")
+    assert os.path.exists(f"{prefix}.vcf.gz.tbi")
+    assert has_bgzf_eof(f"{prefix}.vcf.gz")
+
+    with gzip.open(f"{prefix}.vcf.gz", "rt") as fh:
+        assert fh.read() == vcf
+
+
+@requires_htslib
+def test_merge_compress_streaming_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr(pms, "mergestr_main", lambda _args: 1)
+
+    prefix = str(tmp_path / "pmi_0")
+    with pytest.raises(BCFExtrasProcessError):
+        pms._merge_compress_streaming(prefix, ["a.vcf.gz"], pms._MergeOptions(), False)
+
+    assert not os.path.exists(f"{prefix}.vcf")
+
+
+@requires_htslib
+@pytest.mark.skipif(mergestr_main is None, reason="TRTools is not installed")
+@pytest.mark.parametrize("kwargs", [
+    {}, {"fan_in": 2, "stream_intermediates": True}, {"shard": True}, {"fan_in": 2, "max_mem": 1},
+    {"shard": True, "engine": pms.ENGINE_BUILTIN}])
+def test_pms_matches_mergestr(tmp_path, monkeypatch, kwargs):
+    from argparse import Namespace
+    from .test_mergestr_engine import LOCI, _write_gangstr_vcf
+
+    monkeypatch.chdir(tmp_path)
+
+    if kwargs.get("engine") == pms.ENGINE_BUILTIN:
+        # The builtin engine reads shard regions straight from the inputs, without extracting them
+        monkeypatch.setattr(pms.metrics, "check_call", lambda args, **_kwargs: pytest.fail(f"ran {args}"))
+
+    rng = random.Random(7)
+    inputs = [_write_gangstr_vcf(str(tmp_path / f"in_{i}.vcf"), [f"s{i}"], rng) for i in range(5)]
+
+    # One sample without any chr2 calls, which makes for an empty region shard input
+    inputs.append(_write_gangstr_vcf(
+        str(tmp_path / "in_chr1.vcf"), ["s_chr1"], rng, loci=[locus for locus in LOCI if locus[0] == "chr1"]))
+
+    assert mergestr_main(Namespace(
+        out="ref", vcfs=",".join(inputs), vcftype="gangstr", update_sample_from_file=False, verbose=False,
+        quiet=True)) == 0
+
+    parallel_mergestr(inputs, "out", "gangstr", ntasks=2, **kwargs)
+
+    with open("ref.vcf") as rf, open("out.vcf") as of:
+        ref_lines = [ln for ln in rf if not ln.startswith("##command")]
+        assert [ln for ln in of if not ln.startswith("##command")] == ref_lines
+
+    assert not [fn for fn in os.listdir(tmp_path) if fn.startswith("pmerge_intermediate")]
+
+
+@requires_htslib
+@pytest.mark.skipif(mergestr_main is None, reason="TRTools is not installed")
+@pytest.mark.parametrize("kwargs", [{}, {"shard": True}])
+def test_pms_first_wave_predictions(tmp_path, monkeypatch, capsys, kwargs):
+    from .test_mergestr_engine import _write_gangstr_vcf
+
+    monkeypatch.chdir(tmp_path)
+
+    rng = random.Random(3)
+    inputs = [_write_gangstr_vcf(str(tmp_path / f"in_{i}.vcf"), [f"s{i}"], rng) for i in range(4)]
+    parallel_mergestr(inputs, "out", "gangstr", ntasks=2, **kwargs)
+
+    # With no --max-mem, every first-level merge is queued before any has finished; they still get predicted times
+    queued = [ln for ln in capsys.readouterr().out.split("\n") if "Queued level 0" in ln]
+    assert len(queued) == 2
+    assert all(re.search(r"predicted time: \d+\.\ds", ln) for ln in queued)
+
+
+def test_pms_vcf_list(tmp_path, monkeypatch):
+    from bcf_extras.entry import main
+
+    calls = []
+    monkeypatch.setattr(pms, "parallel_mergestr", lambda vcfs, *args, **kwargs: calls.append(vcfs))
+
+    vcf_list = tmp_path / "vcfs.txt"
+    vcf_list.write_text("b.vcf.gz\n# comment\nc.vcf.gz\n")
+    main(["parallel-mergeSTR", "--out", "merged", "--vcf-list", str(vcf_list), "a.vcf.gz"])
+    assert calls == [["a.vcf.gz", "b.vcf.gz", "c.vcf.gz"]]
+
+    vcf_list.write_text("\n")
+    with pytest.raises(SystemExit):
+        main(["parallel-mergeSTR", "--out", "merged", "--vcf-list", str(vcf_list)])
+
+
+def test_describe_inputs():
+    assert pms._describe_inputs(["a.vcf", "b.vcf"]) == "[a.vcf, b.vcf]"
+    described = pms._describe_inputs([f"{i}.vcf" for i in range(20000)])
+    assert described.endswith(", ... (20000 files)]") and "10.vcf" not in described
+
+
+def test_plan_mergestr(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    inputs = []
+    for i in range(6):
+        (tmp_path / f"s{i}.vcf.gz").write_bytes(b"x" * (i + 1))
+        inputs.append(f"s{i}.vcf.gz")
+
+    plan_path = str(tmp_path / "plan.json")
+    plan = pms.plan_mergestr(inputs, "out", plan_path, "gangstr", ntasks=3, fan_in=2)
+
+    with open(plan_path) as fh:
+        assert json.load(fh) == plan
+    assert plan["schema"] == pms.PLAN_SCHEMA
+    assert plan["vcfs"] == [str(tmp_path / v) for v in inputs]
+    assert [len(level) for level in plan["levels"]] == [3, 1, 1]
+    assert plan["levels"][-1] == [str(tmp_path / "out")]
+
+    _, nodes, options = pms._load_plan(plan_path)
+    assert (options.vcf_type, options.engine) == ("gangstr", pms.ENGINE_MERGESTR)
+    assert nodes == _build_merge_tree(
+        plan["vcfs"], str(tmp_path / "out"), str(tmp_path / "pmerge_intermediate_out"), 2, 2,
+        weights=pms._input_weights(plan["vcfs"]))
+    assert all(os.path.isabs(i) for n in nodes for i in n.inputs)
+    assert all(r["estimated_memory"] > 0 and r["cost"] > 0 for r in plan["nodes"])
+
+    with pytest.raises(BCFExtrasInputError):
+        pms.plan_mergestr(inputs, "out", plan_path, fan_in=2, shard=True)
+
+    (tmp_path / "not_a_plan.json").write_text("{}")
+    with pytest.raises(BCFExtrasInputError):
+        pms._load_plan(str(tmp_path / "not_a_plan.json"))
+
+
+@pytest.mark.skipif(mergestr_main is None, reason="TRTools is not installed")
+def test_run_merge_plan(tmp_path, monkeypatch):
+    from bcf_extras.entry import main
+    from .test_mergestr_engine import _write_gangstr_vcf
+
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(11)
+    inputs = [_write_gangstr_vcf(str(tmp_path / f"in_{i}.vcf"), [f"s{i}"], rng) for i in range(5)]
+
+    parallel_mergestr(inputs, "ref", "gangstr", ntasks=4, fan_in=2, engine="builtin")
+    with open("ref.vcf") as fh:
+        expected = [ln for ln in fh if not ln.startswith("##command")]
+
+    def _output(name: str) -> list:
+        with open(name) as fh:
+            return [ln for ln in fh if not ln.startswith("##command")]
+
+    main(["plan-mergeSTR", "--plan", "plan.json", "--out", "out", "--vcftype", "gangstr", "--ntasks", "4",
+          "--fan-in", "2", "--engine", "builtin", *inputs])
+    with open("plan.json") as fh:
+        levels = json.load(fh)["levels"]
+
+    # Nodes can't run before the nodes they depend on
+    with pytest.raises(BCFExtrasInputError):
+        main(["run-merge-plan", "--node", levels[-1][0], "plan.json"])
+
+    # One node at a time, level by level, as a cluster array job would
+    for level, ids in enumerate(levels):
+        for index in range(len(ids)):
+            main(["run-merge-plan", "--level", str(level), "--index", str(index), "plan.json"])
+    assert _output("out.vcf") == expected
+    with pytest.raises(BCFExtrasInputError):
+        main(["run-merge-plan", "--level", str(len(levels)), "--index", "0", "plan.json"])
+
+    # The whole plan at once, with the local executor
+    os.remove("out.vcf")
+    main(["run-merge-plan", "--ntasks", "2", "plan.json"])
+    assert _output("out.vcf") == expected
+    assert not [fn for fn in os.listdir(tmp_path) if fn.startswith("pmerge_intermediate")]